@@ -1,13 +1,128 @@
 import os
+import sys
 import unittest
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
 import time
 import functools
+import copy
 import argparse
 import math
+import json
+import threading
+import Queue
+import multiprocessing
+import subprocess
+import pickle
+import tempfile
 import numpy as np
+from vtk.util import numpy_support
+import SpectrumAnalysis
+from SpectrumAnalysis import (SpectrumPreprocessor, SignalQualityScorer, ScanRecording, reanalyzeRecording,
+                              ThresholdCalibrator, SpectralLibrary)
+
+
+#
+# SpanTracer
+#
+
+class SpanTracer(object):
+    """Opt-in timing of the module's entry points. Spans (name, category, start,
+  duration, thread) are written to preallocated arrays, nothing is recorded
+  while disabled and tracing stops silently once the buffer is full.
+  exportChromeTrace() writes the spans in the Chrome trace event format, which
+  chrome://tracing, Perfetto or speedscope show as a timeline.
+  """
+
+    def __init__(self, capacity=100000):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.capacity = int(capacity)
+        self.keyIds = np.zeros(self.capacity, dtype=np.int32)
+        self.starts = np.zeros(self.capacity)
+        self.durations = np.zeros(self.capacity)
+        self.threadIds = np.zeros(self.capacity, dtype=np.int64)
+        self.keys = []  # (name, category) of every key id
+        self.keyIndex = {}
+        self.clear()
+
+    def __len__(self):
+        return self.numberOfSpans
+
+    def clear(self):
+        self.numberOfSpans = 0
+        self.droppedSpans = 0
+        self.origin = time.time()
+
+    def start(self):
+        self.clear()
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+
+    def record(self, name, category, start, end):
+        with self.lock:
+            if self.numberOfSpans == self.capacity:
+                self.droppedSpans = self.droppedSpans + 1
+                return
+            key = (name, category)
+            if key not in self.keyIndex:
+                self.keyIndex[key] = len(self.keys)
+                self.keys.append(key)
+            index = self.numberOfSpans
+            self.keyIds[index] = self.keyIndex[key]
+            self.starts[index] = start
+            self.durations[index] = end - start
+            self.threadIds[index] = threading.current_thread().ident
+            self.numberOfSpans = index + 1
+
+    def traceCommand(self, command, category="printer"):
+        # span from sending an OpenIGTLink command to its completion, e.g. "command G01"
+        if not self.enabled:
+            return
+        name = "command " + (command.GetCommandAttribute('Text') or command.GetCommandName()).split(" ")[0]
+        start = time.time()
+        observerTags = []
+        def onCompleted(caller, eventid):
+            command.RemoveObserver(observerTags[0])
+            self.record(name, category, start, time.time())
+        observerTags.append(command.AddObserver(command.CommandCompletedEvent, onCompleted))
+
+    def exportChromeTrace(self, path):
+        processId = os.getpid()
+        events = []
+        for i in xrange(self.numberOfSpans):
+            name, category = self.keys[self.keyIds[i]]
+            events.append({"name": name, "cat": category, "ph": "X", "pid": processId, "tid": int(self.threadIds[i]),
+                           "ts": (self.starts[i] - self.origin) * 1e6, "dur": self.durations[i] * 1e6})
+        with open(path, "w") as traceFile:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, traceFile)
+        return len(events)
+
+spanTracer = SpanTracer()
+
+def traced(name, category="logic"):
+    """Decorator recording every call of the function as a span of spanTracer.
+  Disabled tracing costs one attribute check per call. Not for methods
+  connected to Qt signals, PythonQt would pass the signal arguments to the
+  wrapper's *args.
+  """
+    def decorate(function):
+        @functools.wraps(function)
+        def tracedFunction(*args, **kwargs):
+            if not spanTracer.enabled:
+                return function(*args, **kwargs)
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                spanTracer.record(name, category, start, time.time())
+        return tracedFunction
+    return decorate
+
+classifySpectra = traced("classify spectra", "classification")(SpectrumAnalysis.classifySpectra)
 
 
 #
@@ -84,6 +199,38 @@ class PrinterInteractorWidget(ScriptedLoadableModuleWidget):
         self.layout.addWidget(ImageRegistrationCollapsibleButton)
         ImageRegistrationFormLayout = qt.QFormLayout(ImageRegistrationCollapsibleButton)
         #
+        # Spectrum Preprocessing Area
+        #
+        PreprocessingCollapsibleButton = ctk.ctkCollapsibleButton()
+        PreprocessingCollapsibleButton.text = " Spectrum Preprocessing"
+        PreprocessingCollapsibleButton.collapsed = True
+        self.layout.addWidget(PreprocessingCollapsibleButton)
+        PreprocessingFormLayout = qt.QFormLayout(PreprocessingCollapsibleButton)
+        #
+        # Multiple Printers Area
+        #
+        MultiPrinterCollapsibleButton = ctk.ctkCollapsibleButton()
+        MultiPrinterCollapsibleButton.text = " Multiple Printers"
+        MultiPrinterCollapsibleButton.collapsed = True
+        self.layout.addWidget(MultiPrinterCollapsibleButton)
+        MultiPrinterFormLayout = qt.QFormLayout(MultiPrinterCollapsibleButton)
+        #
+        # Spectral Library Area
+        #
+        LibraryCollapsibleButton = ctk.ctkCollapsibleButton()
+        LibraryCollapsibleButton.text = " Spectral Library"
+        LibraryCollapsibleButton.collapsed = True
+        self.layout.addWidget(LibraryCollapsibleButton)
+        LibraryFormLayout = qt.QFormLayout(LibraryCollapsibleButton)
+        #
+        # Profiling Area
+        #
+        ProfilingCollapsibleButton = ctk.ctkCollapsibleButton()
+        ProfilingCollapsibleButton.text = " Profiling"
+        ProfilingCollapsibleButton.collapsed = True
+        self.layout.addWidget(ProfilingCollapsibleButton)
+        ProfilingFormLayout = qt.QFormLayout(ProfilingCollapsibleButton)
+        #
         # Wavelength Selector
         #
         self.probeSelector = qt.QComboBox()
@@ -91,6 +238,15 @@ class PrinterInteractorWidget(ScriptedLoadableModuleWidget):
         #self.probeSelector.insertItem(2, "UV: 395 nm ")
         PrinterControlFormLayout.addRow("Laser Wavelength :", self.probeSelector)
         #
+        # Reference Label
+        #
+        self.referenceLabelSelector = qt.QComboBox()
+        self.referenceLabelSelector.setEditable(True)
+        self.referenceLabelSelector.addItems(["tumor", "healthy"])
+        self.referenceLabelSelector.setToolTip("Tissue class of the learned spectrum. Learning more than one class"
+                                               " switches classification to the nearest library reference.")
+        PrinterControlFormLayout.addRow("Reference label :", self.referenceLabelSelector)
+        #
         # Learn Spectra Button
         #
         self.learnSpectraButton = qt.QPushButton("Learn Spectra")
@@ -99,6 +255,28 @@ class PrinterInteractorWidget(ScriptedLoadableModuleWidget):
         PrinterControlFormLayout.addRow(self.learnSpectraButton)
         self.learnSpectraButton.connect('clicked(bool)', self.onLearnSpectraButton)
         #
+        # Learn Region
+        #
+        self.learnRegionSelector = qt.QComboBox()
+        self.learnRegionSelector.addItems(["Patch around probe", "BoundaryPoints ROI"])
+        self.learnRegionSelector.setToolTip("Region scanned to learn an averaged reference spectrum.")
+        PrinterControlFormLayout.addRow("Reference region :", self.learnRegionSelector)
+        self.learnPatchSize_spinbox = qt.QDoubleSpinBox()
+        self.learnPatchSize_spinbox.setMinimum(0)
+        self.learnPatchSize_spinbox.setMaximum(20)
+        self.learnPatchSize_spinbox.setValue(4)
+        PrinterControlFormLayout.addRow("Reference patch size (mm) :", self.learnPatchSize_spinbox)
+        self.learnSpacing_spinbox = qt.QDoubleSpinBox()
+        self.learnSpacing_spinbox.setMinimum(0.1)
+        self.learnSpacing_spinbox.setMaximum(10)
+        self.learnSpacing_spinbox.setValue(1)
+        PrinterControlFormLayout.addRow("Reference point spacing (mm) :", self.learnSpacing_spinbox)
+        self.learnRegionButton = qt.QPushButton("Learn Region")
+        self.learnRegionButton.toolTip = "Scan the reference region, reject outlier frames and store the mean and covariance."
+        self.learnRegionButton.enabled = True
+        PrinterControlFormLayout.addRow(self.learnRegionButton)
+        self.learnRegionButton.connect('clicked(bool)', self.onLearnRegionButton)
+        #
         # Home Button
         #
         self.homeButton = qt.QPushButton("Home")
@@ -107,6 +285,19 @@ class PrinterInteractorWidget(ScriptedLoadableModuleWidget):
         PrinterControlFormLayout.addRow(self.homeButton)
         self.homeButton.connect('clicked(bool)', self.onHomeButton)
         #
+        # Scan Session Buttons
+        #
+        self.newSessionButton = qt.QPushButton("New Scan Session")
+        self.newSessionButton.toolTip = "Clear the collected points, boundaries and tracing state of the previous scan."
+        self.newSessionButton.connect('clicked(bool)', self.onNewSessionButton)
+        self.exportPointsButton = qt.QPushButton("Export Scan Points")
+        self.exportPointsButton.toolTip = "Save x, y, z, time, label and score of every classified point as CSV."
+        self.exportPointsButton.connect('clicked(bool)', self.onExportPointsButton)
+        sessionButtonsLayout = qt.QHBoxLayout()
+        sessionButtonsLayout.addWidget(self.newSessionButton)
+        sessionButtonsLayout.addWidget(self.exportPointsButton)
+        PrinterControlFormLayout.addRow(sessionButtonsLayout)
+        #
         # Keyboard ShortCut Button
         #
         self.shortcutButton = qt.QPushButton("Activate Keyboard Shortcuts")
@@ -142,6 +333,31 @@ class PrinterInteractorWidget(ScriptedLoadableModuleWidget):
         self.outputArraySelector.setToolTip("Pick the output array for spectrum analysis.")
         PrinterControlFormLayout.addRow("Output spectrum array: ", self.outputArraySelector)
         #
+        # Spectrum Image Selector
+        #
+        self.spectrumImageSelector = slicer.qMRMLNodeComboBox()
+        self.spectrumImageSelector.nodeTypes = ["vtkMRMLScalarVolumeNode"]
+        self.spectrumImageSelector.selectNodeUponCreation = False
+        self.spectrumImageSelector.addEnabled = False
+        self.spectrumImageSelector.removeEnabled = False
+        self.spectrumImageSelector.noneEnabled = True
+        self.spectrumImageSelector.showHidden = False
+        self.spectrumImageSelector.showChildNodeTypes = False
+        self.spectrumImageSelector.setMRMLScene(slicer.mrmlScene)
+        self.spectrumImageSelector.setToolTip("Spectrometer image streamed over OpenIGTLink (2 rows: wavelength, intensity).")
+        PrinterControlFormLayout.addRow("Spectrum image: ", self.spectrumImageSelector)
+        self.spectrumImageSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.onSpectrumImageSelectorChanged)
+        #
+        # Chart Update Rate
+        #
+        self.chartRate_spinbox = qt.QDoubleSpinBox()
+        self.chartRate_spinbox.setMinimum(0.5)
+        self.chartRate_spinbox.setMaximum(60)
+        self.chartRate_spinbox.setValue(15)
+        self.chartRate_spinbox.setToolTip("Spectrum chart refresh limit. Every frame is still used for classification.")
+        PrinterControlFormLayout.addRow("Chart update rate (Hz) :", self.chartRate_spinbox)
+        self.chartRate_spinbox.connect('valueChanged(double)', self.onChartRateChanged)
+        #
         # X Resolution
         #
         self.xResolution_spinbox = qt.QDoubleSpinBox()
@@ -181,6 +397,99 @@ class PrinterInteractorWidget(ScriptedLoadableModuleWidget):
         PrinterControlFormLayout.addRow("Fiducial Marking Off:", self.fiducialMarkerCheckBox)
         self.fiducialMarkerCheckBox.connect('stateChanged(int)', self.onFiducialMarkerChecked)
         #
+        # Scan Point Model on/ off
+        #
+        self.scanPointModelCheckBox = qt.QCheckBox()
+        self.scanPointModelCheckBox.checked = 0
+        self.scanPointModelCheckBox.setToolTip("Show classified points as one point cloud model (coloured by label)"
+                                               " instead of fiducials, for dense scans.")
+        PrinterControlFormLayout.addRow("Point cloud display:", self.scanPointModelCheckBox)
+        self.scanPointGlyphCheckBox = qt.QCheckBox()
+        self.scanPointGlyphCheckBox.checked = 0
+        self.scanPointGlyphCheckBox.setToolTip("Draw spheres instead of vertices, also visible in the slice views.")
+        PrinterControlFormLayout.addRow("Point cloud glyphs:", self.scanPointGlyphCheckBox)
+        self.scanPointDecimation_spinbox = qt.QSpinBox()
+        self.scanPointDecimation_spinbox.setMinimum(1)
+        self.scanPointDecimation_spinbox.setMaximum(100)
+        self.scanPointDecimation_spinbox.setValue(1)
+        self.scanPointDecimation_spinbox.setToolTip("Display every n-th point, all points are kept for export.")
+        PrinterControlFormLayout.addRow("Point cloud decimation :", self.scanPointDecimation_spinbox)
+        self.scanPointModelCheckBox.connect('toggled(bool)', self.onScanPointDisplayChanged)
+        self.scanPointGlyphCheckBox.connect('toggled(bool)', self.onScanPointDisplayChanged)
+        self.scanPointDecimation_spinbox.connect('valueChanged(int)', self.onScanPointDisplayChanged)
+        #
+        # Adaptive Averaging on/ off
+        #
+        self.adaptiveAveragingCheckBox = qt.QCheckBox()
+        self.adaptiveAveragingCheckBox.checked = 0
+        self.adaptiveAveragingCheckBox.setToolTip("Average frames at each stop until the tissue label is confident.")
+        PrinterControlFormLayout.addRow("Adaptive averaging:", self.adaptiveAveragingCheckBox)
+        #
+        # Signal Quality Check on/ off
+        #
+        self.qualityCheckBox = qt.QCheckBox()
+        self.qualityCheckBox.checked = 0
+        self.qualityCheckBox.setToolTip("Do not label spectra with a low SNR or saturated detector, revisit their stops"
+                                        " at the end of the scan.")
+        PrinterControlFormLayout.addRow("Signal quality check:", self.qualityCheckBox)
+        self.qualityCheckBox.connect('toggled(bool)', self.onSignalQualityChanged)
+        self.minimumSnr_spinbox = qt.QDoubleSpinBox()
+        self.minimumSnr_spinbox.setMinimum(0)
+        self.minimumSnr_spinbox.setMaximum(1000)
+        self.minimumSnr_spinbox.setValue(10)
+        PrinterControlFormLayout.addRow("Minimum SNR :", self.minimumSnr_spinbox)
+        self.minimumSnr_spinbox.connect('valueChanged(double)', self.onSignalQualityChanged)
+        self.revisitButton = qt.QPushButton("Revisit Low Quality Stops")
+        self.revisitButton.toolTip = "Step scan the queued low signal quality stops in travel-optimal order."
+        PrinterControlFormLayout.addRow(self.revisitButton)
+        self.revisitButton.connect('clicked(bool)', self.onRevisitButton)
+        #
+        # Maximum Dwell per Stop
+        #
+        self.maxDwell_spinbox = qt.QSpinBox()
+        self.maxDwell_spinbox.setMinimum(0)
+        self.maxDwell_spinbox.setMaximum(5000)
+        self.maxDwell_spinbox.setValue(1000)
+        PrinterControlFormLayout.addRow("Maximum dwell per stop (ms) :", self.maxDwell_spinbox)
+        #
+        # Motion Synchronized Stepping on/ off
+        #
+        self.motionSyncCheckBox = qt.QCheckBox()
+        self.motionSyncCheckBox.checked = 0
+        self.motionSyncCheckBox.setToolTip("Wait for each move to finish (M400) before acquiring, then move on"
+                                           " as soon as the stop is labelled.")
+        PrinterControlFormLayout.addRow("Motion synchronized stepping:", self.motionSyncCheckBox)
+        #
+        # G-code Program Streaming on/ off
+        #
+        self.streamProgramCheckBox = qt.QCheckBox()
+        self.streamProgramCheckBox.checked = 0
+        self.streamProgramCheckBox.setToolTip("Compile the scan into a G-code program and stream it with line numbers"
+                                              " and checksums, keeping the printer's planner buffer full.")
+        PrinterControlFormLayout.addRow("Stream G-code program:", self.streamProgramCheckBox)
+        #
+        # Pipelined Stepping on/ off
+        #
+        self.pipelineCheckBox = qt.QCheckBox()
+        self.pipelineCheckBox.checked = 0
+        self.pipelineCheckBox.setToolTip("Move on as soon as the spectrum at a stop is captured, classification,"
+                                         " marking and recording run in the background.")
+        PrinterControlFormLayout.addRow("Pipelined stepping:", self.pipelineCheckBox)
+        self.pipelineRecordingPathLineEdit = ctk.ctkPathLineEdit()
+        self.pipelineRecordingPathLineEdit.filters = ctk.ctkPathLineEdit.Dirs
+        self.pipelineRecordingPathLineEdit.settingKey = "PrinterInteractorRecordingPath"
+        self.pipelineRecordingPathLineEdit.setToolTip("Optional directory the pipelined scan is recorded to.")
+        PrinterControlFormLayout.addRow("Scan recording directory:", self.pipelineRecordingPathLineEdit)
+        #
+        # Reuse Classified Positions on/ off
+        #
+        self.reuseClassificationsCheckBox = qt.QCheckBox()
+        self.reuseClassificationsCheckBox.checked = 0
+        self.reuseClassificationsCheckBox.setToolTip("Skip stops and tracing probes within 0.5 mm of a position"
+                                                     " classified in the last 10 minutes.")
+        PrinterControlFormLayout.addRow("Reuse classified positions:", self.reuseClassificationsCheckBox)
+        self.reuseClassificationsCheckBox.connect('toggled(bool)', self.onReuseClassificationsToggled)
+        #
         # Z Movement
         #
         self.verticalControlButton = qt.QPushButton("Vertical Control")
@@ -198,7 +507,30 @@ class PrinterInteractorWidget(ScriptedLoadableModuleWidget):
         self.scanButton.connect('clicked(bool)', self.onScanButton)
         self.scanButton.setStyleSheet("background-color: green; font: bold")
         #
-        # Surface Scan Button
+        # Pattern File and Transform
+        #
+        self.patternPathLineEdit = ctk.ctkPathLineEdit()
+        self.patternPathLineEdit.filters = ctk.ctkPathLineEdit.Files
+        self.patternPathLineEdit.nameFilters = ["Patterns (*.npy *.csv *.txt *.fcsv *.json)"]
+        self.patternPathLineEdit.settingKey = "PrinterInteractorPatternPath"
+        self.patternPathLineEdit.setToolTip("Points to visit with Follow Pattern.")
+        PrinterControlFormLayout.addRow("Pattern file:", self.patternPathLineEdit)
+        self.patternTransformSelector = slicer.qMRMLNodeComboBox()
+        self.patternTransformSelector.nodeTypes = ["vtkMRMLLinearTransformNode"]
+        self.patternTransformSelector.selectNodeUponCreation = False
+        self.patternTransformSelector.addEnabled = False
+        self.patternTransformSelector.removeEnabled = False
+        self.patternTransformSelector.noneEnabled = True
+        self.patternTransformSelector.showHidden = False
+        self.patternTransformSelector.setMRMLScene(slicer.mrmlScene)
+        self.patternTransformSelector.setToolTip("Transform applied to the pattern, e.g. ReferenceImageToOpticalModel.")
+        PrinterControlFormLayout.addRow("Pattern transform:", self.patternTransformSelector)
+        self.optimizePathCheckBox = qt.QCheckBox()
+        self.optimizePathCheckBox.checked = 0
+        self.optimizePathCheckBox.setToolTip("Reorder the pattern points to minimize stage travel.")
+        PrinterControlFormLayout.addRow("Optimize visiting order:", self.optimizePathCheckBox)
+        #
+        # Follow Pattern Button
         #
         self.patternButton = qt.QPushButton("Follow Pattern")
         self.patternButton.toolTip = "Begin systematic surface scan"
@@ -216,6 +548,17 @@ class PrinterInteractorWidget(ScriptedLoadableModuleWidget):
         self.stopButton.connect('clicked(bool)', self.onStopButton)
         self.stopButton.setStyleSheet("background-color: red; font: bold")
         #
+        # Scan Progress
+        #
+        self.scanProgressBar = qt.QProgressBar()
+        self.scanProgressBar.setMinimum(0)
+        self.scanProgressBar.setMaximum(100)
+        self.scanProgressBar.setValue(0)
+        PrinterControlFormLayout.addRow("Scan progress:", self.scanProgressBar)
+        self.scanProgressLabel = qt.QLabel("No scan running.")
+        PrinterControlFormLayout.addRow(self.scanProgressLabel)
+        self.logic.scanProgress.addObserver(self.onScanProgress)
+        #
         # Place boundary point
         #
         self.placeBoundaryButton = qt.QPushButton("Place Boundary Fiducial")
@@ -232,6 +575,54 @@ class PrinterInteractorWidget(ScriptedLoadableModuleWidget):
         ROIFormLayout.addRow(self.ROIsearchButton)
         self.ROIsearchButton.connect('clicked(bool)', self.ROIsearch)
         #
+        # Kinematic Timing on/ off
+        #
+        self.kinematicTimingCheckBox = qt.QCheckBox()
+        self.kinematicTimingCheckBox.checked = 0
+        self.kinematicTimingCheckBox.setToolTip("Time rectilinear scans from the printer kinematics instead of a fixed"
+                                                " delay per move. The data delay is used as dwell at each stop.")
+        ROIFormLayout.addRow("Kinematic timing:", self.kinematicTimingCheckBox)
+        #
+        # Printer Kinematics
+        #
+        self.maxFeedRate_spinbox = qt.QDoubleSpinBox()
+        self.maxFeedRate_spinbox.setMinimum(1)
+        self.maxFeedRate_spinbox.setMaximum(500)
+        self.maxFeedRate_spinbox.setValue(50)
+        ROIFormLayout.addRow("Max feed rate (mm/s):", self.maxFeedRate_spinbox)
+        self.acceleration_spinbox = qt.QDoubleSpinBox()
+        self.acceleration_spinbox.setMinimum(1)
+        self.acceleration_spinbox.setMaximum(10000)
+        self.acceleration_spinbox.setValue(500)
+        ROIFormLayout.addRow("Acceleration (mm/s^2):", self.acceleration_spinbox)
+        self.jerk_spinbox = qt.QDoubleSpinBox()
+        self.jerk_spinbox.setMinimum(0)
+        self.jerk_spinbox.setMaximum(100)
+        self.jerk_spinbox.setValue(10)
+        ROIFormLayout.addRow("Jerk (mm/s):", self.jerk_spinbox)
+        #
+        # Time Budget Planner
+        #
+        self.timeBudget_spinbox = qt.QDoubleSpinBox()
+        self.timeBudget_spinbox.setMinimum(0.1)
+        self.timeBudget_spinbox.setMaximum(600)
+        self.timeBudget_spinbox.setValue(10)
+        self.timeBudget_spinbox.setToolTip("Time the ROI scan may take.")
+        ROIFormLayout.addRow("Time budget (min):", self.timeBudget_spinbox)
+        self.planScanButton = qt.QPushButton("Plan ROI Scan")
+        self.planScanButton.toolTip = "Choose the finest resolution that scans the ROI within the time budget."
+        self.planScanButton.enabled = True
+        ROIFormLayout.addRow(self.planScanButton)
+        self.planScanButton.connect('clicked(bool)', self.onPlanScanButton)
+        self.planLabel = qt.QLabel("")
+        ROIFormLayout.addRow("Planned scan:", self.planLabel)
+        self.startPlannedScanButton = qt.QPushButton("Start Planned Scan")
+        self.startPlannedScanButton.toolTip = "Run the planned scan as a step scan (pipelined if it was planned pipelined)."
+        self.startPlannedScanButton.enabled = False
+        ROIFormLayout.addRow(self.startPlannedScanButton)
+        self.startPlannedScanButton.connect('clicked(bool)', self.onStartPlannedScanButton)
+        self.plannedScan = None  # (waypoints, pipelined) of the last plan
+        #
         # ROI Raster Search
         #
         self.ROIrasterButton = qt.QPushButton("ROI Raster Scan")
@@ -240,6 +631,23 @@ class PrinterInteractorWidget(ScriptedLoadableModuleWidget):
         ROIFormLayout.addRow(self.ROIrasterButton)
         self.ROIrasterButton.connect('clicked(bool)', self.ROIrastersearch)
         #
+        # Fly Scan Feed Rate
+        #
+        self.flyScanFeedRate_spinbox = qt.QSpinBox()
+        self.flyScanFeedRate_spinbox.setMinimum(10)
+        self.flyScanFeedRate_spinbox.setMaximum(6000)
+        self.flyScanFeedRate_spinbox.setValue(300)
+        self.flyScanFeedRate_spinbox.setToolTip("Constant feed rate of the stage while sweeping a row.")
+        ROIFormLayout.addRow("Fly scan feed rate (mm/min):", self.flyScanFeedRate_spinbox)
+        #
+        # ROI Fly Scan
+        #
+        self.ROIflyScanButton = qt.QPushButton("ROI Fly Scan")
+        self.ROIflyScanButton.toolTip = "Sweep each row at constant speed and locate every spectrum along the row."
+        self.ROIflyScanButton.enabled = True
+        ROIFormLayout.addRow(self.ROIflyScanButton)
+        self.ROIflyScanButton.connect('clicked(bool)', self.ROIflyScan)
+        #
         # Edge Tracing Button
         #
         self.ConvexHullTraceButton = qt.QPushButton("Trace Contour (after systematic scan)")
@@ -294,11 +702,208 @@ class PrinterInteractorWidget(ScriptedLoadableModuleWidget):
         self.landmarkRegButton.enabled = True
         ImageRegistrationFormLayout.addRow(self.landmarkRegButton)
         self.landmarkRegButton.connect('clicked(bool)', self.onLandmarkRegButton)
+        #
+        # ICP registration Button
+        #
+        self.ICPRegButton = qt.QPushButton("ICP Registration")
+        self.ICPRegButton.toolTip = "Register image to optical landmarks or point clouds without correspondences."
+        self.ICPRegButton.enabled = True
+        ImageRegistrationFormLayout.addRow(self.ICPRegButton)
+        self.ICPRegButton.connect('clicked(bool)', self.onICPRegButton)
+        #
+        # Registration Error
+        #
+        self.registrationErrorLabel = qt.QLabel("")
+        ImageRegistrationFormLayout.addRow("Registration error:", self.registrationErrorLabel)
+        #
+        # Dark Frame Button
+        #
+        self.darkFrameButton = qt.QPushButton("Collect Dark Frame")
+        self.darkFrameButton.toolTip = "Collect a spectrum with the light source off, it is subtracted from every spectrum."
+        self.darkFrameButton.enabled = True
+        PreprocessingFormLayout.addRow(self.darkFrameButton)
+        self.darkFrameButton.connect('clicked(bool)', self.onDarkFrameButton)
+        #
+        # Baseline Removal
+        #
+        self.baselineOrder_spinbox = qt.QSpinBox()
+        self.baselineOrder_spinbox.setMinimum(-1)
+        self.baselineOrder_spinbox.setMaximum(8)
+        self.baselineOrder_spinbox.setValue(-1)
+        self.baselineOrder_spinbox.setSpecialValueText("Off")
+        self.baselineOrder_spinbox.setToolTip("Order of the polynomial baseline removed from each spectrum.")
+        PreprocessingFormLayout.addRow("Baseline polynomial order:", self.baselineOrder_spinbox)
+        self.baselineOrder_spinbox.connect('valueChanged(int)', self.onPreprocessingChanged)
+        #
+        # Savitzky-Golay Smoothing
+        #
+        self.smoothingWindow_spinbox = qt.QSpinBox()
+        self.smoothingWindow_spinbox.setMinimum(0)
+        self.smoothingWindow_spinbox.setMaximum(51)
+        self.smoothingWindow_spinbox.setSingleStep(2)
+        self.smoothingWindow_spinbox.setValue(0)
+        self.smoothingWindow_spinbox.setSpecialValueText("Off")
+        self.smoothingWindow_spinbox.setToolTip("Savitzky-Golay window length (odd number of points, quadratic fit).")
+        PreprocessingFormLayout.addRow("Smoothing window (points):", self.smoothingWindow_spinbox)
+        self.smoothingWindow_spinbox.connect('valueChanged(int)', self.onPreprocessingChanged)
+        #
+        # Normalization
+        #
+        self.normalizationSelector = qt.QComboBox()
+        self.normalizationSelector.addItems(["none", "area", "peak"])
+        self.normalizationSelector.setToolTip("Scale each spectrum to unit area or unit peak. The comparison threshold"
+                                              " must be adjusted when normalization is used.")
+        PreprocessingFormLayout.addRow("Normalization:", self.normalizationSelector)
+        self.normalizationSelector.connect('currentIndexChanged(int)', self.onPreprocessingChanged)
+        #
+        # Library Distance Metric
+        #
+        self.libraryMetricSelector = qt.QComboBox()
+        self.libraryMetricSelector.addItems(["euclidean", "cosine", "mahalanobis"])
+        self.libraryMetricSelector.setToolTip("Distance used to find the nearest reference spectrum. Mahalanobis uses"
+                                              " the covariance of region-learned references.")
+        LibraryFormLayout.addRow("Distance metric:", self.libraryMetricSelector)
+        self.libraryMetricSelector.connect('currentIndexChanged(int)', self.onLibrarySettingsChanged)
+        #
+        # Library PCA Components
+        #
+        self.libraryComponents_spinbox = qt.QSpinBox()
+        self.libraryComponents_spinbox.setMinimum(0)
+        self.libraryComponents_spinbox.setMaximum(50)
+        self.libraryComponents_spinbox.setValue(0)
+        self.libraryComponents_spinbox.setSpecialValueText("Off")
+        self.libraryComponents_spinbox.setToolTip("Compare spectra in the space of the first principal components of the library.")
+        LibraryFormLayout.addRow("PCA components:", self.libraryComponents_spinbox)
+        self.libraryComponents_spinbox.connect('valueChanged(int)', self.onLibrarySettingsChanged)
+        #
+        # Library Save / Load / Clear
+        #
+        self.saveLibraryButton = qt.QPushButton("Save Library")
+        self.saveLibraryButton.connect('clicked(bool)', self.onSaveLibraryButton)
+        self.loadLibraryButton = qt.QPushButton("Load Library")
+        self.loadLibraryButton.connect('clicked(bool)', self.onLoadLibraryButton)
+        self.clearLibraryButton = qt.QPushButton("Clear Library")
+        self.clearLibraryButton.connect('clicked(bool)', self.onClearLibraryButton)
+        libraryButtonsLayout = qt.QHBoxLayout()
+        libraryButtonsLayout.addWidget(self.saveLibraryButton)
+        libraryButtonsLayout.addWidget(self.loadLibraryButton)
+        libraryButtonsLayout.addWidget(self.clearLibraryButton)
+        LibraryFormLayout.addRow(libraryButtonsLayout)
+        self.libraryLabel = qt.QLabel("Empty")
+        LibraryFormLayout.addRow("References:", self.libraryLabel)
+        #
+        # Recording Export
+        #
+        self.exportLabelSelector = qt.QComboBox()
+        self.exportLabelSelector.addItems(["unlabelled", "healthy", "tumor"])
+        self.exportLabelSelector.setToolTip("Ground truth label written for every exported spectrum.")
+        LibraryFormLayout.addRow("Recording label:", self.exportLabelSelector)
+        self.exportRecordingButton = qt.QPushButton("Export Recent Spectra")
+        self.exportRecordingButton.toolTip = "Save the spectrum history as a recording for offline calibration."
+        LibraryFormLayout.addRow(self.exportRecordingButton)
+        self.exportRecordingButton.connect('clicked(bool)', self.onExportRecordingButton)
+        #
+        # Threshold Calibration
+        #
+        self.calibrateButton = qt.QPushButton("Calibrate Threshold")
+        self.calibrateButton.toolTip = "Choose the statistic and threshold from labelled recordings (ROC operating point)."
+        LibraryFormLayout.addRow(self.calibrateButton)
+        self.calibrateButton.connect('clicked(bool)', self.onCalibrateButton)
+        self.calibrationLabel = qt.QLabel("difference < 10")
+        LibraryFormLayout.addRow("Threshold:", self.calibrationLabel)
+        #
+        # Batch Re-analysis
+        #
+        self.reanalyzeButton = qt.QPushButton("Re-analyse Recordings")
+        self.reanalyzeButton.toolTip = "Re-label a directory of recordings with the current classifier on all CPU cores."
+        LibraryFormLayout.addRow(self.reanalyzeButton)
+        self.reanalyzeButton.connect('clicked(bool)', self.onReanalyzeButton)
+        #
+        # Printer Device Connector
+        #
+        self.deviceConnectorSelector = slicer.qMRMLNodeComboBox()
+        self.deviceConnectorSelector.nodeTypes = ["vtkMRMLIGTLConnectorNode"]
+        self.deviceConnectorSelector.selectNodeUponCreation = False
+        self.deviceConnectorSelector.addEnabled = False
+        self.deviceConnectorSelector.removeEnabled = False
+        self.deviceConnectorSelector.noneEnabled = True
+        self.deviceConnectorSelector.showHidden = False
+        self.deviceConnectorSelector.showChildNodeTypes = False
+        self.deviceConnectorSelector.setMRMLScene(slicer.mrmlScene)
+        self.deviceConnectorSelector.setToolTip("OpenIGTLink connector of the printer to add.")
+        MultiPrinterFormLayout.addRow("Connector:", self.deviceConnectorSelector)
+        self.deviceIdLineEdit = qt.QLineEdit("SerialDevice")
+        self.deviceIdLineEdit.setToolTip("Device ID the connector's server forwards the printer commands to.")
+        MultiPrinterFormLayout.addRow("Device ID:", self.deviceIdLineEdit)
+        self.deviceArraySelector = slicer.qMRMLNodeComboBox()
+        self.deviceArraySelector.nodeTypes = ["vtkMRMLDoubleArrayNode"]
+        self.deviceArraySelector.selectNodeUponCreation = False
+        self.deviceArraySelector.addEnabled = False
+        self.deviceArraySelector.removeEnabled = False
+        self.deviceArraySelector.noneEnabled = True
+        self.deviceArraySelector.showHidden = False
+        self.deviceArraySelector.showChildNodeTypes = False
+        self.deviceArraySelector.setMRMLScene(slicer.mrmlScene)
+        self.deviceArraySelector.setToolTip("Spectrum array of the probe mounted on this printer.")
+        MultiPrinterFormLayout.addRow("Spectrum array:", self.deviceArraySelector)
+        self.addDeviceButton = qt.QPushButton("Add Printer")
+        self.addDeviceButton.connect('clicked(bool)', self.onAddDeviceButton)
+        self.removeDevicesButton = qt.QPushButton("Remove All")
+        self.removeDevicesButton.connect('clicked(bool)', self.onRemoveDevicesButton)
+        deviceButtonsLayout = qt.QHBoxLayout()
+        deviceButtonsLayout.addWidget(self.addDeviceButton)
+        deviceButtonsLayout.addWidget(self.removeDevicesButton)
+        MultiPrinterFormLayout.addRow(deviceButtonsLayout)
+        self.devicesLabel = qt.QLabel("None")
+        MultiPrinterFormLayout.addRow("Printers:", self.devicesLabel)
+        #
+        # Multiple Printer Scan
+        #
+        self.multiPrinterModeSelector = qt.QComboBox()
+        self.multiPrinterModeSelector.addItems(["Split ROI between printers", "Same ROI on every printer"])
+        MultiPrinterFormLayout.addRow("Mode:", self.multiPrinterModeSelector)
+        self.multiPrinterScanButton = qt.QPushButton("Multi-printer ROI Scan")
+        self.multiPrinterScanButton.toolTip = "Scan the BoundaryPoints ROI with every added printer at the same time."
+        MultiPrinterFormLayout.addRow(self.multiPrinterScanButton)
+        self.multiPrinterScanButton.connect('clicked(bool)', self.onMultiPrinterScanButton)
+        #
+        # Span Tracing
+        #
+        self.tracingCheckBox = qt.QCheckBox()
+        self.tracingCheckBox.checked = 0
+        self.tracingCheckBox.setToolTip("Record how long planning, printer commands, acquisition, classification"
+                                        " and marking take. Checking clears the previous recording.")
+        ProfilingFormLayout.addRow("Record spans:", self.tracingCheckBox)
+        self.tracingCheckBox.connect('toggled(bool)', self.onTracingToggled)
+        self.exportTraceButton = qt.QPushButton("Export Trace")
+        self.exportTraceButton.toolTip = "Save the recorded spans as a Chrome trace (open in chrome://tracing or Perfetto)."
+        ProfilingFormLayout.addRow(self.exportTraceButton)
+        self.exportTraceButton.connect('clicked(bool)', self.onExportTraceButton)
 
         self.layout.addStretch(1)
 
     def cleanup(self):
-        pass
+        self.logic.scanProgress.removeObserver(self.onScanProgress)
+        self.logic.removeObservers()
+
+    def onSpectrumImageSelectorChanged(self):
+        self.logic.setSpectrumImageNode(self.spectrumImageSelector.currentNode(), self.outputArraySelector.currentNode())
+
+    def onChartRateChanged(self):
+        self.logic.chartMaximumRateHz = self.chartRate_spinbox.value
+
+    def onScanProgress(self, progress):
+        self.scanProgressBar.setValue(int(100 * progress.fractionComplete()))
+        text = "{0} / {1} stops, {2:.0f} s remaining".format(progress.completedStops, progress.plannedStops,
+                                                            progress.remainingTimeMs() / 1000.0)
+        if 0 < progress.nominalStopCostMs < progress.scheduleLagMs():
+            text = text + ", {0:.0f} ms behind schedule".format(progress.scheduleLagMs())
+        if self.logic.droppedMoveCount > 0:
+            text = text + ", {0} moves sent ({1} redundant dropped)".format(self.logic.sentMoveCount,
+                                                                          self.logic.droppedMoveCount)
+        if progress.lastDriftMm > self.logic.driftToleranceMm:
+            text = text + ", drift {0:.1f} mm".format(progress.lastDriftMm)
+        self.scanProgressLabel.setText(text)
 
     def onSerialIGLTSelectorChanged(self):
         self.logic.setSerialIGTLNode(serialIGTLNode=self.inputSelector.currentNode())
@@ -311,7 +916,127 @@ class PrinterInteractorWidget(ScriptedLoadableModuleWidget):
     def onLearnSpectraButton(self):
         self.ondoubleArrayNodeChanged()
         self.onSerialIGLTSelectorChanged()
-        self.logic.getSpectralData(self.outputArraySelector.currentNode())
+        self.logic.getSpectralData(self.outputArraySelector.currentNode(), self.referenceLabelSelector.currentText)
+        self.updateLibraryLabel()
+
+    def onLearnRegionButton(self):
+        self.ondoubleArrayNodeChanged()
+        self.onSerialIGLTSelectorChanged()
+        spacing = self.learnSpacing_spinbox.value
+        if self.learnRegionSelector.currentIndex == 0:
+            waypoints = self.logic.patchWaypoints(self.learnPatchSize_spinbox.value, spacing)
+        else:
+            bounds = self.logic.ROIBoundarySearch()
+            if bounds == False:
+                return
+            xMin, xMax, yMin, yMax = bounds
+            waypoints = self.logic.rasterWaypoints(xMin, xMax, yMin, yMax, spacing, spacing)
+        if waypoints is None:
+            return
+        self.logic.learnReferenceRegion(self.outputArraySelector.currentNode(), waypoints,
+                                        self.referenceLabelSelector.currentText, self.maxDwell_spinbox.value)
+
+    def onExportRecordingButton(self):
+        directory = qt.QFileDialog.getExistingDirectory(None, "Export recording")
+        if directory:
+            self.logic.exportSpectrumHistory(directory, self.exportLabelSelector.currentIndex - 1)
+
+    def onCalibrateButton(self):
+        directory = qt.QFileDialog.getExistingDirectory(None, "Recordings directory")
+        if not directory:
+            return
+        result = self.logic.calibrateThreshold(directory)
+        if result:
+            self.calibrationLabel.setText("{metric} < {threshold:.4g} (AUC {auc:.3f}, TPR {tpr:.2f}, FPR {fpr:.2f})".format(**result))
+
+    def onAddDeviceButton(self):
+        connectorNode = self.deviceConnectorSelector.currentNode()
+        if not connectorNode:
+            print "Error: no connector selected."
+            return
+        device = self.logic.deviceManager.addDevice(connectorNode, self.deviceIdLineEdit.text or "SerialDevice")
+        device.outputArrayNode = self.deviceArraySelector.currentNode()
+        self.updateDevicesLabel()
+
+    def onRemoveDevicesButton(self):
+        for device in list(self.logic.deviceManager.devices):
+            self.logic.deviceManager.removeDevice(device)
+        self.updateDevicesLabel()
+
+    def updateDevicesLabel(self):
+        names = [device.name for device in self.logic.deviceManager.devices]
+        self.devicesLabel.setText(", ".join(names) if names else "None")
+
+    def onMultiPrinterScanButton(self):
+        bounds = self.logic.ROIBoundarySearch()
+        if bounds == False:
+            return
+        xMin, xMax, yMin, yMax = bounds
+        waypoints = self.logic.rasterWaypoints(xMin, xMax, yMin, yMax, self.xResolution_spinbox.value,
+                                               self.yResolution_spinbox.value)
+        self.logic.startMultiPrinterScan(waypoints, self.maxDwell_spinbox.value,
+                                         self.multiPrinterModeSelector.currentIndex == 0)
+
+    def onReanalyzeButton(self):
+        directory = qt.QFileDialog.getExistingDirectory(None, "Recordings directory")
+        if not directory:
+            return
+        outputDirectory = qt.QFileDialog.getExistingDirectory(None, "Output directory for label maps")
+        if not outputDirectory:
+            return
+        self.reanalyzeButton.enabled = False
+        self.logic.reanalyzeRecordings(directory, outputDirectory, doneCallback=self.onReanalysisDone)
+        if self.logic.batchProcess is None:
+            self.reanalyzeButton.enabled = True
+
+    def onReanalysisDone(self, summaries):
+        self.reanalyzeButton.enabled = True
+
+    def onLibrarySettingsChanged(self):
+        self.logic.spectralLibrary.metric = self.libraryMetricSelector.currentText
+        self.logic.spectralLibrary.numberOfComponents = self.libraryComponents_spinbox.value
+
+    def onSaveLibraryButton(self):
+        path = qt.QFileDialog.getSaveFileName(None, "Save spectral library", "", "NumPy archive (*.npz)")
+        if path:
+            self.logic.spectralLibrary.save(path)
+
+    def onLoadLibraryButton(self):
+        path = qt.QFileDialog.getOpenFileName(None, "Load spectral library", "", "NumPy archive (*.npz)")
+        if path:
+            self.logic.spectralLibrary.load(path)
+            self.updateLibraryLabel()
+
+    def onClearLibraryButton(self):
+        self.logic.spectralLibrary.clear()
+        self.updateLibraryLabel()
+
+    def updateLibraryLabel(self):
+        labels = self.logic.spectralLibrary.labels
+        if not labels:
+            self.libraryLabel.setText("Empty")
+            return
+        self.libraryLabel.setText(", ".join("{0} {1}".format(labels.count(label), label) for label in sorted(set(labels))))
+
+    def onDarkFrameButton(self):
+        self.logic.collectDarkFrame(self.outputArraySelector.currentNode())
+
+    def onPreprocessingChanged(self):
+        preprocessor = self.logic.spectrumPreprocessor
+        preprocessor.baselineOrder = self.baselineOrder_spinbox.value
+        smoothingWindow = self.smoothingWindow_spinbox.value
+        if smoothingWindow > 0 and smoothingWindow % 2 == 0:
+            smoothingWindow = smoothingWindow + 1
+        preprocessor.smoothingWindow = smoothingWindow
+        preprocessor.normalization = self.normalizationSelector.currentText
+
+    def onNewSessionButton(self):
+        self.logic.resetScanSession()
+
+    def onExportPointsButton(self):
+        path = qt.QFileDialog.getSaveFileName(None, "Export scan points", "", "CSV (*.csv)")
+        if path:
+            self.logic.exportScanPoints(path)
 
     def onHomeButton(self, SerialIGTLNode):
         self.onSerialIGLTSelectorChanged()
@@ -331,11 +1056,22 @@ class PrinterInteractorWidget(ScriptedLoadableModuleWidget):
         if xResolution < 2 or yResolution < 2:
             print "Error: Resolution too high. Try ROI systematic scanning."
             return
+        elif self.streamProgramCheckBox.checked:
+            self.streamScanProgram(self.logic.rasterWaypoints(0, 120, 0, 120, xResolution, yResolution))
+        elif self.pipelineCheckBox.checked:
+            self.startPipelinedScan(self.logic.rasterWaypoints(0, 120, 0, 120, xResolution, yResolution))
+        elif self.motionSyncCheckBox.checked:
+            self.startStepScan(self.logic.rasterWaypoints(0, 120, 0, 120, xResolution, yResolution))
+        elif self.kinematicTimingCheckBox.checked:
+            self.updateMoveModel()
+            self.logic.scheduleTimedScan(self.logic.rasterWaypoints(0, 120, 0, 120, xResolution, yResolution),
+                                         self.mvmtDelay, self.tissueDecision)
         else:
             self.logic.xLoop(self.mvmtDelay, xResolution, yResolution)
             self.logic.yLoop(self.mvmtDelay, yResolution, xResolution)
             stopsToVisitX = 120 / xResolution
             stopsToVisitY = 120 / yResolution
+            self.logic.startScanProgress(stopsToVisitX * stopsToVisitY, self.mvmtDelay)
         
         # Spectrum Analysis
             self.tissueAnalysisTimer = qt.QTimer()
@@ -347,17 +1083,32 @@ class PrinterInteractorWidget(ScriptedLoadableModuleWidget):
 
     def onPatternButton(self):
         self.onSerialIGLTSelectorChanged()
-        pattern = np.load("C:\Users\lconnolly\Desktop\use_this_tissue_scanning/transformed pts.npy")
-        patternTimer = qt.QTimer()
-        timevar = 0
-        for j in range(0,len(pattern)):
-            x = pattern[j][0]
-            y = pattern[j][1]
-            self.logic.xyMovement(x,y, timevar)
-            patternTimer.singleShot(timevar, lambda: self.tissueDecision())
-            timevar = timevar + 1000
+        path = self.patternPathLineEdit.currentPath
+        if not path:
+            print "Error: No pattern file selected."
+            return
+        self.patternPathLineEdit.addCurrentPathToHistory()
+        if not self.logic.hasClassifier():
+            print " Error: reference spectrum not collected."
+            return
+        try:
+            self.logic.followPattern(path, self.patternTransformSelector.currentNode(), self.acquireAtStop,
+                                     self.optimizePathCheckBox.checked)
+        except (IOError, ValueError) as error:
+            print "Error: {0}".format(error)
 
+    @traced("tissue decision", "widget")
     def tissueDecision(self):
+        self.logic.scanProgress.stopCompleted()
+
+        if self.adaptiveAveragingCheckBox.checked:
+            # never dwell longer than the timed scan leaves between two stops
+            maxDwellMs = self.maxDwell_spinbox.value
+            if hasattr(self, 'mvmtDelay'):
+                maxDwellMs = min(maxDwellMs, self.mvmtDelay)
+            self.logic.startAdaptiveAcquisition(self.outputArraySelector.currentNode(), maxDwellMs,
+                                                self.onAdaptiveDecision)
+            return
 
         # For using the thorlabs spectrometer
         #self.ondoubleArrayNodeChanged()
@@ -373,6 +1124,116 @@ class PrinterInteractorWidget(ScriptedLoadableModuleWidget):
         soln = cliNode.GetParameterValue(1,0)
         print(soln)
 
+    def onPlanScanButton(self):
+        bounds = self.logic.ROIBoundarySearch()
+        if bounds == False:
+            return
+        xMin, xMax, yMin, yMax = bounds
+        self.updateMoveModel()
+        # measured acquisition time per stop of the last synchronized scan, the maximum dwell before any was measured
+        acquisitionMs = self.logic.measuredAcquisitionMs or self.maxDwell_spinbox.value
+        pipelined = self.pipelineCheckBox.checked
+        plan = self.logic.planScanResolution(xMin, xMax, yMin, yMax, self.timeBudget_spinbox.value * 60.0, acquisitionMs,
+                                             pipelined)
+        if plan is None:
+            self.plannedScan = None
+            self.startPlannedScanButton.enabled = False
+            self.planLabel.setText("The ROI cannot be scanned within the budget.")
+            return
+        resolution, waypoints, duration = plan
+        # the prediction holds for the step scan it was made for, not for the fixed delay raster scans
+        self.plannedScan = (waypoints, pipelined)
+        self.startPlannedScanButton.enabled = True
+        self.xResolution_spinbox.setValue(resolution)
+        self.yResolution_spinbox.setValue(resolution)
+        self.planLabel.setText("{0} {1} stops at {2:.2f} mm, {3:.0f} min {4:02.0f} s ({5:.0f} ms per acquisition)".format(
+            len(waypoints), "pipelined" if pipelined else "step scan", resolution, duration // 60, duration % 60,
+            acquisitionMs))
+
+    def onStartPlannedScanButton(self):
+        if self.plannedScan is None:
+            print "Error: no scan planned."
+            return
+        self.ondoubleArrayNodeChanged()
+        self.onSerialIGLTSelectorChanged()
+        waypoints, pipelined = self.plannedScan
+        if pipelined:
+            self.startPipelinedScan(waypoints)
+        else:
+            self.startStepScan(waypoints)
+
+    def updateMoveModel(self):
+        moveModel = self.logic.moveModel
+        moveModel.maxFeedRate[:] = self.maxFeedRate_spinbox.value
+        moveModel.acceleration[:] = self.acceleration_spinbox.value
+        moveModel.jerk[:] = self.jerk_spinbox.value
+
+    @traced("acquire at stop", "widget")
+    def acquireAtStop(self, stopIndex, xcoordinate, ycoordinate):
+        # called by the step scan once the printer reports the move to this stop as finished
+        singleFrame = not self.adaptiveAveragingCheckBox.checked
+        self.logic.startAdaptiveAcquisition(self.outputArraySelector.currentNode(), self.maxDwell_spinbox.value,
+                                            self.onStepScanDecision, singleFrame)
+
+    def streamScanProgram(self, waypoints):
+        # with adaptive averaging the stream holds at each stop until it is labelled, otherwise the printer dwells (G4)
+        # for the maximum dwell while the spectrum is taken and the stream keeps going
+        dwellMs = 0
+        if not self.adaptiveAveragingCheckBox.checked:
+            dwellMs = self.maxDwell_spinbox.value
+        self.logic.streamScanProgram(waypoints, self.logic.travelFeedRate, dwellMs, self.acquireAtStop)
+
+    def onReuseClassificationsToggled(self, checked):
+        self.logic.reuseClassifications = checked
+
+    def onSignalQualityChanged(self):
+        self.logic.qualityCheck = self.qualityCheckBox.checked
+        self.logic.signalQuality.minimumSnr = self.minimumSnr_spinbox.value
+
+    def onRevisitButton(self):
+        self.onSerialIGLTSelectorChanged()
+        self.logic.revisitLowQualityStops(self.acquireAtStop)
+
+    def onTracingToggled(self, checked):
+        if checked:
+            spanTracer.start()
+        else:
+            spanTracer.stop()
+
+    def onExportTraceButton(self):
+        path = qt.QFileDialog.getSaveFileName(None, "Export trace", "", "Chrome trace (*.json)")
+        if not path:
+            return
+        numberOfSpans = spanTracer.exportChromeTrace(path)
+        if spanTracer.droppedSpans:
+            logging.warning("Trace buffer full, {0} spans were not recorded".format(spanTracer.droppedSpans))
+        print "{0} spans exported to {1}".format(numberOfSpans, path)
+
+    def onScanPointDisplayChanged(self):
+        self.logic.setScanPointDisplay(self.scanPointModelCheckBox.checked, self.scanPointGlyphCheckBox.checked,
+                                       self.scanPointDecimation_spinbox.value)
+
+    def startStepScan(self, waypoints):
+        if not self.logic.hasClassifier():
+            print " Error: reference spectrum not collected."
+            return
+        self.logic.startStepScan(waypoints, self.acquireAtStop)
+
+    def startPipelinedScan(self, waypoints):
+        recordingDirectory = self.pipelineRecordingPathLineEdit.currentPath or None
+        if recordingDirectory:
+            self.pipelineRecordingPathLineEdit.addCurrentPathToHistory()
+        self.logic.startPipelinedScan(self.outputArraySelector.currentNode(), waypoints, self.maxDwell_spinbox.value,
+                                      recordingDirectory)
+
+    def onStepScanDecision(self, healthy):
+        self.onAdaptiveDecision(healthy)
+        self.logic.acquisitionDone()
+
+    def onAdaptiveDecision(self, healthy):
+        if healthy == False:  # add a fiducial if the the tumor detecting function returns false
+            self.logic.get_coordinates()
+
     def onFiducialMarkerChecked(self):
         # Turns off fiducial Marking when checked
         self.logic.fiducialMarkerChecked()
@@ -385,6 +1246,10 @@ class PrinterInteractorWidget(ScriptedLoadableModuleWidget):
 
     def onStopButton(self):
         self.onSerialIGLTSelectorChanged()
+        self.logic.stopStepScan()
+        self.logic.stopFlyScan()
+        self.logic.stopProgramStream()
+        self.logic.deviceManager.emergencyStopAll()
         self.logic.emergencyStop()
         # Note: the stop command uses G-code command M112 which requires slicer reboot and printer reboot after each usage.
 
@@ -403,6 +1268,20 @@ class PrinterInteractorWidget(ScriptedLoadableModuleWidget):
         if self.logic.ROIBoundarySearch() == False:
             return
         xMin, xMax, yMin, yMax = self.logic.ROIBoundarySearch()
+        if self.streamProgramCheckBox.checked:
+            self.streamScanProgram(self.logic.rasterWaypoints(xMin, xMax, yMin, yMax, xResolution, yResolution))
+            return
+        if self.pipelineCheckBox.checked:
+            self.startPipelinedScan(self.logic.rasterWaypoints(xMin, xMax, yMin, yMax, xResolution, yResolution))
+            return
+        if self.motionSyncCheckBox.checked:
+            self.startStepScan(self.logic.rasterWaypoints(xMin, xMax, yMin, yMax, xResolution, yResolution))
+            return
+        if self.kinematicTimingCheckBox.checked:
+            self.updateMoveModel()
+            self.logic.scheduleTimedScan(self.logic.rasterWaypoints(xMin, xMax, yMin, yMax, xResolution, yResolution),
+                                         self.mvmtDelay, self.tissueDecision)
+            return
         self.logic.yMovement(0, yMin)
         self.logic.XMovement(0, xMin)
         self.logic.ROIsearchXLoop(self.mvmtDelay, xResolution, yResolution, xMin,xMax, yMin, yMax)
@@ -415,6 +1294,7 @@ class PrinterInteractorWidget(ScriptedLoadableModuleWidget):
 
         stopsToVisitX = (xMax - xMin) / xResolution
         stopsToVisitY = (yMax - yMin) / yResolution
+        self.logic.startScanProgress(stopsToVisitX * stopsToVisitY, self.mvmtDelay)
         for self.iterationTimingValue in self.logic.frange(0, (stopsToVisitX * stopsToVisitY * self.mvmtDelay) + 16 * self.mvmtDelay,self.mvmtDelay):
             self.tissueAnalysisTimer.singleShot(self.iterationTimingValue, lambda: self.tissueDecision())
             self.iterationTimingValue = self.iterationTimingValue + self.mvmtDelay
@@ -437,11 +1317,22 @@ class PrinterInteractorWidget(ScriptedLoadableModuleWidget):
         self.mvmtDelay = self.timeDelay_spinbox.value
         stopsToVisitX = (xMax - xMin) / xResolution
         stopsToVisitY = (yMax - yMin) / yResolution
+        self.logic.startScanProgress(stopsToVisitX * stopsToVisitY, self.mvmtDelay)
         for self.iterationTimingValue in self.logic.frange(0, (stopsToVisitX * stopsToVisitY * self.mvmtDelay) + 16 * self.mvmtDelay,self.mvmtDelay):
             self.tissueAnalysisTimer.singleShot(self.iterationTimingValue, lambda: self.tissueDecision())
 
             self.iterationTimingValue = self.iterationTimingValue + self.mvmtDelay
 
+    def ROIflyScan(self):
+        self.ondoubleArrayNodeChanged()
+        self.onSerialIGLTSelectorChanged()
+        if self.logic.ROIBoundarySearch() == False:
+            return
+        xMin, xMax, yMin, yMax = self.logic.ROIBoundarySearch()
+        self.logic.startFlyScan(self.outputArraySelector.currentNode(), xMin, xMax, yMin, yMax,
+                                self.xResolution_spinbox.value, self.yResolution_spinbox.value,
+                                self.flyScanFeedRate_spinbox.value)
+
     def onFindConvexHull(self):
         self.logic.convexHull()
 
@@ -463,7 +1354,18 @@ class PrinterInteractorWidget(ScriptedLoadableModuleWidget):
         self.logic.getLandmarkFiducialsCoordinate()
 
     def onLandmarkRegButton(self):
-        self.logic.landmarkRegistration()
+        if self.logic.landmarkRegistration() is None:
+            return
+        errors = self.logic.registrationErrors
+        self.registrationErrorLabel.setText("FRE {0:.2f} mm, TRE {1:.2f} mm (max {2:.2f} mm)".format(
+            errors['FRE'], math.sqrt(np.mean(errors['TRE'] ** 2)), errors['TRE'].max()))
+
+    def onICPRegButton(self):
+        if self.logic.ICPRegistration() is None:
+            return
+        errors = self.logic.registrationErrors
+        self.registrationErrorLabel.setText("RMS {0:.2f} mm after {1} iterations".format(errors['ICPRMS'],
+                                                                                       errors['iterations']))
 
 
 #
@@ -479,18 +1381,6 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
   Uses ScriptedLoadableModuleLogic base class, available at:
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
-    # arrays for convex Hull
-    _yHullArray = []
-    _xHullArray = []
-    # arrays for edge tracing
-    _saveycoordinate = []
-    _savexcoordinate = []
-    # arrays for quadrant check (independent edge tracing)
-    _tumorCheck = []
-    # ROI boundary arrays
-    _ROIxbounds = []
-    _ROIybounds = []
-    
 
     def __init__(self):
 
@@ -500,6 +1390,21 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
         self.spectrumImageNode = None
         self.observerTags = []
         self.outputArrayNode = None
+
+        # Spectrum Chart Variables
+        self.chartNode = None
+        self.chartArrayNode = None
+        self.chartMaximumRateHz = 15.0
+        self.chartUpdatePending = False
+        self.lastChartUpdateTime = 0
+        self.chartClock = time.time
+
+        # Spectral Library
+        self.spectralLibrary = SpectralLibrary()
+
+        # Spectrum History
+        self.spectrumBufferCapacity = 256
+        self.spectrumBuffer = None  # created on the first frame, once the number of spectrum points is known
         
 
         # Spectrum Analysis Variables
@@ -510,6 +1415,124 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
         self.currentSpectrum = vtk.vtkPoints()
         self.referenceSpectra = vtk.vtkPolyData()
         self.spectra = vtk.vtkPoints()
+        self.referenceIntensities = None
+        self.spectrumPreprocessor = SpectrumPreprocessor()
+        self.spectralLibrary.preprocessor = self.spectrumPreprocessor
+        self.spectrumThreshold = 10
+        self.thresholdMetric = "difference"  # statistic compared with spectrumThreshold, see ThresholdCalibrator.metrics
+        self.thresholdCalibrator = ThresholdCalibrator()
+
+        # Batch Re-analysis Variables
+        self.batchProcess = None
+        self.batchDirectory = None
+        self.batchPython = None  # interpreter for the re-analysis worker, PythonSlicer next to Slicer (or a thread) when None
+        self.batchOutputDirectory = None
+        self.batchDoneCallback = None
+        self.batchStartTime = 0
+        self.batchPollIntervalMs = 200
+
+        # Adaptive Averaging Variables
+        self.spectrumAverager = AdaptiveSpectrumAverager()
+        self.adaptiveArrayNode = None
+        self.adaptiveObserverTag = None
+        self.adaptiveAcquisitionIndex = 0
+        self.adaptiveDecisionCallback = None
+        self.adaptiveSingleFrame = False
+
+        # Signal Quality Variables
+        self.signalQuality = SignalQualityScorer()
+        self.qualityCheck = False  # queue low quality stops instead of labelling them
+        self.lastSignalQuality = None  # (snr, saturation) of the latest classified spectrum
+        self.lowQualityStops = []
+        self.lowQualityRevisitDone = False  # set once the queue was revisited (or the scan stopped), no second pass
+
+        # Step Scan Variables
+        self.stepScanWaypoints = None
+        self.stepScanIndex = 0
+        self.stepScanActive = False
+        self.stepScanAcquireCallback = None
+        self.stepScanCompleteCallback = None
+        self.stepScanSkipClassified = True
+
+        # Spatial Index Variables
+        self.spatialIndex = SpatialHashIndex(1.0)
+        self.reuseClassifications = False  # skip stops already classified within reuseRadiusMm
+        self.reuseRadiusMm = 0.5
+        self.reuseMaximumAgeSeconds = 600
+
+        # Multiple Printer Variables
+        self.deviceManager = PrinterDeviceManager()
+        self.deviceDwellMs = 1000
+
+        # Pipelined Scan Variables
+        self.pipelineArrayNode = None
+        self.pipelineObserverTag = None
+        self.pipelineCaptureIndex = 0
+        self.pipelineStop = None
+        self.pipelineMaxDwellMs = 1000
+        self.pipelineTasks = None
+        self.pipelineResults = None
+        self.pipelineWorker = None
+        self.pipelineActive = False
+        self.pipelineResultCallback = None
+        self.pipelinePollIntervalMs = 20
+
+        # Region Learning Variables
+        self.regionLearningArrayNode = None
+        self.regionLearningObserverTag = None
+        self.regionLearningLabel = "tumor"
+        self.regionLearningDwellMs = 500
+        self.regionLearningFrames = []
+        self.regionLearningStopFrames = 0
+
+        # Scan Planner Variables
+        self.measuredAcquisitionMs = 0  # moving average of the time spent at a stop, 0 until a synchronized scan ran
+        self.acquisitionSmoothing = 0.2
+        self.stepScanArrivalTime = None
+
+        # Pattern Variables
+        self.bedSize = 120  # mm, printer bed limits are [0, bedSize] in x and y
+        self.moveModel = KinematicMoveModel()
+        self.pathOptimizer = PathOptimizer(self.moveModel)
+
+        # Fly Scan Variables
+        self.travelFeedRate = 3000  # mm/min for moves between rows
+        self.flyScanActive = False
+        self.flyScanPhase = None
+        self.flyScanRows = []
+        self.flyScanRowIndex = 0
+        self.flyScanArrayNode = None
+        self.flyScanObserverTag = None
+        self.flyScanRowFrames = []
+        self.flyScanFrames = []
+        self.flyScanGrid = None
+
+        # G-code Program Streaming Variables
+        self.programCompiler = GcodeProgramCompiler()
+        self.programMaxInFlight = 4  # commands outstanding at once, matches the firmware's serial buffer
+        self.programStreamActive = False
+        self.programLines = []
+        self.programStopOfLine = {}
+        self.programNextLine = 0
+        self.programHoldAtAcquisition = False
+        self.programWaypoints = None
+        self.programBarrierLine = None
+        self.programAcquireCallback = None
+        self.programLineOfCmd = {}
+        self.programStaleCmds = set()  # in flight when a resend was requested, their completions are ignored
+        self.programFreeCmds = []
+        for i in xrange(self.programMaxInFlight):
+            programCmd = slicer.vtkSlicerOpenIGTLinkCommand()
+            programCmd.SetCommandName('SendText')
+            programCmd.SetCommandAttribute('DeviceId', "SerialDevice")
+            programCmd.SetCommandTimeoutSec(30.0)
+            programCmd.AddObserver(programCmd.CommandCompletedEvent,
+                                   lambda caller, eventid, programCmd=programCmd: self.onProgramLineCompleted(programCmd))
+            self.programFreeCmds.append(programCmd)
+
+        # Image Registration Variables
+        self.registration = PointSetRegistration()
+        self.registrationErrors = {}
 
         # Cooridinate Variables
         self.xcoordinate = 0
@@ -519,12 +1542,31 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
         self.regFidIndex = 0
         self.boundFidIndex = 0
 
+        # Scan Session Variables, cleared by resetScanSession
+        self.scanPoints = ScanPointStore()
+
+        # Scan Point Model Variables
+        self.scanPointCloud = ScanPointCloud(self.scanPoints)
+        self.scanPointModelNode = None
+        self.scanPointGlyphFilter = None
+        self.useScanPointModel = False
+        self.scanPointGlyphs = False
+        self.scanPointModelMaximumRateHz = 5.0
+        self.scanPointModelUpdatePending = False
+        self.lastScanPointModelUpdateTime = 0
+        self._yHullArray = []  # arrays for convex hull
+        self._xHullArray = []
+        self._saveycoordinate = []  # arrays for edge tracing
+        self._savexcoordinate = []
+        self._tumorCheck = []  # array for quadrant check (independent edge tracing)
+        self._ROIxbounds = []  # ROI boundary arrays
+        self._ROIybounds = []
+
         # Contour Tracing Variables
-        self.pointsForHull = vtk.vtkPoints()
-        self.firstDataPointGenerated = 0
         self.edgePoint = 0
         self.pointsForEdgeTracing = vtk.vtkPoints()
         self.edgeTracingTimerStart = 2000
+        self.edgeTracingDwellMs = 250  # pause at each hull point
         self.createTumorArray = 0
         self.startNext = 6000
         self.timerTracker = 0
@@ -534,6 +1576,23 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
         self.currentXcoordinate = 0
         self.currentYcoordinate = 0
 
+        # Scan Progress Variables
+        self.commandedXcoordinate = None  # last commanded position, None when unknown
+        self.commandedYcoordinate = None
+        self.pendingMoveX = None
+        self.pendingMoveY = None
+        self.moveCoalesceWindowMs = 5
+        self.moveFlushTimer = qt.QTimer()
+        self.moveFlushTimer.setSingleShot(True)
+        self.moveFlushTimer.connect('timeout()', self.flushPendingMove)
+        self.sentMoveCount = 0
+        self.droppedMoveCount = 0
+        self.driftToleranceMm = 2.0
+        self.positionCheckInterval = 10  # stops between M114 position checks, 0 disables them
+        self.scanProgress = ScanProgressModel()
+        self.lastPositionCheckStop = 0
+        self.scanProgress.addStopObserver(self.onStopCompleted)
+
         # instantiate coordinate values
         self.getCoordinateCmd = slicer.vtkSlicerOpenIGTLinkCommand()
         self.getCoordinateCmd.SetCommandName('SendText')
@@ -555,6 +1614,33 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
         self.boundaryCoordinateCmd.SetCommandTimeoutSec(1.0)
         self.boundaryCoordinateCmd.SetCommandAttribute('Text', 'M114')
         self.boundaryCoordinateCmd.AddObserver(self.boundaryCoordinateCmd.CommandCompletedEvent,self.onBoundaryCoordinateCmd)
+        # instantiate position check command (drift monitoring during scans)
+        self.positionCheckCmd = slicer.vtkSlicerOpenIGTLinkCommand()
+        self.positionCheckCmd.SetCommandName('SendText')
+        self.positionCheckCmd.SetCommandAttribute('DeviceId', "SerialDevice")
+        self.positionCheckCmd.SetCommandTimeoutSec(1.0)
+        self.positionCheckCmd.SetCommandAttribute('Text', 'M114')
+        self.positionCheckCmd.AddObserver(self.positionCheckCmd.CommandCompletedEvent, self.onPositionCheckCmd)
+        # instantiate motion complete command, M400 is only acknowledged once all queued moves are finished
+        self.motionCompleteCmd = slicer.vtkSlicerOpenIGTLinkCommand()
+        self.motionCompleteCmd.SetCommandName('SendText')
+        self.motionCompleteCmd.SetCommandAttribute('DeviceId', "SerialDevice")
+        self.motionCompleteCmd.SetCommandTimeoutSec(30.0)
+        self.motionCompleteCmd.SetCommandAttribute('Text', 'M400')
+        self.motionCompleteCmd.AddObserver(self.motionCompleteCmd.CommandCompletedEvent, self.onMotionCompleteCmd)
+        # instantiate fly scan commands
+        self.flyScanSyncCmd = slicer.vtkSlicerOpenIGTLinkCommand()
+        self.flyScanSyncCmd.SetCommandName('SendText')
+        self.flyScanSyncCmd.SetCommandAttribute('DeviceId', "SerialDevice")
+        self.flyScanSyncCmd.SetCommandTimeoutSec(60.0)
+        self.flyScanSyncCmd.SetCommandAttribute('Text', 'M400')
+        self.flyScanSyncCmd.AddObserver(self.flyScanSyncCmd.CommandCompletedEvent, self.onFlyScanSyncCmd)
+        self.flyScanPositionCmd = slicer.vtkSlicerOpenIGTLinkCommand()
+        self.flyScanPositionCmd.SetCommandName('SendText')
+        self.flyScanPositionCmd.SetCommandAttribute('DeviceId', "SerialDevice")
+        self.flyScanPositionCmd.SetCommandTimeoutSec(1.0)
+        self.flyScanPositionCmd.SetCommandAttribute('Text', 'M114')
+        self.flyScanPositionCmd.AddObserver(self.flyScanPositionCmd.CommandCompletedEvent, self.onFlyScanPositionCmd)
         # instantiate home command
         self.homeCmd = slicer.vtkSlicerOpenIGTLinkCommand()
         self.homeCmd.SetCommandName('SendText')
@@ -608,13 +1694,87 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
         print "Remove observers"
         for nodeTagPair in self.observerTags:
             nodeTagPair[0].RemoveObserver(nodeTagPair[1])
+        self.observerTags = []
 
+    def setSpectrumImageNode(self, spectrumImageNode, outputArrayNode):
+        self.removeObservers()
+        self.spectrumImageNode = spectrumImageNode
+        self.outputArrayNode = outputArrayNode
+        self.addObservers()
+
+    @traced("spectrum frame", "acquisition")
     def onSpectrumImageNodeModified(self, observer, eventid):
         if not self.spectrumImageNode or not self.outputArrayNode:
             return
-        self.updateOutputArray()
-        self.updateChart()
+        # the output array always holds the latest frame for classification, the chart is only redrawn at chartMaximumRateHz
+        self.updateOutputArray(self.spectrumImageNode)
+        self.recordSpectrum(self.outputArrayNode)
+        self.requestChartUpdate()
+
+    def recordSpectrum(self, outputArrayNode, timestamp=None):
+        intensities = self.getSpectrumIntensities(outputArrayNode)
+        if self.spectrumBuffer is None or self.spectrumBuffer.numberOfPoints != len(intensities):
+            self.spectrumBuffer = SpectrumRingBuffer(self.spectrumBufferCapacity, len(intensities))
+        if self.commandedXcoordinate is None or self.commandedYcoordinate is None:
+            position = None
+        else:
+            position = (self.commandedXcoordinate, self.commandedYcoordinate)
+        self.spectrumBuffer.append(intensities, timestamp, position)
+
+                                                            # Spectrum Chart
+
+    # Every frame that arrives in the same chart interval is coalesced into a single redraw, and nothing is drawn while no chart
+    # view is shown. The chart plots its own copy of the output array so that classification never waits for rendering.
 
+    def requestChartUpdate(self):
+        if self.chartUpdatePending:
+            return
+        if not self.isChartVisible():
+            return
+        elapsedMs = (self.chartClock() - self.lastChartUpdateTime) * 1000.0
+        delayMs = max(0.0, 1000.0 / self.chartMaximumRateHz - elapsedMs)
+        self.chartUpdatePending = True
+        self.scheduleChartUpdate(int(math.ceil(delayMs)))  # rounding down would redraw slightly faster than the rate
+
+    def scheduleChartUpdate(self, delayMs):
+        chartTimer = qt.QTimer()
+        chartTimer.singleShot(delayMs, lambda: self.updateChart())
+
+    def isChartVisible(self):
+        chartViewNode = self.getChartViewNode()
+        if chartViewNode is None:
+            return False
+        if hasattr(chartViewNode, 'IsMappedInLayout'):
+            return bool(chartViewNode.IsMappedInLayout())
+        return True
+
+    def getChartViewNode(self):
+        chartViewNodes = slicer.mrmlScene.GetNodesByClass("vtkMRMLChartViewNode")
+        chartViewNodes.UnRegister(None)
+        if chartViewNodes.GetNumberOfItems() == 0:
+            return None
+        return chartViewNodes.GetItemAsObject(0)
+
+    @traced("update chart", "display")
+    def updateChart(self):
+        self.chartUpdatePending = False
+        self.lastChartUpdateTime = self.chartClock()
+        chartViewNode = self.getChartViewNode()
+        if chartViewNode is None or not self.outputArrayNode:
+            return
+        if not self.chartArrayNode or not slicer.mrmlScene.IsNodePresent(self.chartArrayNode):
+            self.chartArrayNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLDoubleArrayNode", "SpectrumChartArray")
+        if not self.chartNode or not slicer.mrmlScene.IsNodePresent(self.chartNode):
+            self.chartNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLChartNode", "SpectrumChart")
+            self.chartNode.AddArray("Spectrum", self.chartArrayNode.GetID())
+            self.chartNode.SetProperty('default', 'title', 'Spectrum')
+            self.chartNode.SetProperty('default', 'xAxisLabel', 'Wavelength (nm)')
+            self.chartNode.SetProperty('default', 'yAxisLabel', 'Intensity')
+        self.chartArrayNode.GetArray().DeepCopy(self.outputArrayNode.GetArray())
+        self.chartArrayNode.Modified()
+        chartViewNode.SetChartNodeID(self.chartNode.GetID())
+
+    @traced("update output array", "acquisition")
     def updateOutputArray(self, node):
         self.spectrumImageNode = node
         numberOfPoints = self.spectrumImageNode.GetImageData().GetDimensions()[0]
@@ -648,6 +1808,7 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
             a.SetComponent(i, 2, 0)
 
         probedPoints.GetPointData().GetScalars().Modified()
+        self.outputArrayNode.Modified()
 
     # These two functions offer the same functionality as xrange but are able to accept floating point values. Implemented to facilitate high resolution scanning.
 
@@ -661,19 +1822,37 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
             yield start
             start += stepsize
 
-    def getSpectralData(self, outputArrayNode):
+    def getSpectralData(self, outputArrayNode, label="tumor"):
+        # every learned spectrum is added to the spectral library, tumor spectra also become the reference of the threshold comparison
+        self.spectralLibrary.addReference(self.getSpectrumIntensities(outputArrayNode), label)
+        if label != self.spectralLibrary.tumorLabel:
+            print "{0} spectrum added to the library.".format(label)
+            return
         self.referenceOutputArrayNode = outputArrayNode
         referencePointsArray = self.referenceOutputArrayNode.GetArray()
 
         self.spectra.SetNumberOfPoints(100)
         for i in xrange(0, 101, 1):
             self.spectra.SetPoint(i, referencePointsArray.GetTuple(i))
+        self.referenceIntensities = self.getSpectrumIntensities(outputArrayNode)
 
         self.spectraCollected = 1
         print"Spectra collected."
 
+    def getSpectrumIntensities(self, outputArrayNode):
+        # copy of the intensity column (component 1) of the output spectrum array
+        pointsArray = numpy_support.vtk_to_numpy(outputArrayNode.GetArray())
+        return np.array(pointsArray[:self.numberOfSpectrumDataPoints, 1], dtype=float)
+
+    def collectDarkFrame(self, outputArrayNode):
+        self.spectrumPreprocessor.setDarkFrame(self.getSpectrumIntensities(outputArrayNode))
+        print "Dark frame collected."
+
     def home(self):
-        slicer.modules.openigtlinkremote.logic().SendCommand(self.homeCmd, self.serialIGTLNode.GetID())
+        self.sendCommand(self.homeCmd)
+        # G28 leaves the printer at its origin
+        self.commandedXcoordinate = 0
+        self.commandedYcoordinate = 0
 
                                                             # Keyboard Shortcuts
     # Keyboard shortcuts allow the user to manipulate the printer bed with the arrow keys, implemented for boundary selection in ROI scanning.
@@ -717,10 +1896,15 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
 
         return self.xcoordinate, self.ycoordinate, self.zcoordinate
 
+    def sendCommand(self, command):
+        spanTracer.traceCommand(command)
+        slicer.modules.openigtlinkremote.logic().SendCommand(command, self.serialIGTLNode.GetID())
+
     def get_coordinates(self):
-        slicer.modules.openigtlinkremote.logic().SendCommand(self.getCoordinateCmd, self.serialIGTLNode.GetID())
+        self.sendCommand(self.getCoordinateCmd)
         return self.xcoordinate, self.ycoordinate
 
+    @traced("coordinates received", "printer")
     def onPrinterCommandCompleted(self, observer, eventid):
         coordinateValues = self.getCoordinateCmd.GetResponseMessage()
         print("Command completed with status: " + self.getCoordinateCmd.StatusToString(
@@ -730,6 +1914,7 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
 
         mylist = coordinateValues.split(" ")
         self.xcoordinate, self.ycoordinate, self.zcoordinate = self.parseCoords(mylist)
+        self.checkPositionDrift(self.xcoordinate, self.ycoordinate)
 
         # for automated edge tracing
         if self.edgePoint == 0:
@@ -737,8 +1922,6 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
             self._saveycoordinate.append(self.ycoordinate)
             self.edgePoint = 1
 
-        self.dataCollection = self.createPolyDataPoint(self.xcoordinate, self.ycoordinate, self.zcoordinate)
-
         if self.genFidIndex< 1:
             self.fiducialMarker(self.xcoordinate, self.ycoordinate + 1, self.zcoordinate)
             self.genFidIndex= self.genFidIndex + 1
@@ -751,17 +1934,76 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
 
         return self.xcoordinate, self.ycoordinate
 
+                                                            # Scan Progress
+
+    # Every timed scan registers its planned number of stops with the progress model, each tissue decision counts as a completed stop.
+    # Every positionCheckInterval stops the printer is asked for its position (M114) and the answer is compared to the last commanded
+    # position, so that we know when the motion falls behind the timed spectrum readings.
+
+    def startScanProgress(self, plannedStops, stopCostMs):
+        self.scanProgress.reset(plannedStops, stopCostMs)
+        self.lastPositionCheckStop = 0
+        self.resetMoveStatistics()
+        self.scanProgress.notify()
+
+    def onStopCompleted(self, progress):
+        if self.positionCheckInterval <= 0 or progress.completedStops == 0 or self.serialIGTLNode is None:
+            return
+        if self.deviceManager.isScanning():
+            return  # the stops are on the printer devices, M114 would compare them with the primary printer's position
+        if progress.completedStops % self.positionCheckInterval == 0 and progress.completedStops != self.lastPositionCheckStop:
+            self.lastPositionCheckStop = progress.completedStops
+            self.sendCommand(self.positionCheckCmd)
+
+    def onPositionCheckCmd(self, observer, eventid):
+        if self.positionCheckCmd.GetStatus() != self.positionCheckCmd.CommandSuccess:
+            return
+        mylist = self.positionCheckCmd.GetResponseMessage().split(" ")
+        xcoordinate, ycoordinate, zcoordinate = self.parseCoords(mylist)
+        self.checkPositionDrift(xcoordinate, ycoordinate)
+
+    def checkPositionDrift(self, observedX, observedY):
+        # distance between where the printer was last told to go and where it reports to be
+        if self.commandedXcoordinate is None or self.commandedYcoordinate is None:
+            return 0
+        drift = math.hypot(observedX - self.commandedXcoordinate, observedY - self.commandedYcoordinate)
+        # time the printer still needs to reach the commanded position at travel speed
+        self.scanProgress.recordDrift(drift, 1000.0 * drift / (self.travelFeedRate / 60.0))
+        if drift > self.driftToleranceMm:
+            logging.warning("Probe position ({0}, {1}) is {2:.1f} mm from commanded position ({3}, {4})".format(
+                observedX, observedY, drift, self.commandedXcoordinate, self.commandedYcoordinate))
+        return drift
+
+    @traced("mark scan point", "marking")
+    def markScanPoint(self, xcoordinate, ycoordinate, zcoordinate):
+        if self.genFidIndex == 1234:
+            return  # fiducial marking off
+        if self.genFidIndex < 1:
+            self.fiducialMarker(xcoordinate, ycoordinate, zcoordinate)
+            self.genFidIndex = self.genFidIndex + 1
+        else:
+            self.addToCurrentFiducialNode(xcoordinate, ycoordinate, zcoordinate)
+
     def fiducialMarkerChecked(self):
         self.genFidIndex= 1234  # will break if 1234 fiducials is ever reached, implemented for the fiducial marking off function
 
+    @traced("create fiducial node", "marking")
     def fiducialMarker(self, xcoordinate, ycoordinate, zcoordinate):
+        if self.useScanPointModel:
+            return  # points are shown by the scan point model
         self.fiducialNode = slicer.vtkMRMLMarkupsFiducialNode()
         slicer.mrmlScene.AddNode(self.fiducialNode)
         self.fiducialNode.SetName("")
         self.fiducialNode.SetNthFiducialLabel(0, "")
         self.fiducialNode.AddFiducial(xcoordinate, ycoordinate, zcoordinate)
 
+    @traced("add fiducial", "marking")
     def addToCurrentFiducialNode(self, xcoordinate, ycoordinate, zcoordinate):
+        if self.useScanPointModel:
+            return
+        if not getattr(self, 'fiducialNode', None):  # model display was switched off during a scan
+            self.fiducialMarker(xcoordinate, ycoordinate, zcoordinate)
+            return
         self.fiducialNode.AddFiducial(xcoordinate, ycoordinate, zcoordinate)
         self.fiducialNode.SetNthFiducialLabel(self.genFidIndex, "")
         self.genFidIndex= self.genFidIndex + 1
@@ -771,6 +2013,7 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
     
     # Spectrum comparison is used to determine where the live spectrum is the same as the reference spectrum collected before scanning. 
     
+    @traced("spectrum comparison", "classification")
     def spectrumComparison(self, outputArrayNode):
         
         if self.spectraCollected == 0:
@@ -778,24 +2021,188 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
             return
 
         self.currentOutputArrayNode = outputArrayNode
-        currentPointsArray = self.currentOutputArrayNode.GetArray()
         # Data is acquired from probe in a double array with each index corresponding to either wavelength or intensity
         # There are 100 points (tuples) each consisting of one wavelength and a corresponding intensity
         # The first index (0) is where wavelength values are stored
         # The second index (1) is where intensities are stored
-        self.currentSpectrum.SetNumberOfPoints(100)
-        for i in xrange(0, 101, 1):
-            self.currentSpectrum.SetPoint(i, currentPointsArray.GetTuple(i))
-
-        self.averageSpectrumDifferences = 0
-
-        for j in xrange(0, 101, 1):
-            x = self.currentSpectrum.GetPoint(j)
-            y = self.spectra.GetPoint(j)
-            self.averageSpectrumDifferences = self.averageSpectrumDifferences + (y[1] - x[1])
-
-
-        if abs(self.averageSpectrumDifferences) < 10: # 10 is the threshold
+        intensities = self.getSpectrumIntensities(self.currentOutputArrayNode)
+        if not self.checkSignalQuality(intensities):
+            return None  # not labelled, neither healthy nor tumor
+        self.averageSpectrumDifferences = self.spectrumDifference(intensities)
+        return self.applySpectrumDecision(self.classifyTumor(intensities[np.newaxis])[0])
+
+    @traced("classify", "classification")
+    def classifyTumor(self, batch):
+        # nearest reference in the spectral library once it holds more than one tissue class, threshold on the difference to the
+        # tumor reference otherwise
+        return classifySpectra(batch, self.classifierSettings())
+
+    def classifierSettings(self):
+        # everything the classifier needs, picklable so that batch re-analysis workers classify exactly like the live scan
+        return {'library': self.spectralLibrary, 'preprocessor': self.spectrumPreprocessor, 'reference': self.referenceIntensities,
+                'calibrator': self.thresholdCalibrator, 'metric': self.thresholdMetric, 'threshold': self.spectrumThreshold,
+                'signalQuality': self.signalQuality}
+
+    def hasClassifier(self):
+        # a tumor reference for the threshold comparison, or a spectral library with several tissue classes
+        return self.referenceIntensities is not None or self.spectralLibrary.hasClasses()
+
+    def spectrumDifference(self, intensities):
+        if self.referenceIntensities is None:
+            return float('nan')  # classified by the spectral library only
+        return self.spectrumDifferences(np.asarray(intensities)[np.newaxis])[0]
+
+    def spectrumDifferences(self, batch):
+        # The reference goes through the preprocessing pipeline together with the batch before they are compared, thresholdMetric
+        # selects the statistic (summed difference unless a calibration chose another one)
+        processed = self.spectrumPreprocessor.process(np.vstack((batch, self.referenceIntensities)))
+        return self.thresholdCalibrator.scores(processed[:-1], processed[-1], self.thresholdMetric)
+
+                                                            # Batch Re-analysis
+
+    # Archived recordings are re-labelled with the current classifier in a separate Python process (SpectrumAnalysis.py, which does
+    # not import slicer, so neither forking Slicer nor re-importing this module in a spawned child is involved). The worker runs a
+    # process pool, one recording per task, and memory-maps each recording so only the path and the classifier settings are pickled.
+    # A timer waits for the worker, then collects the summaries and writes summary.csv next to the label maps.
+
+    def reanalyzeRecordings(self, directory, outputDirectory, processes=None, doneCallback=None, chunkSize=65536):
+        if self.referenceIntensities is None and not self.spectralLibrary.hasClasses():
+            print " Error: reference spectrum not collected."
+            return
+        if self.batchProcess is not None:
+            print "Error: a batch re-analysis is already running."
+            return
+        paths = ScanRecording.findRecordings(directory)
+        if not paths:
+            print "Error: no recordings found in {0}".format(directory)
+            return
+        settings = self.classifierSettings()
+        tasks = [(path, os.path.join(outputDirectory, os.path.basename(os.path.normpath(path))), settings, chunkSize)
+                 for path in paths]
+        self.batchDirectory = tempfile.mkdtemp()
+        with open(os.path.join(self.batchDirectory, "tasks.pkl"), 'wb') as taskFile:
+            pickle.dump(tasks, taskFile, 2)
+        script = os.path.splitext(SpectrumAnalysis.__file__)[0] + ".py"
+        python = self.batchPythonExecutable()
+        if python is None:
+            # a pool forked from Slicer is not safe, so without a separate interpreter the recordings are classified one by one
+            logging.warning("No Python interpreter for the re-analysis worker (set batchPython), re-analysing in a thread")
+            self.batchProcess = SpectrumAnalysis.BatchThread(os.path.join(self.batchDirectory, "tasks.pkl"),
+                                                             os.path.join(self.batchDirectory, "summaries.pkl"),
+                                                             os.path.join(self.batchDirectory, "errors.txt"))
+            self.batchProcess.start()
+        else:
+            with open(os.path.join(self.batchDirectory, "errors.txt"), 'w') as errorFile:
+                self.batchProcess = subprocess.Popen(
+                    [python, script, os.path.join(self.batchDirectory, "tasks.pkl"),
+                     os.path.join(self.batchDirectory, "summaries.pkl"), str(processes or multiprocessing.cpu_count())],
+                    cwd=os.path.dirname(script), stdout=errorFile, stderr=subprocess.STDOUT)
+        self.batchOutputDirectory = outputDirectory
+        self.batchDoneCallback = doneCallback
+        self.batchStartTime = time.time()
+        print "Re-analysing {0} recordings".format(len(tasks))
+        self.pollBatchReanalysis()
+
+    def batchPythonExecutable(self):
+        # Slicer's own executable would start a second Slicer, PythonSlicer is a plain interpreter with Slicer's NumPy. Older Slicer
+        # builds do not ship it, and a python found on the PATH usually lacks NumPy, so None is returned instead of guessing
+        if self.batchPython:
+            return self.batchPython
+        for name in ("PythonSlicer", "PythonSlicer.exe"):
+            candidate = os.path.join(os.path.dirname(sys.executable), name)
+            if os.path.exists(candidate):
+                return candidate
+        return None
+
+    def pollBatchReanalysis(self):
+        if self.batchProcess is None:
+            return
+        if self.batchProcess.poll() is None:
+            pollTimer = qt.QTimer()
+            pollTimer.singleShot(self.batchPollIntervalMs, lambda: self.pollBatchReanalysis())
+            return
+        returnCode = self.batchProcess.returncode
+        self.batchProcess = None
+        summaries = []
+        if returnCode != 0:
+            with open(os.path.join(self.batchDirectory, "errors.txt")) as errorFile:
+                logging.error("Batch re-analysis failed ({0}): {1}".format(returnCode, errorFile.read()))
+        else:
+            with open(os.path.join(self.batchDirectory, "summaries.pkl"), 'rb') as summaryFile:
+                summaries = pickle.load(summaryFile)
+            summaryPath = self.writeBatchSummary(summaries, self.batchOutputDirectory)
+            print "Re-analysed {0} recordings in {1:.1f} s, summary written to {2}".format(
+                len(summaries), time.time() - self.batchStartTime, summaryPath)
+        if self.batchDoneCallback:
+            self.batchDoneCallback(summaries)
+
+    def writeBatchSummary(self, summaries, outputDirectory):
+        columns = ['recording', 'frames', 'tumorFraction', 'labelled', 'accuracy', 'sensitivity', 'specificity', 'seconds']
+        summaryPath = os.path.join(outputDirectory, "summary.csv")
+        with open(summaryPath, 'w') as summaryFile:
+            summaryFile.write(",".join(columns) + "\n")
+            for summary in summaries:
+                summaryFile.write(",".join(str(summary[column]) for column in columns) + "\n")
+        return summaryPath
+
+                                                            # Threshold Calibration
+
+    # Recorded scans with ground truth labels are scored with every statistic in chunks (recordings are memory-mapped), the ROC and
+    # precision-recall curves of each statistic are written next to the recordings and the operating point of the statistic with the
+    # largest area under the ROC curve becomes the live threshold.
+
+    def exportSpectrumHistory(self, directory, label=-1):
+        if self.spectrumBuffer is None or len(self.spectrumBuffer) == 0:
+            print "Error: no spectra recorded."
+            return None
+        spectra, timestamps, positions = self.spectrumBuffer.window()
+        recording = ScanRecording(spectra, positions, timestamps, np.full(len(spectra), label, dtype=np.int8))
+        recording.save(directory)
+        print "{0} spectra exported to {1}".format(len(spectra), directory)
+        return recording
+
+    def recordingScores(self, spectra, metric, chunkSize=65536):
+        scores = np.zeros(len(spectra))
+        processedReference = self.spectrumPreprocessor.process(self.referenceIntensities)
+        for start in xrange(0, len(spectra), chunkSize):
+            processed = self.spectrumPreprocessor.process(spectra[start:start + chunkSize])
+            scores[start:start + chunkSize] = self.thresholdCalibrator.scores(processed, processedReference, metric)
+        return scores
+
+    def calibrateThreshold(self, directory):
+        if self.referenceIntensities is None:
+            print " Error: reference spectrum not collected."
+            return None
+        recordings = [ScanRecording.load(path) for path in ScanRecording.findRecordings(directory)]
+        if not recordings:
+            print "Error: no recordings found in {0}".format(directory)
+            return None
+        labels = np.concatenate([recording.labels for recording in recordings])
+        if (labels == 1).sum() == 0 or (labels == 0).sum() == 0:
+            print "Error: calibration needs labelled tumor and healthy spectra."
+            return None
+        best = None
+        for metric in self.thresholdCalibrator.metrics:
+            scores = np.concatenate([self.recordingScores(recording.spectra, metric) for recording in recordings])
+            curves = self.thresholdCalibrator.curves(scores, labels)
+            self.thresholdCalibrator.saveCurves(os.path.join(directory, "calibration_{0}.csv".format(metric)), curves)
+            auc = self.thresholdCalibrator.auc(curves)
+            index = self.thresholdCalibrator.operatingPoint(curves)
+            result = {'metric': metric, 'auc': auc, 'threshold': curves['thresholds'][index],
+                      'tpr': curves['tpr'][index], 'fpr': curves['fpr'][index], 'precision': curves['precision'][index]}
+            print "{metric}: AUC {auc:.3f}, threshold {threshold:.4g}, TPR {tpr:.3f}, FPR {fpr:.3f}".format(**result)
+            if best is None or auc > best['auc']:
+                best = result
+        self.thresholdMetric = best['metric']
+        self.spectrumThreshold = best['threshold']
+        return best
+
+    @traced("apply decision", "classification")
+    def applySpectrumDecision(self, tumor):
+        if self.commandedXcoordinate is not None and self.commandedYcoordinate is not None:
+            self.recordClassification(self.commandedXcoordinate, self.commandedYcoordinate, tumor,
+                                      self.averageSpectrumDifferences)
+        if tumor:
             print " tumor"
             if self.firstComparison == 1:
                 self.get_coordinates()
@@ -808,6 +2215,825 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
                 self._tumorCheck.append(0)
             return True
 
+                                                            # Adaptive Averaging
+
+    # Instead of classifying one frame after a fixed delay, every new frame written to the output array is added to a running mean at the
+    # current stop. As soon as the averaged spectrum difference is far enough from the threshold (sequential test on the standard error)
+    # the stop is labelled, ambiguous stops keep collecting frames until the maximum dwell time.
+
+    @traced("start adaptive acquisition", "acquisition")
+    def startAdaptiveAcquisition(self, outputArrayNode, maxDwellMs, decisionCallback=None, singleFrame=False):
+        if not self.hasClassifier():
+            print " Error: reference spectrum not collected."
+            if self.stepScanActive:
+                self.stopStepScan()  # the stop would never be reported as done
+                print "Step scan stopped."
+            return
+        self.stopAdaptiveAcquisition()
+        self.adaptiveAcquisitionIndex = self.adaptiveAcquisitionIndex + 1
+        self.adaptiveDecisionCallback = decisionCallback
+        self.adaptiveSingleFrame = singleFrame
+        self.spectrumAverager.threshold = self.spectrumThreshold
+        self.spectrumAverager.reset()
+        self.adaptiveArrayNode = outputArrayNode
+        self.adaptiveObserverTag = outputArrayNode.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onAdaptiveFrame)
+        acquisitionIndex = self.adaptiveAcquisitionIndex
+        dwellTimer = qt.QTimer()
+        dwellTimer.singleShot(maxDwellMs, lambda: self.finishAdaptiveAcquisition(acquisitionIndex))
+
+    def stopAdaptiveAcquisition(self):
+        if self.adaptiveObserverTag is not None:
+            self.adaptiveArrayNode.RemoveObserver(self.adaptiveObserverTag)
+            self.adaptiveObserverTag = None
+
+    def onAdaptiveFrame(self, observer, eventid):
+        intensities = self.getSpectrumIntensities(self.adaptiveArrayNode)
+        self.spectrumAverager.addFrame(intensities, self.spectrumDifference(intensities))
+        if self.adaptiveSingleFrame or self.spectrumAverager.isConfident() or self.spectrumAverager.isFull():
+            self.finishAdaptiveAcquisition(self.adaptiveAcquisitionIndex)
+
+    def finishAdaptiveAcquisition(self, acquisitionIndex):
+        if acquisitionIndex != self.adaptiveAcquisitionIndex or self.adaptiveObserverTag is None:
+            return  # this stop has already been labelled
+        self.stopAdaptiveAcquisition()
+        if self.spectrumAverager.numberOfFrames == 0:
+            # no new frame arrived during the dwell, fall back to the current contents of the array
+            intensities = self.getSpectrumIntensities(self.adaptiveArrayNode)
+            self.spectrumAverager.addFrame(intensities, self.spectrumDifference(intensities))
+        if not self.checkSignalQuality(self.spectrumAverager.frameMean):
+            if self.adaptiveDecisionCallback:
+                self.adaptiveDecisionCallback(None)  # not labelled, neither healthy nor tumor
+            return None
+        self.averageSpectrumDifferences = self.spectrumAverager.statisticMean
+        if self.spectralLibrary.hasClasses():
+            tumor = self.spectralLibrary.isTumor(self.spectrumAverager.frameMean)[0]
+        else:
+            tumor = self.spectrumAverager.isTumor()
+        healthy = self.applySpectrumDecision(tumor)
+        if self.adaptiveDecisionCallback:
+            self.adaptiveDecisionCallback(healthy)
+        return healthy
+
+
+                                                                # Motion Synchronized Step Scan
+
+    # Instead of timing moves and spectrum readings independently, each stop is visited with G1 followed by M400. The printer only
+    # acknowledges M400 once the move is finished, the acquisition starts on that acknowledgement and the next move is sent as soon as
+    # the acquisition callback reports the stop as done (stepScanStopDone), so the dwell is exactly as long as the optics need.
+
+    @traced("plan raster", "planning")
+    def rasterWaypoints(self, xMin, xMax, yMin, yMax, xResolution, yResolution):
+        # serpentine grid: even rows forward in x, odd rows backwards
+        xValues = np.arange(xMin, xMax + 0.5 * xResolution, float(xResolution))
+        yValues = np.arange(yMin, yMax + 0.5 * yResolution, float(yResolution))
+        xGrid = np.tile(xValues, (len(yValues), 1))
+        xGrid[1::2] = xGrid[1::2, ::-1]
+        yGrid = np.repeat(yValues, len(xValues)).reshape(xGrid.shape)
+        return np.column_stack((xGrid.ravel(), yGrid.ravel()))
+
+    def startStepScan(self, waypoints, acquireCallback, plannedStops=None, completeCallback=None, skipClassified=True,
+                      revisit=False):
+        # waypoints is a (n, 2) array, or an iterable of such arrays that is consumed chunk by chunk while scanning
+        # revisit is set for the pass over queued low signal quality stops, which is not revisited again. Stops queued before the
+        # scan (edge tracing, timed scans) stay in the queue and are revisited together with the ones of this scan
+        self.lowQualityRevisitDone = revisit
+        if isinstance(waypoints, np.ndarray):
+            plannedStops = len(waypoints)
+            waypoints = [waypoints]
+        self.stepScanSource = iter(waypoints)
+        self.stepScanWaypoints = np.zeros((0, 2))
+        self.stepScanChunkIndex = 0
+        self.stepScanIndex = 0
+        self.stepScanAcquireCallback = acquireCallback
+        self.stepScanCompleteCallback = completeCallback
+        self.stepScanSkipClassified = skipClassified
+        self.stepScanActive = True
+        self.startScanProgress(plannedStops or 0, 0)
+        self.moveToNextStop()
+
+    def stopStepScan(self):
+        self.stepScanActive = False
+        self.lowQualityRevisitDone = True  # a stopped scan is not revisited
+        self.stopAdaptiveAcquisition()
+        self.stopRegionLearningStop()
+        self.stopPipelinedScan()
+
+    @traced("move to next stop", "printer")
+    def moveToNextStop(self):
+        if not self.stepScanActive:
+            return
+        while True:
+            while self.stepScanChunkIndex >= len(self.stepScanWaypoints):
+                try:
+                    self.stepScanWaypoints = np.asarray(next(self.stepScanSource), dtype=float)
+                except StopIteration:
+                    if self.lowQualityStops and not self.lowQualityRevisitDone and not self.pipelineActive:
+                        # the pipelined scan revisits once its worker has classified every stop
+                        self.lowQualityRevisitDone = True
+                        self.stepScanSource = iter([self.takeLowQualityStops()])
+                        continue
+                    self.stepScanActive = False
+                    print "Step scan complete."
+                    if self.stepScanCompleteCallback:
+                        self.stepScanCompleteCallback()
+                    return
+                self.stepScanChunkIndex = 0
+            xcoordinate, ycoordinate = self.stepScanWaypoints[self.stepScanChunkIndex, :2]
+            if not self.stepScanSkipClassified or self.cachedClassification(xcoordinate, ycoordinate) is None:
+                break
+            # classified recently, skip the stop
+            self.scanProgress.stopCompleted()
+            self.stepScanIndex = self.stepScanIndex + 1
+            self.stepScanChunkIndex = self.stepScanChunkIndex + 1
+        self.controlledXYMovement(xcoordinate, ycoordinate)
+        self.sendCommand(self.motionCompleteCmd)
+
+    def onMotionCompleteCmd(self, observer, eventid):
+        if not self.stepScanActive:
+            return
+        if self.motionCompleteCmd.GetStatus() != self.motionCompleteCmd.CommandSuccess:
+            logging.error("Step scan stopped, M400 failed with status " +
+                          self.motionCompleteCmd.StatusToString(self.motionCompleteCmd.GetStatus()))
+            self.stepScanActive = False
+            return
+        xcoordinate, ycoordinate = self.stepScanWaypoints[self.stepScanChunkIndex, :2]
+        self.stepScanArrivalTime = time.time()
+        self.stepScanAcquireCallback(self.stepScanIndex, xcoordinate, ycoordinate)
+
+    def stepScanStopDone(self):
+        if not self.stepScanActive:
+            return
+        self.scanProgress.stopCompleted()
+        self.recordAcquisitionTime()
+        self.stepScanIndex = self.stepScanIndex + 1
+        self.stepScanChunkIndex = self.stepScanChunkIndex + 1
+        self.moveToNextStop()
+
+    def acquisitionDone(self):
+        # called once the spectrum at the current stop has been taken, by whichever scan engine is running
+        if self.programStreamActive:
+            self.programAcquisitionDone()
+        else:
+            self.stepScanStopDone()
+
+                                                                # Pipelined Step Scan
+
+    # The step scan only waits for the spectrum at a stop to be captured, the move to the next stop is sent right away. Classification,
+    # recording and the tumor decision of the captured frame run on a worker thread, the results are queued back and applied (fiducials,
+    # resultCallback) on the main thread by a polling timer, so the cost of a stop is the larger of move and acquisition, not their sum.
+    # Fiducials are placed at the commanded stop position since the probe has already moved on when the result arrives.
+
+    def startPipelinedScan(self, outputArrayNode, waypoints, maxDwellMs, recordingDirectory=None, resultCallback=None,
+                           revisit=False):
+        if self.referenceIntensities is None and not self.spectralLibrary.hasClasses():
+            print " Error: reference spectrum not collected."
+            return
+        self.stopPipelinedScan()
+        self.pipelineArrayNode = outputArrayNode
+        self.pipelineMaxDwellMs = maxDwellMs
+        self.pipelineResultCallback = resultCallback
+        self.pipelineTasks = Queue.Queue()
+        self.pipelineResults = Queue.Queue()
+        # the worker classifies with a snapshot, changing the classifier during the scan does not race with the worker thread
+        self.pipelineWorker = threading.Thread(target=self.runPipelineWorker,
+                                               args=(copy.deepcopy(self.classifierSettings()), recordingDirectory,
+                                                     self.pipelineTasks, self.pipelineResults))
+        self.pipelineWorker.daemon = True
+        self.pipelineWorker.start()
+        self.pipelineActive = True
+        self.startStepScan(waypoints, self.capturePipelineStop, completeCallback=self.stopPipelinedScan, revisit=revisit)
+        self.pollPipelineResults(self.pipelineResults)
+
+    @traced("capture pipeline stop", "acquisition")
+    def capturePipelineStop(self, stopIndex, xcoordinate, ycoordinate):
+        # wait for a frame taken after the move finished, or take the current one after the maximum dwell
+        self.pipelineCaptureIndex = self.pipelineCaptureIndex + 1
+        self.pipelineStop = (stopIndex, xcoordinate, ycoordinate)
+        self.pipelineObserverTag = self.pipelineArrayNode.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onPipelineFrame)
+        captureIndex = self.pipelineCaptureIndex
+        dwellTimer = qt.QTimer()
+        dwellTimer.singleShot(self.pipelineMaxDwellMs, lambda: self.pipelineFrameCaptured(captureIndex))
+
+    def onPipelineFrame(self, observer, eventid):
+        self.pipelineFrameCaptured(self.pipelineCaptureIndex)
+
+    def pipelineFrameCaptured(self, captureIndex):
+        if captureIndex != self.pipelineCaptureIndex or self.pipelineObserverTag is None:
+            return  # this stop has already been captured
+        self.pipelineArrayNode.RemoveObserver(self.pipelineObserverTag)
+        self.pipelineObserverTag = None
+        stopIndex, xcoordinate, ycoordinate = self.pipelineStop
+        self.pipelineTasks.put((stopIndex, xcoordinate, ycoordinate, time.time(),
+                                self.getSpectrumIntensities(self.pipelineArrayNode)))
+        self.stepScanStopDone()
+
+    def stopPipelinedScan(self):
+        if self.pipelineObserverTag is not None:
+            self.pipelineArrayNode.RemoveObserver(self.pipelineObserverTag)
+            self.pipelineObserverTag = None
+        if self.pipelineActive:
+            self.pipelineActive = False
+            self.pipelineTasks.put(None)  # the worker finishes the queued stops, saves the recording and exits
+
+    def runPipelineWorker(self, settings, recordingDirectory, tasks, results):
+        # worker thread: no MRML or Qt calls here, only NumPy and file output
+        stops = []
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            stopIndex, xcoordinate, ycoordinate, timestamp, intensities = task
+            try:
+                tumor = bool(classifySpectra(intensities[np.newaxis], settings)[0])
+                snr, saturation = settings['signalQuality'].scores(intensities)
+            except Exception as error:
+                results.put(('error', str(error)))
+                continue
+            stops.append((xcoordinate, ycoordinate, timestamp, intensities, tumor))
+            results.put(('stop', (stopIndex, xcoordinate, ycoordinate, tumor, snr[0], saturation[0])))
+        if recordingDirectory and stops:
+            # the recording's labels are ground truth and stay unknown (-1), the classifier output goes to predictions.npy
+            recording = ScanRecording(np.array([stop[3] for stop in stops]), np.array([stop[:2] for stop in stops]),
+                                      np.array([stop[2] for stop in stops]))
+            recording.save(os.path.join(recordingDirectory, time.strftime("scan-%Y%m%d-%H%M%S")))
+            np.save(os.path.join(recording.path, "predictions.npy"), np.array([stop[4] for stop in stops], dtype=np.int8))
+        results.put(('done', len(stops)))
+
+    def pollPipelineResults(self, results):
+        # one polling chain per scan, it ends with the 'done' message of that scan's worker
+        while True:
+            try:
+                kind, value = results.get_nowait()
+            except Queue.Empty:
+                break
+            if kind == 'stop':
+                self.applyPipelineResult(*value)
+            elif kind == 'error':
+                logging.error("Pipelined classification failed: " + value)
+            elif kind == 'done':
+                print "Pipelined scan classified {0} stops.".format(value)
+                if self.lowQualityStops and not self.lowQualityRevisitDone:
+                    self.startPipelinedScan(self.pipelineArrayNode, self.takeLowQualityStops(), self.pipelineMaxDwellMs,
+                                            resultCallback=self.pipelineResultCallback, revisit=True)
+                return
+        pollTimer = qt.QTimer()
+        pollTimer.singleShot(self.pipelinePollIntervalMs, lambda: self.pollPipelineResults(results))
+
+    def applyPipelineResult(self, stopIndex, xcoordinate, ycoordinate, tumor, snr=float('inf'), saturation=0.0):
+        self.lastSignalQuality = (snr, saturation)
+        if self.qualityCheck and not self.signalQuality.isAcceptable(snr, saturation):
+            self.queueLowQualityStop(xcoordinate, ycoordinate)
+            return
+        self.recordClassification(xcoordinate, ycoordinate, tumor)
+        if tumor:
+            self.markScanPoint(xcoordinate, ycoordinate, self.zcoordinate)
+        if self.createTumorArray == 1:
+            self._tumorCheck.append(1 if tumor else 0)
+        if self.pipelineResultCallback:
+            self.pipelineResultCallback(stopIndex, xcoordinate, ycoordinate, tumor)
+
+                                                                # Signal Quality
+
+    # Spectra taken with poor probe contact (low SNR) or glare (saturation) are not labelled when qualityCheck is on. Their stops are
+    # queued and, once the scan is through, visited again in travel-optimal order from the last position, so that a bad stop costs
+    # one extra move instead of a full rescan. A stop that is still poor on the second visit is left unlabelled. Quadrant checks of
+    # the contour tracing get an unknown (-1) entry in _tumorCheck instead of a label, so findTrajectory picks no quadrant and the
+    # next check probes the same origin again.
+
+    def checkSignalQuality(self, intensities):
+        snr, saturation = self.signalQuality.scores(intensities)
+        self.lastSignalQuality = (snr[0], saturation[0])
+        if not self.qualityCheck or self.signalQuality.isAcceptable(snr, saturation)[0]:
+            return True
+        self.queueLowQualityStop(self.commandedXcoordinate, self.commandedYcoordinate)
+        return False
+
+    def queueLowQualityStop(self, xcoordinate, ycoordinate):
+        snr, saturation = self.lastSignalQuality
+        if self.createTumorArray == 1:
+            self._tumorCheck.append(-1)  # keeps the quadrant slots findTrajectory reads in place
+        if xcoordinate is None or ycoordinate is None or self.lowQualityRevisitDone:
+            logging.warning("Low signal quality (SNR {0:.1f}, {1:.0%} saturated) at ({2}, {3}), stop left unlabelled".format(
+                snr, saturation, xcoordinate, ycoordinate))
+            return
+        print "Low signal quality (SNR {0:.1f}, {1:.0%} saturated), stop ({2}, {3}) queued for re-acquisition".format(
+            snr, saturation, xcoordinate, ycoordinate)
+        self.lowQualityStops.append((xcoordinate, ycoordinate))
+
+    def takeLowQualityStops(self):
+        # the queued stops in travel-optimal order from the current position, the queue is emptied
+        stops = self.optimizeWaypointOrder(np.array(self.lowQualityStops, dtype=float))
+        self.lowQualityStops = []
+        print "Revisiting {0} low signal quality stops.".format(len(stops))
+        return stops
+
+    def revisitLowQualityStops(self, acquireCallback):
+        # for scans without an end of scan revisit (timed scans), started from the widget
+        if not self.lowQualityStops:
+            print "No low signal quality stops queued."
+            return
+        self.startStepScan(self.takeLowQualityStops(), acquireCallback, revisit=True)
+
+                                                                # Region Reference Learning
+
+    # Instead of one instantaneous frame, a reference is learned by step scanning a small patch around the probe (or the BoundaryPoints
+    # ROI) and collecting every frame during a dwell at each point. Outlier frames (bubbles, specular glare, tissue edges) are rejected
+    # by the spectral library before the mean and covariance of the region are stored.
+
+    def patchWaypoints(self, size, spacing):
+        if self.commandedXcoordinate is None or self.commandedYcoordinate is None:
+            print "Error: probe position unknown, home the printer or move to the region first."
+            return None
+        half = size / 2.0
+        xMin = max(self.commandedXcoordinate - half, 0)
+        xMax = min(self.commandedXcoordinate + half, self.bedSize)
+        yMin = max(self.commandedYcoordinate - half, 0)
+        yMax = min(self.commandedYcoordinate + half, self.bedSize)
+        return self.rasterWaypoints(xMin, xMax, yMin, yMax, spacing, spacing)
+
+    def learnReferenceRegion(self, outputArrayNode, waypoints, label, dwellMs):
+        self.regionLearningArrayNode = outputArrayNode
+        self.regionLearningLabel = label
+        self.regionLearningDwellMs = dwellMs
+        self.regionLearningFrames = []
+        self.startStepScan(waypoints, self.acquireRegionLearningStop, completeCallback=self.finishRegionLearning,
+                           skipClassified=False)
+
+    def acquireRegionLearningStop(self, stopIndex, xcoordinate, ycoordinate):
+        self.regionLearningStopFrames = 0
+        self.regionLearningObserverTag = self.regionLearningArrayNode.AddObserver(vtk.vtkCommand.ModifiedEvent,
+                                                                                  self.onRegionLearningFrame)
+        dwellTimer = qt.QTimer()
+        dwellTimer.singleShot(self.regionLearningDwellMs, lambda: self.regionLearningStopDone())
+
+    def onRegionLearningFrame(self, observer, eventid):
+        self.regionLearningFrames.append(self.getSpectrumIntensities(self.regionLearningArrayNode))
+        self.regionLearningStopFrames = self.regionLearningStopFrames + 1
+
+    def stopRegionLearningStop(self):
+        if self.regionLearningObserverTag is not None:
+            self.regionLearningArrayNode.RemoveObserver(self.regionLearningObserverTag)
+            self.regionLearningObserverTag = None
+
+    def regionLearningStopDone(self):
+        if self.regionLearningObserverTag is None:
+            return  # the scan was stopped during the dwell
+        self.stopRegionLearningStop()
+        if self.regionLearningStopFrames == 0:
+            # no new frame arrived during the dwell, use the current contents of the array
+            self.regionLearningFrames.append(self.getSpectrumIntensities(self.regionLearningArrayNode))
+        self.stepScanStopDone()
+
+    def finishRegionLearning(self):
+        if not self.regionLearningFrames:
+            return
+        mean, covariance, inliers = self.spectralLibrary.estimateReference(self.regionLearningFrames)
+        self.spectralLibrary.addReference(mean, self.regionLearningLabel, covariance)
+        if self.regionLearningLabel == self.spectralLibrary.tumorLabel:
+            self.referenceIntensities = mean
+            self.spectraCollected = 1
+        print "{0} reference learned from {1} of {2} frames.".format(self.regionLearningLabel, inliers.sum(), len(inliers))
+        self.regionLearningFrames = []
+
+                                                                # Multiple Printers
+
+    # Additional printers are PrinterDevice objects with their own connector, commands and position, all scanning at the same time.
+    # An ROI raster is split into row blocks (one block per printer), or every printer scans the same pattern on its own specimen.
+    # Each stop waits for a frame from the printer's own spectrum array, is classified with the shared classifier and marked in the
+    # printer's own fiducial list.
+
+    def startMultiPrinterScan(self, waypoints, maxDwellMs, splitWaypoints=True, completeCallback=None):
+        devices = self.deviceManager.devices
+        if not devices:
+            print "Error: no printers added."
+            return
+        if any(device.outputArrayNode is None for device in devices):
+            print "Error: every printer needs a spectrum array."
+            return
+        if self.referenceIntensities is None and not self.spectralLibrary.hasClasses():
+            print " Error: reference spectrum not collected."
+            return
+        if splitWaypoints:
+            assignments = self.deviceManager.partitionWaypoints(waypoints)
+        else:
+            assignments = [waypoints] * len(devices)
+        self.deviceDwellMs = maxDwellMs
+        self.startScanProgress(sum(len(assignment) for assignment in assignments), 0)
+        self.deviceManager.startScans(assignments, self.acquireDeviceStop, completeCallback)
+
+    def acquireDeviceStop(self, device, stopIndex, xcoordinate, ycoordinate):
+        device.captureFrame(self.deviceDwellMs, lambda: self.deviceStopCaptured(device, xcoordinate, ycoordinate))
+
+    def deviceStopCaptured(self, device, xcoordinate, ycoordinate):
+        intensities = self.getSpectrumIntensities(device.outputArrayNode)
+        # not added to the spatial index, which holds positions on the primary printer's bed
+        if self.classifyTumor(intensities[np.newaxis])[0]:
+            self.markDevicePoint(device, xcoordinate, ycoordinate)
+        self.scanProgress.stopCompleted()
+        device.stopDone()
+
+    def markDevicePoint(self, device, xcoordinate, ycoordinate):
+        if device.fiducialNode is None or not slicer.mrmlScene.IsNodePresent(device.fiducialNode):
+            device.fiducialNode = slicer.vtkMRMLMarkupsFiducialNode()
+            device.fiducialNode.SetName("Tumor " + device.name)
+            slicer.mrmlScene.AddNode(device.fiducialNode)
+        index = device.fiducialNode.AddFiducial(xcoordinate, ycoordinate, self.zcoordinate)
+        device.fiducialNode.SetNthFiducialLabel(index, "")
+
+                                                                # Spatial Index
+
+    # Every classification made at a known bed position is kept in a grid hashed spatial index. Step scans and contour tracing can then
+    # reuse a recent label within reuseRadiusMm instead of moving the stage back to a place that has already been probed.
+
+    @traced("record classification", "marking")
+    def recordClassification(self, xcoordinate, ycoordinate, tumor, score=float('nan')):
+        self.scanPoints.append(xcoordinate, ycoordinate, self.zcoordinate, 1 if tumor else 0, score)
+        self.spatialIndex.insert(xcoordinate, ycoordinate, tumor, score)
+        self.requestScanPointModelUpdate()
+
+    def resetScanSession(self):
+        # forget the points, boundaries and tracing state of the previous scan, the allocated point store is reused
+        self.scanPoints.reset()
+        self.spatialIndex.clear()
+        self._xHullArray = []
+        self._yHullArray = []
+        self._savexcoordinate = []
+        self._saveycoordinate = []
+        self._tumorCheck = []
+        self.lowQualityStops = []
+        self._ROIxbounds = []
+        self._ROIybounds = []
+        self.pointsForEdgeTracing.Reset()
+        self.edgeTracingTimerStart = 2000
+        self.requestScanPointModelUpdate()
+
+    def exportScanPoints(self, path):
+        self.scanPoints.save(path)
+        print "{0} scan points exported to {1}".format(len(self.scanPoints), path)
+
+                                                                # Scan Point Model
+
+    # Markups slow down past a few thousand fiducials, so dense scans can publish their points as a single model node instead. The
+    # polydata wraps the scan point store, and additions are coalesced into at most scanPointModelMaximumRateHz redraws per second.
+
+    def setScanPointDisplay(self, enabled, glyphs=False, decimation=1):
+        self.useScanPointModel = enabled
+        self.scanPointCloud.setDecimation(decimation)
+        if glyphs != self.scanPointGlyphs:
+            self.scanPointGlyphs = glyphs
+            if self.scanPointModelNode and slicer.mrmlScene.IsNodePresent(self.scanPointModelNode):
+                self.connectScanPointModel()
+        self.updateScanPointModel()
+
+    def requestScanPointModelUpdate(self):
+        if self.scanPointModelUpdatePending or not self.useScanPointModel:
+            return
+        elapsedMs = (time.time() - self.lastScanPointModelUpdateTime) * 1000.0
+        delayMs = max(0.0, 1000.0 / self.scanPointModelMaximumRateHz - elapsedMs)
+        self.scanPointModelUpdatePending = True
+        modelTimer = qt.QTimer()
+        modelTimer.singleShot(int(delayMs), lambda: self.updateScanPointModel())
+
+    @traced("update point cloud", "marking")
+    def updateScanPointModel(self):
+        self.scanPointModelUpdatePending = False
+        self.lastScanPointModelUpdateTime = time.time()
+        if not self.useScanPointModel:
+            return
+        self.scanPointCloud.update()
+        if not self.scanPointModelNode or not slicer.mrmlScene.IsNodePresent(self.scanPointModelNode):
+            self.scanPointModelNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode", "ScanPoints")
+            self.scanPointModelNode.CreateDefaultDisplayNodes()
+            displayNode = self.scanPointModelNode.GetDisplayNode()
+            displayNode.SetPointSize(4)
+            displayNode.SetActiveScalarName("label")
+            displayNode.SetAndObserveColorNodeID("vtkMRMLColorTableNodeRainbow")  # healthy blue, tumor red
+            displayNode.SetScalarRangeFlag(slicer.vtkMRMLDisplayNode.UseManualScalarRange)
+            displayNode.SetScalarRange(0, 1)
+            displayNode.SetScalarVisibility(True)
+            displayNode.SetSliceIntersectionVisibility(True)
+            self.connectScanPointModel()
+
+    def connectScanPointModel(self):
+        if self.scanPointGlyphs:
+            # small low resolution spheres, these are visible in the slice views too but cost far more than vertices
+            sphere = vtk.vtkSphereSource()
+            sphere.SetRadius(0.25)
+            sphere.SetThetaResolution(6)
+            sphere.SetPhiResolution(6)
+            self.scanPointGlyphFilter = vtk.vtkGlyph3D()
+            self.scanPointGlyphFilter.SetSourceConnection(sphere.GetOutputPort())
+            self.scanPointGlyphFilter.SetInputConnection(self.scanPointCloud.maskedPoints.GetOutputPort())
+            self.scanPointGlyphFilter.SetScaleModeToDataScalingOff()
+            self.scanPointModelNode.SetPolyDataConnection(self.scanPointGlyphFilter.GetOutputPort())
+        else:
+            self.scanPointGlyphFilter = None
+            self.scanPointModelNode.SetAndObservePolyData(self.scanPointCloud.polyData)
+
+    def cachedClassification(self, xcoordinate, ycoordinate):
+        if not self.reuseClassifications:
+            return None
+        return self.spatialIndex.nearest(xcoordinate, ycoordinate, self.reuseRadiusMm, self.reuseMaximumAgeSeconds)
+
+    def appendCachedTumorCheck(self, delay, record):
+        # keeps the cached label in its place in _tumorCheck, the order findTrajectory reads the quadrants in
+        cacheTimer = qt.QTimer()
+        cacheTimer.singleShot(delay, lambda: self._tumorCheck.append(1 if record[2] else 0))
+
+                                                                # Time Budgeted Planning
+
+    # The planner predicts the duration of a serpentine grid from the kinematic move model and the measured time spent acquiring at a
+    # stop, and bisects the grid spacing for the finest grid that fits the time budget. Pipelined scans overlap the move with the
+    # acquisition, so a stop costs the larger of both instead of their sum.
+
+    def recordAcquisitionTime(self):
+        if self.stepScanArrivalTime is None:
+            return
+        acquisitionMs = (time.time() - self.stepScanArrivalTime) * 1000.0
+        self.stepScanArrivalTime = None
+        if self.measuredAcquisitionMs == 0:
+            self.measuredAcquisitionMs = acquisitionMs
+        else:
+            self.measuredAcquisitionMs = ((1.0 - self.acquisitionSmoothing) * self.measuredAcquisitionMs +
+                                          self.acquisitionSmoothing * acquisitionMs)
+
+    def predictScanDuration(self, waypoints, acquisitionMs, pipelined=False):
+        # seconds, including the acquisition at every stop
+        moves = self.moveModel.moveTimes(waypoints)
+        acquisition = acquisitionMs / 1000.0
+        if pipelined:
+            return float(np.maximum(moves, acquisition).sum() + acquisition)
+        return float(moves.sum() + acquisition * len(waypoints))
+
+    @traced("plan resolution", "planning")
+    def planScanResolution(self, xMin, xMax, yMin, yMax, budgetSeconds, acquisitionMs, pipelined=False,
+                           minimumResolution=0.1):
+        # finest square grid spacing (rounded up to 0.01 mm) scanning the ROI within budgetSeconds, None if even one stop per
+        # corner does not fit
+        def duration(resolution):
+            # the stops the step scan actually moves to, controlledXYMovement sends them to 0.01 mm
+            waypoints = np.round(self.rasterWaypoints(xMin, xMax, yMin, yMax, resolution, resolution), 2)
+            return waypoints, self.predictScanDuration(waypoints, acquisitionMs, pipelined)
+        minimumResolution = max(minimumResolution, 0.01)
+        coarsest = max(xMax - xMin, yMax - yMin, minimumResolution)
+        if duration(coarsest)[1] > budgetSeconds:
+            return None
+        low, high = minimumResolution, coarsest
+        if duration(low)[1] <= budgetSeconds:
+            high = low
+        while high - low > 0.005:
+            middle = (low + high) / 2.0
+            if duration(middle)[1] <= budgetSeconds:
+                high = middle
+            else:
+                low = middle
+        resolution = math.ceil(high * 100 - 1e-6) / 100.0
+        waypoints, seconds = duration(resolution)
+        while seconds > budgetSeconds and resolution < coarsest:
+            # the grid is not strictly monotonic in its spacing, step up until the rounded spacing fits again
+            resolution = resolution + 0.01
+            waypoints, seconds = duration(resolution)
+        return resolution, waypoints, seconds
+
+                                                                # G-code Program Streaming
+
+    # The whole scan is compiled into one G-code program (explicit feed rates, one G1 X Y per stop, M400 + M118 markers at each
+    # acquisition point) and streamed with line numbers and checksums, several lines in flight at once. The M118 echo tells us the
+    # printer has reached the stop. Without a dwell in the program the stream holds at each marker until the acquisition is done.
+
+    def streamScanProgram(self, waypoints, feedRate, dwellMs, acquireCallback):
+        self.programWaypoints = np.asarray(waypoints, dtype=float)
+        self.programLines, acquisitionLines = self.programCompiler.compile(self.programWaypoints, feedRate, dwellMs)
+        self.programStopOfLine = dict((lineIndex, stopIndex) for stopIndex, lineIndex in enumerate(acquisitionLines))
+        self.programHoldAtAcquisition = dwellMs <= 0
+        self.programAcquireCallback = acquireCallback
+        self.programNextLine = 0
+        self.programBarrierLine = None
+        self.programStreamActive = True
+        self.startScanProgress(len(self.programWaypoints), 0)
+        self.dispatchProgramLines()
+
+    def stopProgramStream(self):
+        self.programStreamActive = False
+
+    def dispatchProgramLines(self):
+        while (self.programStreamActive and self.programFreeCmds and self.programBarrierLine is None and
+               self.programNextLine < len(self.programLines)):
+            lineIndex = self.programNextLine
+            programCmd = self.programFreeCmds.pop()
+            programCmd.SetCommandAttribute('Text', self.programCompiler.numberLine(lineIndex, self.programLines[lineIndex]))
+            self.programLineOfCmd[programCmd] = lineIndex
+            self.sendCommand(programCmd)
+            self.programNextLine = self.programNextLine + 1
+            if self.programHoldAtAcquisition and lineIndex in self.programStopOfLine:
+                self.programBarrierLine = lineIndex
+        if (self.programStreamActive and self.programNextLine >= len(self.programLines) and
+                len(self.programFreeCmds) == self.programMaxInFlight):
+            self.programStreamActive = False
+            print "G-code program complete."
+
+    def onProgramLineCompleted(self, programCmd):
+        lineIndex = self.programLineOfCmd.pop(programCmd, None)
+        self.programFreeCmds.append(programCmd)
+        if programCmd in self.programStaleCmds:
+            # the firmware dropped this line after the one it asked to be resent, it has not run and is sent again
+            self.programStaleCmds.discard(programCmd)
+            self.dispatchProgramLines()
+            return
+        if not self.programStreamActive or lineIndex is None:
+            return
+        if programCmd.GetStatus() != programCmd.CommandSuccess:
+            logging.error("G-code program stopped at line {0} ({1}), status {2}".format(
+                lineIndex, self.programLines[lineIndex], programCmd.StatusToString(programCmd.GetStatus())))
+            self.programStreamActive = False
+            return
+        response = programCmd.GetResponseMessage() + " " + programCmd.GetResponseText()
+        resendLine = self.programCompiler.resendRequest(response)
+        if resendLine is not None:
+            # the firmware rejected a line (checksum or line number), everything from that line is sent again
+            logging.warning("Printer requested resend from line {0}".format(resendLine))
+            self.programNextLine = min(self.programNextLine, resendLine)
+            self.programStaleCmds.update(cmd for cmd, line in self.programLineOfCmd.items() if line >= resendLine)
+            if self.programBarrierLine is not None and self.programBarrierLine >= resendLine:
+                self.programBarrierLine = None
+        elif lineIndex in self.programStopOfLine:
+            stopIndex = self.programStopOfLine[lineIndex]
+            xcoordinate, ycoordinate = self.programWaypoints[stopIndex, :2]
+            self.commandedXcoordinate = xcoordinate
+            self.commandedYcoordinate = ycoordinate
+            self.programAcquireCallback(stopIndex, xcoordinate, ycoordinate)
+            if not self.programHoldAtAcquisition:
+                self.scanProgress.stopCompleted()
+        self.dispatchProgramLines()
+
+    def programAcquisitionDone(self):
+        if self.programHoldAtAcquisition:
+            self.scanProgress.stopCompleted()
+            self.programBarrierLine = None
+            self.dispatchProgramLines()
+
+                                                                # Fly Scan
+
+    # Rows are swept at a constant feed rate instead of stopping at every point. Every frame written to the output array during a
+    # sweep is timestamped, M114 at both ends of the row gives the observed start and end positions, and each frame is placed by
+    # interpolating along the row between them. Frames are then binned at the x resolution into a dense line scan grid of
+    # spectrum differences (flyScanGrid, one row per sweep, NaN where a bin received no frame).
+
+    def startFlyScan(self, outputArrayNode, xMin, xMax, yMin, yMax, xResolution, yResolution, feedRate):
+        if self.spectraCollected == 0:
+            print " Error: reference spectrum not collected."
+            return
+        self.flyScanArrayNode = outputArrayNode
+        self.flyScanFeedRate = feedRate
+        self.flyScanBounds = (xMin, xMax)
+        self.flyScanBinWidth = float(xResolution)
+        self.flyScanRows = []
+        for rowIndex, ycoordinate in enumerate(np.arange(yMin, yMax + 0.5 * yResolution, float(yResolution))):
+            if rowIndex % 2 == 0:
+                self.flyScanRows.append((xMin, xMax, ycoordinate))
+            else:
+                self.flyScanRows.append((xMax, xMin, ycoordinate))
+        numberOfBins = int(math.ceil((xMax - xMin) / self.flyScanBinWidth)) + 1
+        self.flyScanGrid = np.full((len(self.flyScanRows), numberOfBins), np.nan)
+        self.flyScanFrames = []
+        self.flyScanRowIndex = 0
+        self.flyScanActive = True
+        self.startScanProgress(len(self.flyScanRows), 0)
+        self.approachFlyScanRow()
+
+    def stopFlyScan(self):
+        self.flyScanActive = False
+        self.stopFlyScanRecording()
+
+    def sendMove(self, xcoordinate, ycoordinate, feedRate):
+        self.printerControlCmd.SetCommandAttribute('Text', 'G1 X%.2f Y%.2f F%d' % (xcoordinate, ycoordinate, feedRate))
+        self.sendCommand(self.printerControlCmd)
+        self.commandedXcoordinate = xcoordinate
+        self.commandedYcoordinate = ycoordinate
+
+    def approachFlyScanRow(self):
+        if self.flyScanRowIndex >= len(self.flyScanRows):
+            self.flyScanActive = False
+            print "Fly scan complete."
+            return
+        xStart, xEnd, ycoordinate = self.flyScanRows[self.flyScanRowIndex]
+        self.flyScanPhase = 'approach'
+        self.sendMove(xStart, ycoordinate, self.travelFeedRate)
+        self.sendCommand(self.flyScanSyncCmd)
+
+    def onFlyScanSyncCmd(self, observer, eventid):
+        if not self.flyScanActive:
+            return
+        if self.flyScanSyncCmd.GetStatus() != self.flyScanSyncCmd.CommandSuccess:
+            logging.error("Fly scan stopped, M400 failed with status " +
+                          self.flyScanSyncCmd.StatusToString(self.flyScanSyncCmd.GetStatus()))
+            self.stopFlyScan()
+            return
+        if self.flyScanPhase == 'sweep':
+            self.flyScanSweepEndTime = time.time()
+            self.stopFlyScanRecording()
+        # observed row end points come from M114, the row is swept once the start point is known
+        self.sendCommand(self.flyScanPositionCmd)
+
+    def onFlyScanPositionCmd(self, observer, eventid):
+        if not self.flyScanActive:
+            return
+        if self.flyScanPositionCmd.GetStatus() != self.flyScanPositionCmd.CommandSuccess:
+            logging.error("Fly scan stopped, M114 failed with status " +
+                          self.flyScanPositionCmd.StatusToString(self.flyScanPositionCmd.GetStatus()))
+            self.stopFlyScan()
+            return
+        mylist = self.flyScanPositionCmd.GetResponseMessage().split(" ")
+        xcoordinate, ycoordinate, zcoordinate = self.parseCoords(mylist)
+        if self.flyScanPhase == 'approach':
+            xStart, xEnd, rowY = self.flyScanRows[self.flyScanRowIndex]
+            self.flyScanObservedStart = xcoordinate
+            self.flyScanRowFrames = []
+            self.flyScanObserverTag = self.flyScanArrayNode.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onFlyScanFrame)
+            self.flyScanPhase = 'sweep'
+            self.flyScanSweepStartTime = time.time()
+            self.sendMove(xEnd, rowY, self.flyScanFeedRate)
+            self.sendCommand(self.flyScanSyncCmd)
+        else:
+            self.finishFlyScanRow(xcoordinate)
+            self.scanProgress.stopCompleted()
+            self.flyScanRowIndex = self.flyScanRowIndex + 1
+            self.approachFlyScanRow()
+
+    def onFlyScanFrame(self, observer, eventid):
+        self.flyScanRowFrames.append((time.time(), self.getSpectrumIntensities(self.flyScanArrayNode)))
+
+    def stopFlyScanRecording(self):
+        if self.flyScanObserverTag is not None:
+            self.flyScanArrayNode.RemoveObserver(self.flyScanObserverTag)
+            self.flyScanObserverTag = None
+
+    def finishFlyScanRow(self, observedEnd):
+        xStart, xEnd, ycoordinate = self.flyScanRows[self.flyScanRowIndex]
+        if not self.flyScanRowFrames:
+            logging.warning("Fly scan row at y = {0} received no spectra".format(ycoordinate))
+            return
+        timestamps = np.array([frame[0] for frame in self.flyScanRowFrames])
+        spectra = np.array([frame[1] for frame in self.flyScanRowFrames])
+        xPositions = self.interpolateSweepPositions(timestamps, self.flyScanSweepStartTime, self.flyScanSweepEndTime,
+                                                    self.flyScanObservedStart, observedEnd, self.flyScanFeedRate)
+        differences = self.spectrumDifferences(spectra)
+        self.flyScanFrames.append((timestamps, xPositions, np.full(len(timestamps), ycoordinate), differences))
+
+        means, counts = self.binSweepFrames(xPositions, differences, self.flyScanBounds[0], self.flyScanBinWidth,
+                                            self.flyScanGrid.shape[1])
+        rowValues = self.flyScanGrid[self.flyScanRowIndex]
+        rowValues[counts > 0] = means[counts > 0]
+
+        binsWithFrames = np.nonzero(counts > 0)[0]
+        tumorBins = np.abs(rowValues[binsWithFrames]) < self.spectrumThreshold
+        binPositions = np.column_stack((self.flyScanBounds[0] + binsWithFrames * self.flyScanBinWidth,
+                                        np.full(len(binsWithFrames), ycoordinate), np.full(len(binsWithFrames), self.zcoordinate)))
+        self.scanPoints.appendMany(binPositions, tumorBins, rowValues[binsWithFrames])
+        self.requestScanPointModelUpdate()
+        for binIndex in np.nonzero(np.abs(rowValues) < self.spectrumThreshold)[0]:
+            self.markScanPoint(self.flyScanBounds[0] + binIndex * self.flyScanBinWidth, ycoordinate, self.zcoordinate)
+
+    def binSweepFrames(self, xPositions, differences, xStart, binWidth, numberOfBins):
+        # mean statistic and number of frames of each bin along the row, NaN where a bin received no frame
+        bins = np.clip(np.round((xPositions - xStart) / binWidth).astype(int), 0, numberOfBins - 1)
+        sums = np.bincount(bins, weights=differences, minlength=numberOfBins)
+        counts = np.bincount(bins, minlength=numberOfBins)
+        means = np.full(numberOfBins, np.nan)
+        means[counts > 0] = sums[counts > 0] / counts[counts > 0]
+        return means, counts
+
+    def interpolateSweepPositions(self, timestamps, startTime, endTime, observedStart, observedEnd, feedRate):
+        # The commanded trajectory runs at feedRate from observedStart to observedEnd, the time the printer needed on top of
+        # that (command latency, acceleration) is split evenly between both ends of the row.
+        nominalDuration = abs(observedEnd - observedStart) / (feedRate / 60.0)
+        if nominalDuration <= 0:
+            return np.full(len(timestamps), float(observedStart))
+        overhead = max((endTime - startTime) - nominalDuration, 0.0)
+        return np.interp(timestamps, [startTime + overhead / 2.0, endTime - overhead / 2.0], [observedStart, observedEnd])
+
+                                                                # Kinematic Timed Scan
+
+    # Timed scans scheduled from the move model: each move is sent once the previous stop has dwelled, and the tissue decision runs
+    # when the move model says the probe has arrived plus the dwell. Long moves get more time and short moves no padding.
+
+    @traced("schedule timed scan", "planning")
+    def scheduleTimedScan(self, waypoints, dwellMs, decisionCallback):
+        waypoints = np.asarray(waypoints, dtype=float)
+        moveStart = waypoints[:1]
+        if self.commandedXcoordinate is not None and self.commandedYcoordinate is not None:
+            moveStart = np.array([[self.commandedXcoordinate, self.commandedYcoordinate]], dtype=float)
+        path = np.vstack((moveStart, waypoints))
+        issueTimesMs = 1000 * self.moveModel.issueTimes(path, dwellMs / 1000.0)
+        decisionTimesMs = issueTimesMs + 1000 * self.moveModel.moveTimes(path) + dwellMs
+        self.startScanProgress(len(waypoints), np.mean(np.diff(np.concatenate(([0], decisionTimesMs)))))
+        decisionTimer = qt.QTimer()
+        # the timing only holds at the feed rate the model assumes, not whatever F the printer was left at
+        feedRate = self.moveModel.commandFeedRate()
+        for i in xrange(len(waypoints)):
+            self.xyMovement(waypoints[i, 0], waypoints[i, 1], int(issueTimesMs[i]), feedRate)
+            decisionTimer.singleShot(int(decisionTimesMs[i]), decisionCallback)
+        return decisionTimesMs[-1]
 
                                                                 # Systematic Scanning Scheme
 
@@ -816,6 +3042,7 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
     # Delays for scanning movement are developed to execute incremental delays, the mathematical expressions are dependent on the loop iterator.
     # Systematic scan occurs in a rectangular grid pattern
 
+    @traced("schedule y loop", "planning")
     def yLoop(self, mvmtDelay, yResolution, xResolution):
         i = 0
         j = 0
@@ -845,6 +3072,7 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
                 self.yMovement(delayMs, yValue)
                 j = j + 1
 
+    @traced("schedule x loop", "planning")
     def xLoop(self, mvmtDelay, xResolution, yResolution):
         oscillatingTime = (120 / yResolution) / 2  
         xOscillation = ((120 / xResolution) * 2) * mvmtDelay  
@@ -879,7 +3107,7 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
     # From the boundaries, the ROI is selected and a systematic grid scan is executed.
 
     def getBoundaryFiducialsCoordinate(self):
-        slicer.modules.openigtlinkremote.logic().SendCommand(self.boundaryCoordinateCmd, self.serialIGTLNode.GetID())
+        self.sendCommand(self.boundaryCoordinateCmd)
 
     def onBoundaryCoordinateCmd(self, observer, eventid):
         coordinateValues = self.boundaryCoordinateCmd.GetResponseMessage()
@@ -910,6 +3138,7 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
         self.fiducialNode2.AddFiducial(xcoordinate, ycoordinate, zcoordinate)
         self.boundFidIndex = self.boundFidIndex + 1
 
+    @traced("ROI bounds", "planning")
     def ROIBoundarySearch(self):
         ILfidList = slicer.util.getNode('BoundaryPoints')
         if not ILfidList:
@@ -917,6 +3146,8 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
             return False
         else:
             numFids = ILfidList.GetNumberOfFiducials()
+            self._ROIxbounds = []
+            self._ROIybounds = []
 
             for i in xrange(numFids):
                 ras = [0, 0, 0]
@@ -1015,16 +3246,67 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
             self.j = self.j + 1
 
 
-    def contour_pattern(self):
-        pattern = np.load("C:\Users\lconnolly\Desktop\use_this_tissue_scanning/transformed pts.npy")
-        patternTimer = qt.QTimer()
-        timevar = 0
-        for j in range(0,len(pattern)):
-            x = pattern[j][0]
-            y = pattern[j][1]
-            self.xyMovement(x,y, timevar)
-            patternTimer.singleShot(timevar, lambda: self.tissueDecision())
-            timevar = timevar + 1000
+                    # Pattern Following
+        # Patterns are loaded from npy (memory mapped), CSV or markups files, mapped into printer space with a linear transform
+        # (e.g. ReferenceImageToOpticalModel) one chunk at a time, clipped to the bed and streamed into the step scan.
+
+    def loadPattern(self, path):
+        extension = os.path.splitext(path)[1].lower()
+        if extension == ".npy":
+            pattern = np.load(path, mmap_mode='r')
+        elif extension == ".fcsv":
+            # markups CSV: id, x, y, z, ...
+            pattern = np.loadtxt(path, delimiter=',', comments='#', usecols=(1, 2, 3), ndmin=2)
+        elif extension == ".json":
+            with open(path) as markupsFile:
+                markups = json.load(markupsFile)
+            pattern = np.array([controlPoint['position'] for markup in markups['markups']
+                                for controlPoint in markup['controlPoints']], dtype=float)
+        else:
+            pattern = np.genfromtxt(path, delimiter=',', comments='#')
+            pattern = np.atleast_2d(pattern)
+            pattern = pattern[~np.isnan(pattern[:, :2]).any(axis=1)]  # header lines
+        if pattern.ndim != 2 or pattern.shape[1] < 2:
+            raise ValueError("Pattern file {0} does not contain (x, y) points".format(path))
+        return pattern
+
+    def transformMatrixFromNode(self, transformNode):
+        vtkMatrix = vtk.vtkMatrix4x4()
+        transformNode.GetMatrixTransformToWorld(vtkMatrix)
+        return np.array([[vtkMatrix.GetElement(row, column) for column in xrange(4)] for row in xrange(4)])
+
+    def transformPatternChunks(self, pattern, transformNode=None, chunkSize=4096):
+        # one matrix multiply per chunk, points outside the bed are clipped to its limits
+        matrix = None
+        if transformNode is not None:
+            matrix = self.transformMatrixFromNode(transformNode)
+        for start in xrange(0, len(pattern), chunkSize):
+            points = np.zeros((min(chunkSize, len(pattern) - start), 3))
+            chunk = np.asarray(pattern[start:start + chunkSize], dtype=float)
+            points[:, :min(chunk.shape[1], 3)] = chunk[:, :3]
+            if matrix is not None:
+                points = np.dot(points, matrix[:3, :3].T) + matrix[:3, 3]
+            yield np.clip(points[:, :2], 0, self.bedSize)
+
+    def followPattern(self, path, transformNode, acquireCallback, optimizeOrder=False):
+        pattern = self.loadPattern(path)
+        waypoints = self.transformPatternChunks(pattern, transformNode)
+        if optimizeOrder:
+            # the optimizer needs every point, so the pattern is no longer streamed
+            waypoints = self.optimizeWaypointOrder(np.vstack(list(waypoints)))
+        self.startStepScan(waypoints, acquireCallback, len(pattern))
+
+    @traced("optimize path", "planning")
+    def optimizeWaypointOrder(self, waypoints):
+        # the tour starts from the last commanded position when it is known
+        start = np.array([[self.commandedXcoordinate or 0, self.commandedYcoordinate or 0]], dtype=float)
+        points = np.vstack((start, waypoints[:, :2]))
+        order = self.pathOptimizer.optimize(points, 0)
+        before = self.pathOptimizer.travelTime(points)
+        after = self.pathOptimizer.travelTime(points[order])
+        print "Path optimized: estimated travel time {0:.1f} s (was {1:.1f} s) for {2} points.".format(
+            after, before, len(waypoints))
+        return waypoints[order[1:] - 1]
 
         
 
@@ -1053,41 +3335,45 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
     # saved in a polydata point in the get_coordinates function. After the scan, if the user selects contour trace, the z axis is lowered 5 mm and the probe with then move to trace the
     #convex hull of the previously collected data points.
 
-    def createPolyDataPoint(self, xcoordinate, ycoordinate, zcoordinate):
-        if self.firstDataPointGenerated < 1:
-            self.firstDataPointGenerated = self.firstDataPointGenerated + 1
-            self.pointsForHull.InsertNextPoint(xcoordinate, ycoordinate, zcoordinate)
-        else:
-            self.pointsForHull.InsertNextPoint(xcoordinate, ycoordinate, zcoordinate)
-
     def convexHull(self):
-
+        # hull of the points classified as tumor in this scan session
         self.hullPolydata = vtk.vtkPolyData()
-        self.hullPolydata.SetPoints(self.pointsForHull)
+        self.hullPolydata.SetPoints(self.scanPoints.vtkPoints(self.scanPoints.labels() == 1))
 
         hull = vtk.vtkConvexHull2D()
         hull.SetInputData(self.hullPolydata)
         hull.Update()
 
         pointLimit = hull.GetOutput().GetNumberOfPoints()
+        if pointLimit == 0:
+            print "Error: no tumor points collected."
+            return
+        self.pointsForEdgeTracing.Reset()
+        self._xHullArray = []
+        self._yHullArray = []
         for i in xrange(0, pointLimit):
             self.pointsForEdgeTracing.InsertNextPoint(hull.GetOutput().GetPoint(i))
         self.getCoordinatesForEdgeTracing(self.pointsForEdgeTracing, pointLimit)
 
     def getCoordinatesForEdgeTracing(self, pointsForEdgeTracing, pointLimit):
-
+        # Each hull point is visited when the move model says the previous move has finished, the tour is closed on the first point
+        hullPoints = np.array([pointsForEdgeTracing.GetPoint(i)[:2] for i in xrange(0, pointLimit)])
+        tour = np.vstack((hullPoints, hullPoints[:1]))
+        moveStart = tour[:1]
+        if self.commandedXcoordinate is not None and self.commandedYcoordinate is not None:
+            moveStart = np.array([[self.commandedXcoordinate, self.commandedYcoordinate]], dtype=float)
+        issueTimesMs = self.edgeTracingTimerStart + 1000 * self.moveModel.issueTimes(np.vstack((moveStart, tour)),
+                                                                                  self.edgeTracingDwellMs / 1000.0)
         for i in xrange(0, pointLimit):
-            pointVal = pointsForEdgeTracing.GetPoint(i)
-            xcoordinate = pointVal[0]
-            ycoordinate = pointVal[1]
+            xcoordinate, ycoordinate = hullPoints[i]
             self._xHullArray.append(xcoordinate)
             self._yHullArray.append(ycoordinate)
-            self.slowEdgeTracing(xcoordinate, ycoordinate, self.edgeTracingTimerStart)
-
-            self.edgeTracingTimerStart = self.edgeTracingTimerStart + 2000
-        self.slowEdgeTracing(self._xHullArray[0], self._yHullArray[0], (2000 * pointLimit + 2000))
+            self.slowEdgeTracing(xcoordinate, ycoordinate, int(issueTimesMs[i]))
+        self.slowEdgeTracing(self._xHullArray[0], self._yHullArray[0], int(issueTimesMs[pointLimit]))
+        tourEndMs = issueTimesMs[pointLimit] + 1000 * self.moveModel.moveTimes(tour[-2:])[0]
+        self.edgeTracingTimerStart = int(tourEndMs)
         self.ZMovement(2000, -5)
-        self.ZMovement(2000 * pointLimit + 4000, 0)
+        self.ZMovement(int(tourEndMs + self.edgeTracingDwellMs), 0)
 
                                         # Contour Tracing - Independent of Systematic Scan
 
@@ -1158,20 +3444,22 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
             # go right, back, left, forward until you determine which quadrant to continue in
         self.printTimer = qt.QTimer()
         index = len(self._savexcoordinate) - 1
-
-        self.callMovement(1000, (self._savexcoordinate[index] + quadrantResolution), (self._saveycoordinate[index]))
-        self.readCoordinatesAtTimeInterval2(2000, outputArrayNode)
-
-        self.callMovement(2000, (self._savexcoordinate[index]), (self._saveycoordinate[index] - quadrantResolution))
-        self.readCoordinatesAtTimeInterval2(3000, outputArrayNode)
-
-        self.callMovement(3000, (self._savexcoordinate[index] - quadrantResolution), (self._saveycoordinate[index]))
-        self.readCoordinatesAtTimeInterval2(4000, outputArrayNode)
-
-        self.callMovement(4000, (self._savexcoordinate[index]), (self._saveycoordinate[index] + quadrantResolution))
-        self.readCoordinatesAtTimeInterval2(5000, outputArrayNode)
-
-        self.callMovement(5000, (self._savexcoordinate[index]), (self._saveycoordinate[index]))
+        xOrigin = self._savexcoordinate[index]
+        yOrigin = self._saveycoordinate[index]
+        quadrantOffsets = [(quadrantResolution, 0), (0, -quadrantResolution), (-quadrantResolution, 0), (0, quadrantResolution)]
+
+        for quadrant in xrange(4):
+            xcoordinate = xOrigin + quadrantOffsets[quadrant][0]
+            ycoordinate = yOrigin + quadrantOffsets[quadrant][1]
+            record = self.cachedClassification(xcoordinate, ycoordinate)
+            if record is not None:
+                # already classified near here, reuse the label instead of probing again
+                self.appendCachedTumorCheck(2000 + 1000 * quadrant, record)
+                continue
+            self.callMovement(1000 + 1000 * quadrant, xcoordinate, ycoordinate)
+            self.readCoordinatesAtTimeInterval2(2000 + 1000 * quadrant, outputArrayNode)
+
+        self.callMovement(5000, xOrigin, yOrigin)
 
         self.startTrajectorySearch(outputArrayNode, quadrantResolution)
         self.timerTracker = self.timerTracker + 6000
@@ -1252,7 +3540,7 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
     # and check volume reslice driver.
 
     def getLandmarkFiducialsCoordinate(self):
-        slicer.modules.openigtlinkremote.logic().SendCommand(self.landmarkCoordinateCmd, self.serialIGTLNode.GetID())
+        self.sendCommand(self.landmarkCoordinateCmd)
 
     def onLandmarkCoordinateCmd(self, observer, eventid):
         coordinateValues = self.landmarkCoordinateCmd.GetResponseMessage()
@@ -1281,105 +3569,67 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
     def addToLandmarkFiducialNode(self, xcoordinate, ycoordinate, zcoordinate):
         self.fiducialNode1.AddFiducial(xcoordinate, ycoordinate, zcoordinate)
 
-    def ICPRegistration(self):
-        ILfidList = slicer.util.getNode("ImageLandmarkPoints")
-        numFids = ILfidList.GetNumberOfFiducials()
-        MLfidList = slicer.util.getNode("ModelLandmarkPoints")
-
-        self.ILData = vtk.vtkPoints()
-        for i in xrange(numFids):
-            ras = [0, 0, 0]
-            pos = ILfidList.GetNthFiducialPosition(i, ras)
-            world = [0, 0, 0, 0]
-            ILfidList.GetNthFiducialWorldCoordinates(0, world)
-            self.ILData.InsertNextPoint(ras[0], ras[1], ras[2])
-
-        self.MLData = vtk.vtkPoints()
+    def fiducialPositions(self, fidList):
+        # positions of all fiducials of a markups node as a (n, 3) array
+        numFids = fidList.GetNumberOfFiducials()
+        positions = np.zeros((numFids, 3))
         for i in xrange(numFids):
-            ras = [0, 0, 0]
-            pos = MLfidList.GetNthFiducialPosition(i, ras)
-            world = [0, 0, 0, 0]
-            MLfidList.GetNthFiducialWorldCoordinates(0, world)
-            self.MLData.InsertNextPoint(ras[0], ras[1], ras[2])
-
-        self.ILPointsData = vtk.vtkPolyData()
-        self.ILPointsData.SetPoints(self.ILData)
-
-        self.MLPointsData = vtk.vtkPolyData()
-        self.MLPointsData.SetPoints(self.MLData)
-
-        source = self.ILPointsData
-        target = self.MLPointsData
-
-        icp = vtk.vtkIterativeClosestPointTransform()
-        icp.SetSource(source)
-        icp.SetTarget(target)
-        icp.DebugOn()
-        icp.SetMaximumNumberOfLandmarks(source.GetNumberOfPoints())
-        icp.SetCheckMeanDistance(1)
-        icp.SetMaximumMeanDistance(0.00000001)
-        icp.GetLandmarkTransform().SetModeToSimilarity()
-        icp.StartByMatchingCentroidsOn()
-        icp.SetMaximumNumberOfIterations(200)
-        icp.GetLandmarkTransform().SetSourceLandmarks(self.ILData)
-        icp.GetLandmarkTransform().SetTargetLandmarks(self.MLData)
-        icp.Modified()
-
+            fidList.GetNthFiducialPosition(i, positions[i])
+        return positions
+
+    def pointSetFromNode(self, node):
+        # model nodes (dense optical surface scans) or markups fiducial lists
+        if node.IsA("vtkMRMLModelNode"):
+            return numpy_support.vtk_to_numpy(node.GetPolyData().GetPoints().GetData()).astype(float)
+        return self.fiducialPositions(node)
+
+    def createRegistrationTransformNode(self, matrix):
+        vtkMatrix = vtk.vtkMatrix4x4()
+        for row in xrange(4):
+            for column in xrange(4):
+                vtkMatrix.SetElement(row, column, matrix[row, column])
         transformNode = slicer.vtkMRMLLinearTransformNode()
-        transformNode.CanApplyNonLinearTransforms()
         transformNode.SetName('ReferenceImageToOpticalModel')
-        matrix = icp.GetLandmarkTransform().GetMatrix()
-        transformNode.SetMatrixTransformToParent(matrix)
-
+        transformNode.SetMatrixTransformToParent(vtkMatrix)
         slicer.mrmlScene.AddNode(transformNode)
-        print "ICP registration Complete."
+        return transformNode
+
+    def ICPRegistration(self, sourceNode=None, targetNode=None):
+        # Source and target may have any number of points, correspondences are found by nearest neighbour search
+        if sourceNode is None:
+            sourceNode = slicer.util.getNode("ImageLandmarkPoints")
+        if targetNode is None:
+            targetNode = slicer.util.getNode("ModelLandmarkPoints")
+        source = self.pointSetFromNode(sourceNode)
+        target = self.pointSetFromNode(targetNode)
+        if len(source) < 3 or len(target) < 3:
+            print "Error: ICP registration needs at least 3 points in each point set."
+            return None
+
+        matrix, rmsDistance, iterations = self.registration.icp(source, target)
+        self.registrationErrors = {'ICPRMS': rmsDistance, 'iterations': iterations}
+        transformNode = self.createRegistrationTransformNode(matrix)
+        print "ICP registration Complete. RMS distance {0:.3f} mm after {1} iterations.".format(rmsDistance, iterations)
+        return transformNode
 
     def landmarkRegistration(self):
         ILfidList = slicer.util.getNode("ImageLandmarkPoints")
-        numFids = ILfidList.GetNumberOfFiducials()
         MLfidList = slicer.util.getNode("ModelLandmarkPoints")
-
-        self.ILData = vtk.vtkPoints()
-        for i in xrange(numFids):
-            ras = [0, 0, 0]
-            pos = ILfidList.GetNthFiducialPosition(i, ras)
-            world = [0, 0, 0, 0]
-            ILfidList.GetNthFiducialWorldCoordinates(0, world)
-            self.ILData.InsertNextPoint(ras[0], ras[1], ras[2])
-
-        self.MLData = vtk.vtkPoints()
-        for i in xrange(numFids):
-            ras = [0, 0, 0]
-            pos = MLfidList.GetNthFiducialPosition(i, ras)
-            world = [0, 0, 0, 0]
-            MLfidList.GetNthFiducialWorldCoordinates(0, world)
-            self.MLData.InsertNextPoint(ras[0], ras[1], ras[2])
-
-        self.ILPointsData = vtk.vtkPolyData()
-        self.ILPointsData.SetPoints(self.ILData)
-
-        self.MLPointsData = vtk.vtkPolyData()
-        self.MLPointsData.SetPoints(self.MLData)
-
-        source = self.ILData
-        target = self.MLData
-
-        lmt = vtk.vtkLandmarkTransform()
-        lmt.SetSourceLandmarks(source)
-        source.Modified()
-        lmt.SetTargetLandmarks(target)
-        target.Modified()
-        lmt.SetModeToSimilarity()
-        lmt.TransformPoints(source, target)
-
-        transformNode = slicer.vtkMRMLLinearTransformNode()
-        transformNode.SetName('ReferenceImageToOpticalModel')
-        transformNode.CanApplyNonLinearTransforms()
-        matrix = lmt.GetMatrix()
-        transformNode.SetMatrixTransformToParent(matrix)
-
-        slicer.mrmlScene.AddNode(transformNode)
-        print "Landmark Transform completed succesfully."
+        source = self.fiducialPositions(ILfidList)
+        target = self.fiducialPositions(MLfidList)
+        if len(source) != len(target) or len(source) < 3:
+            print "Error: landmark registration needs the same number (at least 3) of image and model landmarks."
+            return None
+
+        matrix = self.registration.similarityTransform(source, target)
+        residuals = self.registration.residuals(matrix, source, target)
+        self.registrationErrors = {'residuals': residuals,
+                                   'FRE': math.sqrt(np.mean(residuals ** 2)),
+                                   'TRE': self.registration.leaveOneOutErrors(source, target)}
+        transformNode = self.createRegistrationTransformNode(matrix)
+        print "Landmark Transform completed succesfully. FRE {0:.3f} mm, leave-one-out TRE {1:.3f} mm.".format(
+            self.registrationErrors['FRE'], math.sqrt(np.mean(self.registrationErrors['TRE'] ** 2)))
+        return transformNode
 
     # Image Registration functions
     #def callFollowFiducials(self):
@@ -1425,7 +3675,7 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
     def emergencyStop(self):
         # Writes to the printer to automatically stop all motors
         # Requires reboot
-        slicer.modules.openigtlinkremote.logic().SendCommand(self.emergStopCmd, self.serialIGTLNode.GetID())
+        self.sendCommand(self.emergStopCmd)
         self.emergStopCmd.AddObserver(self.emergStopCmd.CommandCompletedEvent, self.onPrinterCommandCompleted)
 
 
@@ -1441,9 +3691,9 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
         self.edgetimer = qt.QTimer()
         self.edgetimer.singleShot(timevar, lambda: self.get(xcoordinate, ycoordinate))
 
-    def xyMovement(self, xcoordinate, ycoordinate, timevar):
+    def xyMovement(self, xcoordinate, ycoordinate, timevar, feedRate=None):
         self.scanTimer = qt.QTimer()
-        self.scanTimer.singleShot(timevar, lambda: self.controlledXYMovement(xcoordinate, ycoordinate))
+        self.scanTimer.singleShot(timevar, lambda: self.controlledXYMovement(xcoordinate, ycoordinate, feedRate))
     
     
 
@@ -1451,21 +3701,75 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
         self.scanTimer = qt.QTimer()
         self.scanTimer.singleShot(mvmtDelay, lambda: self.controlledZMovement(zcoordinate))
 
-    def controlledXYMovement(self, xcoordinate, ycoordinate):
-        self.xyControlCmd.SetCommandAttribute('Text', 'G1 X%d Y%d' % (xcoordinate, ycoordinate))
-        slicer.modules.openigtlinkremote.logic().SendCommand(self.xyControlCmd, self.serialIGTLNode.GetID())
+    # Moves go through a small command layer that remembers the last commanded position and drops moves to where the printer
+    # already is. Separate X and Y moves that arrive within moveCoalesceWindowMs of each other (the timer chains of the rectilinear
+    # scans fire them at the same time) are fused into one diagonal G1, nothing is measured in between so the stops are unchanged.
+    # An axis that already has a pending move is flushed first so no intermediate stop is ever skipped.
+
+    def controlledXYMovement(self, xcoordinate, ycoordinate, feedRate=None):
+        # step scans and patterns move to 0.01 mm, like sendMove
+        self.flushPendingMove()
+        self.sendMoveCommand(round(xcoordinate, 2), round(ycoordinate, 2), feedRate)
 
     def controlledXMovement(self, xCoordinate):  # x movement
-        self.xControlCmd.SetCommandAttribute('Text', 'G1 X%d' % (xCoordinate))
-        slicer.modules.openigtlinkremote.logic().SendCommand(self.xControlCmd, self.serialIGTLNode.GetID())
+        self.queueMove(int(round(xCoordinate)), None)
 
     def controlledYMovement(self, yCoordinate):  # y movement
-        self.yControlCmd.SetCommandAttribute('Text', 'G1 Y%d' % (yCoordinate))
-        slicer.modules.openigtlinkremote.logic().SendCommand(self.yControlCmd, self.serialIGTLNode.GetID())
+        self.queueMove(None, int(round(yCoordinate)))
+
+    def queueMove(self, xCoordinate, yCoordinate):
+        if (xCoordinate is not None and self.pendingMoveX is not None) or (
+                yCoordinate is not None and self.pendingMoveY is not None):
+            self.flushPendingMove()
+        if xCoordinate is not None:
+            self.pendingMoveX = xCoordinate
+        if yCoordinate is not None:
+            self.pendingMoveY = yCoordinate
+        if not self.moveFlushTimer.isActive():
+            self.moveFlushTimer.start(self.moveCoalesceWindowMs)
+
+    def flushPendingMove(self):
+        self.moveFlushTimer.stop()
+        xCoordinate, yCoordinate = self.pendingMoveX, self.pendingMoveY
+        self.pendingMoveX = None
+        self.pendingMoveY = None
+        if xCoordinate is not None or yCoordinate is not None:
+            self.sendMoveCommand(xCoordinate, yCoordinate)
+
+    def sendMoveCommand(self, xCoordinate, yCoordinate, feedRate=None):
+        if xCoordinate is not None and xCoordinate == self.commandedXcoordinate:
+            xCoordinate = None
+        if yCoordinate is not None and yCoordinate == self.commandedYcoordinate:
+            yCoordinate = None
+        if xCoordinate is None and yCoordinate is None:
+            self.droppedMoveCount = self.droppedMoveCount + 1
+            return
+        # %g keeps whole millimetres as before (X10) and writes fractional ones to 0.01 mm (X10.25)
+        feedWord = ''
+        if feedRate is not None:
+            feedWord = ' F%d' % int(round(feedRate))
+        if xCoordinate is not None and yCoordinate is not None:
+            self.xyControlCmd.SetCommandAttribute('Text', 'G1 X%g Y%g%s' % (xCoordinate, yCoordinate, feedWord))
+            self.sendCommand(self.xyControlCmd)
+        elif xCoordinate is not None:
+            self.xControlCmd.SetCommandAttribute('Text', 'G1 X%g%s' % (xCoordinate, feedWord))
+            self.sendCommand(self.xControlCmd)
+        else:
+            self.yControlCmd.SetCommandAttribute('Text', 'G1 Y%g%s' % (yCoordinate, feedWord))
+            self.sendCommand(self.yControlCmd)
+        if xCoordinate is not None:
+            self.commandedXcoordinate = xCoordinate
+        if yCoordinate is not None:
+            self.commandedYcoordinate = yCoordinate
+        self.sentMoveCount = self.sentMoveCount + 1
+
+    def resetMoveStatistics(self):
+        self.sentMoveCount = 0
+        self.droppedMoveCount = 0
 
     def controlledZMovement(self, zcoordinate):
         self.zControlCmd.SetCommandAttribute('Text', 'G1 Z%d' % (zcoordinate))
-        slicer.modules.openigtlinkremote.logic().SendCommand(self.zControlCmd, self.serialIGTLNode.GetID())
+        self.sendCommand(self.zControlCmd)
 
     # specific movement commands for keyboard control, necessary because of serialIGTLNode declaration
     def keyboardControlledXMovementForward(self, serialIGTLNode):  # x movement
@@ -1479,6 +3783,7 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
         self.xControlCmd.SetCommandTimeoutSec(1.0)
         self.xControlCmd.SetCommandAttribute('Text', 'G1 X%d' % (self.currentXcoordinate))
         slicer.modules.openigtlinkremote.logic().SendCommand(self.xControlCmd, serialIGTLNode.GetID())
+        self.commandedXcoordinate = self.currentXcoordinate
 
     def keyboardControlledXMovementBackwards(self, serialIGTLNode):  # x movement
         if self.currentXcoordinate > 1:
@@ -1491,6 +3796,7 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
         self.xControlCmd.SetCommandTimeoutSec(1.0)
         self.xControlCmd.SetCommandAttribute('Text', 'G1 X%d' % (self.currentXcoordinate))
         slicer.modules.openigtlinkremote.logic().SendCommand(self.xControlCmd, serialIGTLNode.GetID())
+        self.commandedXcoordinate = self.currentXcoordinate
 
     def keyboardControlledYMovementForward(self, serialIGTLNode):  # y movement
         if self.currentYcoordinate < 120:
@@ -1503,6 +3809,7 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
         self.yControlCmd.SetCommandTimeoutSec(1.0)
         self.yControlCmd.SetCommandAttribute('Text', 'G1 Y%d' % (self.currentYcoordinate))
         slicer.modules.openigtlinkremote.logic().SendCommand(self.yControlCmd, serialIGTLNode.GetID())
+        self.commandedYcoordinate = self.currentYcoordinate
 
     def keyboardControlledYMovementBackwards(self, serialIGTLNode):  # y movement
         if self.currentYcoordinate > 1:
@@ -1515,6 +3822,7 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
         self.yControlCmd.SetCommandTimeoutSec(1.0)
         self.yControlCmd.SetCommandAttribute('Text', 'G1 Y%d' % (self.currentYcoordinate))
         slicer.modules.openigtlinkremote.logic().SendCommand(self.yControlCmd, serialIGTLNode.GetID())
+        self.commandedYcoordinate = self.currentYcoordinate
 
     def keyboardControlledHomeMovement(self, serialIGTLNode):
         self.yControlCmd = slicer.vtkSlicerOpenIGTLinkCommand()
@@ -1523,6 +3831,1132 @@ class PrinterInteractorLogic(ScriptedLoadableModuleLogic):
         self.yControlCmd.SetCommandTimeoutSec(1.0)
         self.yControlCmd.SetCommandAttribute('Text', 'G28 X Y')
         slicer.modules.openigtlinkremote.logic().SendCommand(self.yControlCmd, serialIGTLNode.GetID())
+        self.commandedXcoordinate = 0
+        self.commandedYcoordinate = 0
+
+
+#
+# ScanProgressModel
+#
+
+class ScanProgressModel(object):
+    """Tracks completed against planned stops of a scan. Event driven scans
+  (stopCostMs 0) re-estimate the remaining time from the measured cost per stop
+  (exponential moving average). Timed scans take their readings on a fixed
+  schedule, so their remaining time is the schedule plus the motion lag found
+  by the last position check. Observers are called with the model after every
+  change, stop observers only when a stop is completed.
+  """
+
+    def __init__(self, smoothing=0.3):
+        self.smoothing = smoothing
+        self.observers = []
+        self.stopObservers = []
+        self.reset(0, 0)
+
+    def reset(self, plannedStops, stopCostMs):
+        self.plannedStops = int(plannedStops)
+        self.completedStops = 0
+        self.nominalStopCostMs = float(stopCostMs)
+        self.measuredStopCostMs = float(stopCostMs)
+        self.startTime = time.time()
+        self.lastStopTime = self.startTime
+        self.lastDriftMm = 0.0
+        self.maxDriftMm = 0.0
+        self.motionLagMs = 0.0
+
+    def addObserver(self, callback):
+        if callback not in self.observers:
+            self.observers.append(callback)
+
+    def removeObserver(self, callback):
+        if callback in self.observers:
+            self.observers.remove(callback)
+
+    def addStopObserver(self, callback):
+        if callback not in self.stopObservers:
+            self.stopObservers.append(callback)
+
+    def notify(self):
+        for callback in list(self.observers):
+            callback(self)
+
+    def stopCompleted(self):
+        now = time.time()
+        stopCostMs = (now - self.lastStopTime) * 1000.0
+        self.lastStopTime = now
+        self.completedStops = self.completedStops + 1
+        if self.nominalStopCostMs <= 0:
+            # only event driven stops are measured, timed stops are spaced by their timers
+            if self.completedStops == 1:
+                self.measuredStopCostMs = stopCostMs
+            else:
+                self.measuredStopCostMs = (1.0 - self.smoothing) * self.measuredStopCostMs + self.smoothing * stopCostMs
+        self.notify()
+        for callback in list(self.stopObservers):
+            callback(self)
+
+    def recordDrift(self, driftMm, lagMs=0.0):
+        self.lastDriftMm = driftMm
+        self.maxDriftMm = max(self.maxDriftMm, driftMm)
+        self.motionLagMs = lagMs
+        self.notify()
+
+    def remainingStops(self):
+        return max(self.plannedStops - self.completedStops, 0)
+
+    def fractionComplete(self):
+        if self.plannedStops <= 0:
+            return 0.0
+        return min(float(self.completedStops) / self.plannedStops, 1.0)
+
+    def elapsedTimeMs(self):
+        return (time.time() - self.startTime) * 1000.0
+
+    def remainingTimeMs(self):
+        if self.nominalStopCostMs > 0:
+            return self.remainingStops() * self.nominalStopCostMs + self.motionLagMs
+        return self.remainingStops() * self.measuredStopCostMs
+
+    def scheduleLagMs(self):
+        # how far the printer trails the timed schedule, from the last position check
+        return self.motionLagMs
+
+
+#
+# AdaptiveSpectrumAverager
+#
+
+class AdaptiveSpectrumAverager(object):
+    """Running mean and variance (Welford) of the frames collected at one stop
+  and of their spectrum difference statistic. The stop is labelled tumor when
+  the mean statistic is below the threshold; the label is confident once the
+  mean is more than `confidence` standard errors away from the threshold.
+  """
+
+    def __init__(self, threshold=10.0, confidence=3.0, minFrames=3, maxFrames=50):
+        self.threshold = threshold
+        self.confidence = confidence
+        self.minFrames = minFrames
+        self.maxFrames = maxFrames
+        self.reset()
+
+    def reset(self):
+        self.numberOfFrames = 0
+        self.frameMean = None
+        self.frameM2 = None
+        self.statisticMean = 0.0
+        self.statisticM2 = 0.0
+
+    def addFrame(self, frame, statistic):
+        frame = np.asarray(frame, dtype=float)
+        self.numberOfFrames = self.numberOfFrames + 1
+        if self.frameMean is None:
+            self.frameMean = np.zeros_like(frame)
+            self.frameM2 = np.zeros_like(frame)
+        delta = frame - self.frameMean
+        self.frameMean += delta / self.numberOfFrames
+        self.frameM2 += delta * (frame - self.frameMean)
+        delta = statistic - self.statisticMean
+        self.statisticMean += delta / self.numberOfFrames
+        self.statisticM2 += delta * (statistic - self.statisticMean)
+
+    def frameVariance(self):
+        if self.numberOfFrames < 2:
+            return np.zeros_like(self.frameMean)
+        return self.frameM2 / (self.numberOfFrames - 1)
+
+    def statisticStandardError(self):
+        if self.numberOfFrames < 2:
+            return float('inf')
+        return math.sqrt(self.statisticM2 / (self.numberOfFrames - 1) / self.numberOfFrames)
+
+    def isTumor(self):
+        return abs(self.statisticMean) < self.threshold
+
+    def isConfident(self):
+        if self.numberOfFrames < self.minFrames:
+            return False
+        margin = abs(abs(self.statisticMean) - self.threshold)
+        return margin > self.confidence * self.statisticStandardError()
+
+    def isFull(self):
+        return self.numberOfFrames >= self.maxFrames
+
+
+#
+# PrinterDevice
+#
+
+class PrinterDevice(object):
+    """One printer stage reached through its own OpenIGTLink connector and
+  device ID, with its own command objects, commanded position and step scan
+  queue (G1 then M400 per stop, the acquisition starts on the M400
+  acknowledgement and the next stop is visited once stopDone is called).
+  Several devices run their scans concurrently, each driven by the
+  completion events of its own commands.
+  """
+
+    def __init__(self, connectorNode, deviceId="SerialDevice", name=None):
+        self.connectorNode = connectorNode
+        self.deviceId = deviceId
+        self.name = name or "{0} {1}".format(connectorNode.GetName(), deviceId)
+        self.outputArrayNode = None  # spectrum array of the probe mounted on this stage
+        self.fiducialNode = None
+        self.commandedXcoordinate = None
+        self.commandedYcoordinate = None
+        self.moveCmd = self.createCommand()
+        self.homeCmd = self.createCommand('G28 X Y ')
+        self.emergStopCmd = self.createCommand('M112')
+        self.motionCompleteCmd = self.createCommand('M400', 30.0)
+        self.motionCompleteCmd.AddObserver(self.motionCompleteCmd.CommandCompletedEvent, self.onMotionCompleteCmd)
+        self.waypoints = np.zeros((0, 2))
+        self.stopIndex = 0
+        self.active = False
+        self.acquireCallback = None
+        self.completeCallback = None
+        self.captureIndex = 0
+        self.captureObserverTag = None
+
+    def createCommand(self, text=None, timeoutSec=1.0):
+        command = slicer.vtkSlicerOpenIGTLinkCommand()
+        command.SetCommandName('SendText')
+        command.SetCommandAttribute('DeviceId', self.deviceId)
+        command.SetCommandTimeoutSec(timeoutSec)
+        if text is not None:
+            command.SetCommandAttribute('Text', text)
+        return command
+
+    def send(self, command):
+        spanTracer.traceCommand(command, "printer " + self.name)
+        slicer.modules.openigtlinkremote.logic().SendCommand(command, self.connectorNode.GetID())
+
+    def moveTo(self, xcoordinate, ycoordinate):
+        self.moveCmd.SetCommandAttribute('Text', 'G1 X%.2f Y%.2f' % (xcoordinate, ycoordinate))
+        self.send(self.moveCmd)
+        self.commandedXcoordinate = xcoordinate
+        self.commandedYcoordinate = ycoordinate
+
+    def home(self):
+        self.send(self.homeCmd)
+        self.commandedXcoordinate = 0
+        self.commandedYcoordinate = 0
+
+    def emergencyStop(self):
+        self.stopScan()
+        self.send(self.emergStopCmd)
+
+    def startScan(self, waypoints, acquireCallback, completeCallback=None):
+        self.waypoints = np.asarray(waypoints, dtype=float)
+        self.stopIndex = 0
+        self.acquireCallback = acquireCallback
+        self.completeCallback = completeCallback
+        self.active = True
+        self.moveToNextStop()
+
+    def stopScan(self):
+        self.active = False
+        self.stopCapture()
+
+    def remainingStops(self):
+        if not self.active:
+            return 0
+        return len(self.waypoints) - self.stopIndex
+
+    def moveToNextStop(self):
+        if not self.active:
+            return
+        if self.stopIndex >= len(self.waypoints):
+            self.active = False
+            if self.completeCallback:
+                self.completeCallback(self)
+            return
+        xcoordinate, ycoordinate = self.waypoints[self.stopIndex, :2]
+        self.moveTo(xcoordinate, ycoordinate)
+        self.send(self.motionCompleteCmd)
+
+    def onMotionCompleteCmd(self, observer, eventid):
+        if not self.active:
+            return
+        if self.motionCompleteCmd.GetStatus() != self.motionCompleteCmd.CommandSuccess:
+            logging.error("Scan on {0} stopped, M400 failed with status {1}".format(
+                self.name, self.motionCompleteCmd.StatusToString(self.motionCompleteCmd.GetStatus())))
+            self.active = False
+            return
+        xcoordinate, ycoordinate = self.waypoints[self.stopIndex, :2]
+        self.acquireCallback(self, self.stopIndex, xcoordinate, ycoordinate)
+
+    def stopDone(self):
+        self.stopIndex = self.stopIndex + 1
+        self.moveToNextStop()
+
+    def captureFrame(self, maxDwellMs, callback):
+        # callback runs once the next frame arrives in outputArrayNode, or after maxDwellMs with the current contents
+        self.stopCapture()
+        self.captureIndex = self.captureIndex + 1
+        captureIndex = self.captureIndex
+        self.captureObserverTag = self.outputArrayNode.AddObserver(vtk.vtkCommand.ModifiedEvent,
+                                                                   lambda observer, eventid: self.frameCaptured(captureIndex, callback))
+        dwellTimer = qt.QTimer()
+        dwellTimer.singleShot(maxDwellMs, lambda: self.frameCaptured(captureIndex, callback))
+
+    def frameCaptured(self, captureIndex, callback):
+        if captureIndex != self.captureIndex or self.captureObserverTag is None:
+            return  # already captured
+        self.stopCapture()
+        callback()
+
+    def stopCapture(self):
+        if self.captureObserverTag is not None:
+            self.outputArrayNode.RemoveObserver(self.captureObserverTag)
+            self.captureObserverTag = None
+
+
+#
+# PrinterDeviceManager
+#
+
+class PrinterDeviceManager(object):
+    """Set of printer stages driven from one Slicer instance. A raster is
+  split into blocks of whole rows with balanced stop counts, one per stage,
+  or the same pattern is run on every stage (one specimen per printer).
+  """
+
+    def __init__(self):
+        self.devices = []
+        self.completeCallback = None
+
+    def addDevice(self, connectorNode, deviceId="SerialDevice"):
+        for device in self.devices:
+            if device.connectorNode is connectorNode and device.deviceId == deviceId:
+                return device
+        device = PrinterDevice(connectorNode, deviceId)
+        self.devices.append(device)
+        return device
+
+    def removeDevice(self, device):
+        device.stopScan()
+        self.devices.remove(device)
+
+    def partitionWaypoints(self, waypoints, numberOfParts=None):
+        # contiguous blocks of whole rows (consecutive stops with the same y), balanced by number of stops
+        waypoints = np.asarray(waypoints, dtype=float)
+        numberOfParts = numberOfParts or len(self.devices)
+        rowStarts = np.append(0, np.nonzero(np.diff(waypoints[:, 1]))[0] + 1)
+        targets = len(waypoints) * np.arange(1, numberOfParts) / float(numberOfParts)
+        # cut at the row start nearest to each equal share of the stops
+        cuts = rowStarts[np.abs(rowStarts[np.newaxis, :] - targets[:, np.newaxis]).argmin(axis=1)]
+        return np.split(waypoints, cuts)
+
+    def startScans(self, assignments, acquireCallback, completeCallback=None):
+        self.completeCallback = completeCallback
+        for device, waypoints in zip(self.devices, assignments):
+            if len(waypoints):
+                device.startScan(waypoints, acquireCallback, self.onDeviceComplete)
+
+    def onDeviceComplete(self, device):
+        print "{0} finished its scan.".format(device.name)
+        if not self.isScanning() and self.completeCallback:
+            self.completeCallback()
+
+    def isScanning(self):
+        return any(device.active for device in self.devices)
+
+    def stopAll(self):
+        for device in self.devices:
+            device.stopScan()
+
+    def emergencyStopAll(self):
+        for device in self.devices:
+            device.emergencyStop()
+
+
+#
+# ScanPointStore
+#
+
+class ScanPointStore(object):
+    """Growable column store of classified scan points: coordinates (x, y, z),
+  time, label (1 tumor, 0 healthy) and score. Columns are preallocated arrays
+  whose capacity doubles when full, so appending is amortized O(1), and the
+  accessors return views of the filled rows (points() can be handed to VTK
+  without a copy). reset() empties the store for a new scan session but keeps
+  the allocated capacity, so back-to-back scans do not grow memory.
+  """
+
+    def __init__(self, capacity=1024):
+        self.coordinates = np.zeros((capacity, 3))
+        self.timestamps = np.zeros(capacity)
+        self.labelColumn = np.zeros(capacity, dtype=np.int8)
+        self.scoreColumn = np.zeros(capacity)
+        self.numberOfPoints = 0
+        self.modifiedCount = 0  # incremented on every change, lets displays update incrementally
+
+    def __len__(self):
+        return self.numberOfPoints
+
+    def reset(self):
+        self.numberOfPoints = 0
+        self.modifiedCount = self.modifiedCount + 1
+
+    def reserve(self, capacity):
+        if capacity <= len(self.timestamps):
+            return
+        capacity = max(capacity, 2 * len(self.timestamps))
+        count = self.numberOfPoints
+        coordinates = np.zeros((capacity, 3))
+        coordinates[:count] = self.coordinates[:count]
+        self.coordinates = coordinates
+        for name in ('timestamps', 'labelColumn', 'scoreColumn'):
+            column = getattr(self, name)
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:count] = column[:count]
+            setattr(self, name, grown)
+
+    def append(self, xcoordinate, ycoordinate, zcoordinate, label, score=float('nan'), timestamp=None):
+        self.appendMany([[xcoordinate, ycoordinate, zcoordinate]], [label], [score],
+                        [time.time() if timestamp is None else timestamp])
+
+    def appendMany(self, coordinates, labels, scores=None, timestamps=None):
+        coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 3)
+        count = len(coordinates)
+        start = self.numberOfPoints
+        self.reserve(start + count)
+        self.coordinates[start:start + count] = coordinates
+        self.labelColumn[start:start + count] = labels
+        self.scoreColumn[start:start + count] = np.nan if scores is None else scores
+        self.timestamps[start:start + count] = time.time() if timestamps is None else timestamps
+        self.numberOfPoints = start + count
+        self.modifiedCount = self.modifiedCount + 1
+
+    def points(self):
+        return self.coordinates[:self.numberOfPoints]
+
+    def labels(self):
+        return self.labelColumn[:self.numberOfPoints]
+
+    def scores(self):
+        return self.scoreColumn[:self.numberOfPoints]
+
+    def times(self):
+        return self.timestamps[:self.numberOfPoints]
+
+    def vtkPoints(self, mask=None):
+        # zero-copy unless a mask selects a subset, the VTK array keeps a reference to the NumPy rows it wraps
+        coordinates = self.points() if mask is None else np.ascontiguousarray(self.points()[mask])
+        points = vtk.vtkPoints()
+        points.SetData(numpy_support.numpy_to_vtk(coordinates, deep=False))
+        return points
+
+    def save(self, path):
+        table = np.column_stack((self.points(), self.times(), self.labels(), self.scores()))
+        np.savetxt(path, table, delimiter=",", header="x,y,z,t,label,score", comments="")
+
+
+#
+# ScanPointCloud
+#
+
+class ScanPointCloud(object):
+    """Vertex polydata of the points in a ScanPointStore, with the tissue label as
+  active point scalars and the score as a second point array. Points and point
+  data wrap the store's columns without copying. Only the vertex cells are
+  owned here: update() appends cells for the rows added since the last call
+  and keeps every decimation-th point, so the displayed cloud can be thinned
+  without dropping anything from the store. Glyph filters place a glyph on every
+  point regardless of the cells, so they read the same decimated points from
+  maskedPoints instead.
+  """
+
+    def __init__(self, store, decimation=1):
+        self.store = store
+        self.decimation = max(1, int(decimation))
+        self.polyData = vtk.vtkPolyData()
+        # vertex cells as point ids and offsets, vertex i covers vertexIds[vertexOffsets[i]:vertexOffsets[i + 1]]
+        idType = numpy_support.get_numpy_array_type(vtk.VTK_ID_TYPE)
+        self.vertexIds = np.zeros(2048, dtype=idType)
+        self.vertexOffsets = np.arange(len(self.vertexIds) + 1, dtype=idType)
+        self.numberOfVertices = 0
+        self.numberOfPublishedPoints = 0
+        self.publishedModifiedCount = -1
+        # keeps point ids 0, decimation, 2 * decimation, ... like the vertex cells
+        self.maskedPoints = vtk.vtkMaskPoints()
+        self.maskedPoints.SetInputData(self.polyData)
+        self.maskedPoints.SetOnRatio(self.decimation)
+        self.maskedPoints.SetOffset(0)
+        self.maskedPoints.RandomModeOff()
+
+    def setDecimation(self, decimation):
+        decimation = max(1, int(decimation))
+        if decimation != self.decimation:
+            self.decimation = decimation
+            self.maskedPoints.SetOnRatio(decimation)
+            self.numberOfVertices = 0
+            self.numberOfPublishedPoints = 0
+            self.publishedModifiedCount = -1
+
+    def update(self):
+        if self.publishedModifiedCount == self.store.modifiedCount:
+            return False
+        count = len(self.store)
+        if count < self.numberOfPublishedPoints:  # the store was reset
+            self.numberOfVertices = 0
+            self.numberOfPublishedPoints = 0
+        firstId = -(-self.numberOfPublishedPoints // self.decimation) * self.decimation
+        newIds = np.arange(firstId, count, self.decimation)
+        end = self.numberOfVertices + len(newIds)
+        if end > len(self.vertexIds):
+            grown = np.zeros(max(end, 2 * len(self.vertexIds)), dtype=self.vertexIds.dtype)
+            grown[:self.numberOfVertices] = self.vertexIds[:self.numberOfVertices]
+            self.vertexIds = grown
+            self.vertexOffsets = np.arange(len(grown) + 1, dtype=grown.dtype)
+        self.vertexIds[self.numberOfVertices:end] = newIds
+        self.numberOfVertices = end
+        self.numberOfPublishedPoints = count
+        self.publishedModifiedCount = self.store.modifiedCount
+
+        # the store reallocates its columns when it grows, so the wrappers are rebuilt on every update (no data is copied)
+        vertices = vtk.vtkCellArray()
+        if hasattr(vertices, "SetData"):
+            # VTK 9 keeps offsets and connectivity, wrapping them avoids converting a legacy cell array on every update
+            vertices.SetData(numpy_support.numpy_to_vtkIdTypeArray(self.vertexOffsets[:end + 1], deep=False),
+                             numpy_support.numpy_to_vtkIdTypeArray(self.vertexIds[:end], deep=False))
+        else:
+            # VTK 8 stores the legacy layout, [1, id] per vertex
+            legacyCells = np.ones(2 * end, dtype=self.vertexIds.dtype)
+            legacyCells[1::2] = self.vertexIds[:end]
+            vertices.SetCells(end, numpy_support.numpy_to_vtkIdTypeArray(legacyCells, deep=True))
+        labels = numpy_support.numpy_to_vtk(self.store.labels(), deep=False)
+        labels.SetName("label")
+        scores = numpy_support.numpy_to_vtk(self.store.scores(), deep=False)
+        scores.SetName("score")
+        self.polyData.SetPoints(self.store.vtkPoints())
+        self.polyData.SetVerts(vertices)
+        self.polyData.GetPointData().Initialize()
+        self.polyData.GetPointData().SetScalars(labels)
+        self.polyData.GetPointData().AddArray(scores)
+        self.polyData.Modified()
+        return True
+
+
+#
+# SpatialHashIndex
+#
+
+class SpatialHashIndex(object):
+    """Classified bed positions hashed by grid cell. Every cell keeps the latest
+  classification made inside it (position, tumor label, score and time), so
+  lookups, neighbourhood and nearest queries only visit the cells around the
+  query point instead of the whole scan history.
+  """
+
+    def __init__(self, cellSize=1.0):
+        self.cellSize = float(cellSize)
+        self.cells = {}
+
+    def __len__(self):
+        return len(self.cells)
+
+    def clear(self):
+        self.cells = {}
+
+    def cellKey(self, xcoordinate, ycoordinate):
+        return int(math.floor(xcoordinate / self.cellSize)), int(math.floor(ycoordinate / self.cellSize))
+
+    def insert(self, xcoordinate, ycoordinate, tumor, score=float('nan'), timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self.cells[self.cellKey(xcoordinate, ycoordinate)] = (xcoordinate, ycoordinate, bool(tumor), score, timestamp)
+
+    def neighbourhood(self, xcoordinate, ycoordinate, radius, maximumAge=None):
+        # records within radius of the point, optionally only those younger than maximumAge seconds
+        cellX, cellY = self.cellKey(xcoordinate, ycoordinate)
+        reach = int(math.ceil(radius / self.cellSize))
+        oldest = None if maximumAge is None else time.time() - maximumAge
+        records = []
+        for i in xrange(cellX - reach, cellX + reach + 1):
+            for j in xrange(cellY - reach, cellY + reach + 1):
+                record = self.cells.get((i, j))
+                if record is None or (oldest is not None and record[4] < oldest):
+                    continue
+                if (record[0] - xcoordinate) ** 2 + (record[1] - ycoordinate) ** 2 <= radius * radius:
+                    records.append(record)
+        return records
+
+    def nearest(self, xcoordinate, ycoordinate, maximumDistance, maximumAge=None):
+        best = None
+        bestDistance = maximumDistance * maximumDistance
+        for record in self.neighbourhood(xcoordinate, ycoordinate, maximumDistance, maximumAge):
+            distance = (record[0] - xcoordinate) ** 2 + (record[1] - ycoordinate) ** 2
+            if distance <= bestDistance:
+                best = record
+                bestDistance = distance
+        return best
+
+
+#
+# SpectrumRingBuffer
+#
+
+class SpectrumRingBuffer(object):
+    """Fixed capacity history of the most recent spectra with their timestamps
+  and commanded positions. Every frame is written twice, at i and i + capacity,
+  so the last k frames are always one contiguous slice and window() returns
+  views instead of copies. Running sums give the mean and variance of the
+  buffered frames in O(1) per frame; they are recomputed once per capacity
+  frames to keep rounding errors from accumulating.
+  """
+
+    def __init__(self, capacity, numberOfPoints):
+        self.capacity = int(capacity)
+        self.numberOfPoints = int(numberOfPoints)
+        self.frames = np.zeros((2 * self.capacity, self.numberOfPoints), dtype=float)
+        self.timestamps = np.zeros(2 * self.capacity, dtype=float)
+        self.positions = np.zeros((2 * self.capacity, 2), dtype=float)
+        self.frameSum = np.zeros(self.numberOfPoints, dtype=float)
+        self.frameSquareSum = np.zeros(self.numberOfPoints, dtype=float)
+        self.clear()
+
+    def clear(self):
+        self.numberOfFrames = 0
+        self.totalFrames = 0
+        self.lastIndex = -1
+        self.frameSum.fill(0)
+        self.frameSquareSum.fill(0)
+
+    def __len__(self):
+        return self.numberOfFrames
+
+    def append(self, frame, timestamp=None, position=None):
+        index = (self.lastIndex + 1) % self.capacity
+        if self.numberOfFrames == self.capacity:
+            evicted = self.frames[index]
+            self.frameSum -= evicted
+            self.frameSquareSum -= evicted * evicted
+        else:
+            self.numberOfFrames = self.numberOfFrames + 1
+        self.frames[index] = frame
+        self.frames[index + self.capacity] = self.frames[index]
+        self.timestamps[index] = self.timestamps[index + self.capacity] = time.time() if timestamp is None else timestamp
+        if position is None:
+            self.positions[index] = self.positions[index + self.capacity] = np.nan
+        else:
+            self.positions[index] = self.positions[index + self.capacity] = position[:2]
+        self.lastIndex = index
+        self.totalFrames = self.totalFrames + 1
+        if self.totalFrames % self.capacity == 0:
+            frames = self.window()[0]
+            self.frameSum[:] = frames.sum(axis=0)
+            self.frameSquareSum[:] = (frames * frames).sum(axis=0)
+        else:
+            frame = self.frames[index]
+            self.frameSum += frame
+            self.frameSquareSum += frame * frame
+
+    def window(self, numberOfFrames=None):
+        # views of the last numberOfFrames frames, timestamps and positions, oldest first
+        if numberOfFrames is None or numberOfFrames > self.numberOfFrames:
+            numberOfFrames = self.numberOfFrames
+        end = self.lastIndex + 1 + self.capacity
+        start = end - numberOfFrames
+        return self.frames[start:end], self.timestamps[start:end], self.positions[start:end]
+
+    def framesSince(self, timestamp):
+        frames, timestamps, positions = self.window()
+        start = np.searchsorted(timestamps, timestamp)
+        return frames[start:], timestamps[start:], positions[start:]
+
+    def latest(self):
+        if self.numberOfFrames == 0:
+            return None
+        return self.frames[self.lastIndex]
+
+    def mean(self):
+        if self.numberOfFrames == 0:
+            return np.zeros(self.numberOfPoints)
+        return self.frameSum / self.numberOfFrames
+
+    def variance(self):
+        if self.numberOfFrames < 2:
+            return np.zeros(self.numberOfPoints)
+        mean = self.frameSum / self.numberOfFrames
+        variance = (self.frameSquareSum - self.numberOfFrames * mean * mean) / (self.numberOfFrames - 1)
+        return np.maximum(variance, 0)
+
+
+#
+# PointSetRegistration
+#
+
+class PointSetRegistration(object):
+    """Closed form (Umeyama) similarity registration of corresponding point sets
+  with residual, FRE and leave-one-out TRE estimates, and an ICP mode for point
+  sets without correspondences. ICP uses scipy's cKDTree for the nearest
+  neighbour search when SciPy is available and a GridPointLocator otherwise.
+  """
+
+    def __init__(self, mode="similarity"):
+        self.mode = mode  # "similarity" or "rigid"
+        self.maximumIterations = 100
+        self.tolerance = 1e-6
+        self.outlierRejection = 3.0  # pairs further than this many median distances are ignored, 0 keeps all
+
+    def similarityTransform(self, source, target):
+        source = np.asarray(source, dtype=float)
+        target = np.asarray(target, dtype=float)
+        sourceMean = source.mean(axis=0)
+        targetMean = target.mean(axis=0)
+        sourceCentered = source - sourceMean
+        targetCentered = target - targetMean
+        covariance = np.dot(targetCentered.T, sourceCentered) / len(source)
+        U, D, Vt = np.linalg.svd(covariance)
+        signs = np.ones(3)
+        if np.linalg.det(U) * np.linalg.det(Vt) < 0:
+            signs[2] = -1
+        rotation = np.dot(U * signs, Vt)
+        scale = 1.0
+        if self.mode == "similarity":
+            scale = np.dot(D, signs) / (sourceCentered ** 2).sum(axis=1).mean()
+        matrix = np.eye(4)
+        matrix[:3, :3] = scale * rotation
+        matrix[:3, 3] = targetMean - scale * np.dot(rotation, sourceMean)
+        return matrix
+
+    def transformPoints(self, matrix, points):
+        return np.dot(points, matrix[:3, :3].T) + matrix[:3, 3]
+
+    def residuals(self, matrix, source, target):
+        return np.sqrt(((self.transformPoints(matrix, source) - target) ** 2).sum(axis=1))
+
+    def leaveOneOutErrors(self, source, target):
+        # error at each landmark when it is left out of the fit, an estimate of the target registration error
+        source = np.asarray(source, dtype=float)
+        target = np.asarray(target, dtype=float)
+        errors = np.zeros(len(source))
+        if len(source) < 4:
+            errors[:] = np.nan
+            return errors
+        for i in xrange(len(source)):
+            keep = np.arange(len(source)) != i
+            matrix = self.similarityTransform(source[keep], target[keep])
+            errors[i] = self.residuals(matrix, source[i:i + 1], target[i:i + 1])[0]
+        return errors
+
+    def icp(self, source, target, initialMatrix=None):
+        source = np.asarray(source, dtype=float)
+        target = np.asarray(target, dtype=float)
+        findNearest = self.nearestNeighbourSearch(target)
+        if initialMatrix is None:
+            # start by matching centroids
+            initialMatrix = np.eye(4)
+            initialMatrix[:3, 3] = target.mean(axis=0) - source.mean(axis=0)
+        matrix = initialMatrix
+        previousDistance = None
+        iteration = 0
+        for iteration in xrange(1, self.maximumIterations + 1):
+            distances, indices = findNearest(self.transformPoints(matrix, source))
+            keep = np.ones(len(source), dtype=bool)
+            if self.outlierRejection > 0:
+                keep = distances <= self.outlierRejection * max(np.median(distances), 1e-12)
+            matrix = self.similarityTransform(source[keep], target[indices[keep]])
+            meanDistance = distances[keep].mean()
+            if previousDistance is not None and abs(previousDistance - meanDistance) < self.tolerance:
+                break
+            previousDistance = meanDistance
+        distances, indices = findNearest(self.transformPoints(matrix, source))
+        return matrix, math.sqrt(np.mean(distances ** 2)), iteration
+
+    def nearestNeighbourSearch(self, target):
+        try:
+            from scipy.spatial import cKDTree
+        except ImportError:
+            cKDTree = None
+        if cKDTree is not None:
+            tree = cKDTree(target)
+            return lambda points: tree.query(points)
+        return GridPointLocator(target).query
+
+
+#
+# GridPointLocator
+#
+
+class GridPointLocator(object):
+    """Exact nearest neighbour queries in NumPy for a batch of points, used when
+  SciPy is not available. The target points are sorted into a uniform grid of
+  about pointsPerCell points per cell (flat axes get a single cell). All
+  queries search the 3 x 3 x 3 cells around their own cell at once; a result is
+  final when it is closer than anything outside the searched block can be. The
+  rest (mostly queries outside the point set) compare their best distance with
+  the bounding boxes of a coarser grid and only search the cells that can hold
+  a closer point.
+  """
+
+    def __init__(self, points, chunkSize=20000, pointsPerCell=1):
+        self.points = np.asarray(points, dtype=float)
+        self.chunkSize = chunkSize
+        self.origin = self.points.min(axis=0)
+        self.maximum = self.points.max(axis=0)
+        extent = self.maximum - self.origin
+        active = extent > 1e-9 * max(extent.max(), 1e-12)
+        if active.any():
+            self.cellSize = (np.prod(extent[active]) * pointsPerCell / len(self.points)) ** (1.0 / active.sum())
+            self.cellSize = max(self.cellSize, extent[active].max() / 1e6)
+        else:
+            self.cellSize = 1.0  # all points coincide
+        self.dimensions = np.where(active, np.floor(extent / self.cellSize).astype(int) + 1, 1)
+        keys = self.cellKeys(self.cellsOf(self.points))
+        self.order = np.argsort(keys, kind="mergesort")
+        self.sortedPoints = self.points[self.order]  # the points of a cell are contiguous
+        sortedKeys = keys[self.order]
+        allKeys = np.arange(np.prod(self.dimensions))
+        self.cellStart = np.searchsorted(sortedKeys, allKeys, side="left")
+        self.cellEnd = np.searchsorted(sortedKeys, allKeys, side="right")
+        self.coarseGrid = None
+
+    def cellsOf(self, points):
+        cells = np.floor((points - self.origin) / self.cellSize).astype(int)
+        return np.clip(cells, 0, self.dimensions - 1)
+
+    def cellKeys(self, cells):
+        return (cells[..., 0] * self.dimensions[1] + cells[..., 1]) * self.dimensions[2] + cells[..., 2]
+
+    def offsets(self, radius):
+        ranges = [np.arange(-radius, radius + 1) if dimension > 1 else np.zeros(1, dtype=int)
+                  for dimension in self.dimensions]
+        grids = np.meshgrid(*ranges, indexing="ij")
+        return np.column_stack([grid.ravel() for grid in grids])
+
+    def cellBounds(self):
+        # occupied cells with the bounding box of their points
+        occupied = np.flatnonzero(self.cellEnd > self.cellStart)
+        starts = self.cellStart[occupied]
+        boxMin = np.minimum.reduceat(self.sortedPoints, starts, axis=0)
+        boxMax = np.maximum.reduceat(self.sortedPoints, starts, axis=0)
+        return occupied, boxMin, boxMax
+
+    def query(self, queryPoints):
+        queryPoints = np.asarray(queryPoints, dtype=float)
+        distances = np.empty(len(queryPoints))
+        indices = np.empty(len(queryPoints), dtype=int)
+        for start in xrange(0, len(queryPoints), self.chunkSize):
+            chunk = slice(start, start + self.chunkSize)
+            distances[chunk], indices[chunk] = self.queryChunk(queryPoints[chunk])
+        return distances, indices
+
+    def queryChunk(self, queryPoints):
+        squaredDistances, indices, resolved = self.searchBlock(queryPoints)
+        remaining = np.flatnonzero(~resolved)
+        if len(remaining) > 0:
+            squaredDistances[remaining], indices[remaining] = self.searchBounded(
+                queryPoints[remaining], squaredDistances[remaining], indices[remaining])
+        return np.sqrt(squaredDistances), indices
+
+    def searchBlock(self, queryPoints, radius=1):
+        cells = self.cellsOf(queryPoints)
+        neighbours = cells[:, np.newaxis, :] + self.offsets(radius)[np.newaxis]
+        valid = ((neighbours >= 0) & (neighbours < self.dimensions)).all(axis=2)
+        keys = self.cellKeys(np.clip(neighbours, 0, self.dimensions - 1))
+        starts = self.cellStart[keys]
+        counts = np.where(valid, self.cellEnd[keys] - starts, 0)
+        squaredDistances, indices = self.nearestInRanges(queryPoints, np.repeat(np.arange(len(queryPoints)), keys.shape[1]),
+                                                         starts.ravel(), counts.ravel())
+
+        # a point outside the block lies beyond one of its faces (sides at the edge of the grid
+        # have none) and, on the other axes, at least as far as the query is outside the grid
+        low = np.where(cells - radius > 0, queryPoints - (self.origin + (cells - radius) * self.cellSize), np.inf)
+        high = np.where(cells + radius + 1 < self.dimensions,
+                        self.origin + (cells + radius + 1) * self.cellSize - queryPoints, np.inf)
+        outside = np.maximum(np.maximum(self.origin - queryPoints, queryPoints - self.maximum), 0)
+        faceDistances = np.maximum(np.minimum(low, high), outside)
+        bound = (faceDistances ** 2 - outside ** 2 + (outside ** 2).sum(axis=1)[:, np.newaxis]).min(axis=1)
+        return squaredDistances, indices, squaredDistances <= bound
+
+    def searchBounded(self, queryPoints, squaredDistances, indices):
+        if self.coarseGrid is None:
+            coarse = GridPointLocator(self.points, pointsPerCell=512)
+            self.coarseGrid = (coarse,) + coarse.cellBounds()
+        coarse, occupied, boxMin, boxMax = self.coarseGrid
+        step = max(1, 500000 // len(occupied))
+        for start in xrange(0, len(queryPoints), step):
+            block = slice(start, start + step)
+            gaps = np.maximum(np.maximum(boxMin[np.newaxis] - queryPoints[block, np.newaxis],
+                                         queryPoints[block, np.newaxis] - boxMax[np.newaxis]), 0)
+            # only cells whose box is closer than the best point so far are searched
+            pairQuery, pairCell = np.nonzero((gaps ** 2).sum(axis=2) < squaredDistances[block, np.newaxis])
+            starts = coarse.cellStart[occupied[pairCell]]
+            found, foundIndices = coarse.nearestInRanges(queryPoints[block], pairQuery,
+                                                         starts, coarse.cellEnd[occupied[pairCell]] - starts)
+            closer = found < squaredDistances[block]
+            squaredDistances[block][closer] = found[closer]
+            indices[block][closer] = foundIndices[closer]
+        return squaredDistances, indices
+
+    def nearestInRanges(self, queryPoints, rangeQuery, starts, counts):
+        # nearest sorted point for each query among the point ranges listed for it (grouped by query)
+        pairQuery = np.repeat(rangeQuery, counts)
+        candidates = np.repeat(starts, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        pairDistances = np.zeros(len(candidates))
+        for axis in xrange(3):
+            pairDistances += (self.sortedPoints[candidates, axis] - queryPoints[pairQuery, axis]) ** 2
+
+        squaredDistances = np.full(len(queryPoints), np.inf)
+        indices = np.zeros(len(queryPoints), dtype=int)
+        if len(pairQuery) > 0:
+            queries, groupStarts = np.unique(pairQuery, return_index=True)
+            squaredDistances[queries] = np.minimum.reduceat(pairDistances, groupStarts)
+            isNearest = np.flatnonzero(pairDistances == squaredDistances[pairQuery])
+            queries, first = np.unique(pairQuery[isNearest], return_index=True)
+            indices[queries] = self.order[candidates[isNearest[first]]]
+        return squaredDistances, indices
+
+
+#
+# PathOptimizer
+#
+
+class PathOptimizer(object):
+    """Orders waypoints to reduce travel: a nearest neighbour tour built with a
+  uniform grid index over the points, improved by 2-opt moves restricted to
+  each point's nearest neighbours. The start point is kept first. Travel time
+  is estimated with moveTimeModel.moveTimes(waypoints) when a model is given,
+  otherwise from straight line distance at feedRate plus a fixed per-move
+  overhead.
+  """
+
+    def __init__(self, moveTimeModel=None, feedRate=3000.0, moveOverhead=0.05):
+        self.moveTimeModel = moveTimeModel
+        self.feedRate = feedRate  # mm/min
+        self.moveOverhead = moveOverhead  # s
+        self.numberOfNeighbours = 8
+        self.maximumPasses = 20
+
+    def travelTime(self, waypoints):
+        waypoints = np.asarray(waypoints, dtype=float)
+        if len(waypoints) < 2:
+            return 0.0
+        if self.moveTimeModel is not None:
+            return float(np.sum(self.moveTimeModel.moveTimes(waypoints)))
+        lengths = np.sqrt((np.diff(waypoints, axis=0) ** 2).sum(axis=1))
+        return float(np.sum(lengths / (self.feedRate / 60.0) + self.moveOverhead * (lengths > 0)))
+
+    def optimize(self, waypoints, start=0):
+        # returns the visiting order (indices into waypoints)
+        points = np.asarray(waypoints, dtype=float)[:, :2]
+        if len(points) < 3:
+            return np.arange(len(points))
+        self._buildGrid(points)
+        order = self.nearestNeighbourOrder(points, start)
+        return self.twoOpt(points, order)
+
+    def _buildGrid(self, points):
+        self.origin = points.min(axis=0)
+        extent = np.maximum(points.max(axis=0) - self.origin, 1e-9)
+        self.cellSize = max(math.sqrt(extent[0] * extent[1] / len(points)), extent.max() / len(points), 1e-9)
+        self.cells = np.floor((points - self.origin) / self.cellSize).astype(int)
+        self.gridShape = self.cells.max(axis=0) + 1
+        self.grid = {}
+        for index in xrange(len(points)):
+            self.grid.setdefault((self.cells[index, 0], self.cells[index, 1]), []).append(index)
+
+    def _ring(self, cell, radius):
+        # grid cells at Chebyshev distance radius around cell
+        for i in xrange(cell[0] - radius, cell[0] + radius + 1):
+            for j in xrange(cell[1] - radius, cell[1] + radius + 1):
+                if max(abs(i - cell[0]), abs(j - cell[1])) == radius and (i, j) in self.grid:
+                    for index in self.grid[(i, j)]:
+                        yield index
+
+    def _nearest(self, points, index, count, available):
+        # the count nearest points to points[index] among the grid entries accepted by available
+        cell = self.cells[index]
+        maximumRadius = int(self.gridShape.max())
+        candidates = []
+        for radius in xrange(0, maximumRadius + 1):
+            if 8 * radius > len(self.grid):
+                # fewer occupied cells than ring cells (the end of a tour): take the rest of the points at once
+                candidates.extend(other for key, indices in self.grid.iteritems()
+                                  if max(abs(key[0] - cell[0]), abs(key[1] - cell[1])) >= radius
+                                  for other in indices if other != index and available(other))
+                break
+            candidates.extend(other for other in self._ring(cell, radius) if other != index and available(other))
+            if len(candidates) >= count:
+                distances = np.sqrt(((points[candidates] - points[index]) ** 2).sum(axis=1))
+                # points outside this ring are at least radius cells away
+                if np.sort(distances)[count - 1] <= radius * self.cellSize:
+                    break
+        if not candidates:
+            return []
+        distances = np.sqrt(((points[candidates] - points[index]) ** 2).sum(axis=1))
+        return [candidates[i] for i in np.argsort(distances)[:count]]
+
+    def _remove(self, index):
+        # visited points leave the grid, and so do cells once they are empty
+        cell = (self.cells[index, 0], self.cells[index, 1])
+        self.grid[cell].remove(index)
+        if not self.grid[cell]:
+            del self.grid[cell]
+
+    def nearestNeighbourOrder(self, points, start=0):
+        order = [start]
+        self._remove(start)
+        current = start
+        for step in xrange(1, len(points)):
+            current = self._nearest(points, current, 1, lambda other: True)[0]
+            self._remove(current)
+            order.append(current)
+        self._buildGrid(points)
+        return np.array(order)
+
+    def twoOpt(self, points, order):
+        order = np.array(order)
+        numberOfPoints = len(order)
+        position = np.empty(numberOfPoints, dtype=int)
+        position[order] = np.arange(numberOfPoints)
+        neighbours = [self._nearest(points, index, self.numberOfNeighbours, lambda other: True)
+                      for index in xrange(numberOfPoints)]
+
+        def distance(a, b):
+            return math.hypot(points[a, 0] - points[b, 0], points[a, 1] - points[b, 1])
+
+        for iteration in xrange(self.maximumPasses):
+            improved = False
+            for i in xrange(numberOfPoints - 1):
+                a = order[i]
+                b = order[i + 1]
+                for c in neighbours[a]:
+                    j = position[c]
+                    if j <= i + 1:
+                        continue
+                    # replace edges a-b and c-d by a-c and b-d (d is absent at the end of the open path)
+                    gain = distance(a, b) - distance(a, c)
+                    if j + 1 < numberOfPoints:
+                        d = order[j + 1]
+                        gain = gain + distance(c, d) - distance(b, d)
+                    if gain > 1e-9:
+                        order[i + 1:j + 1] = order[i + 1:j + 1][::-1].copy()
+                        position[order[i + 1:j + 1]] = np.arange(i + 1, j + 1)
+                        b = order[i + 1]
+                        improved = True
+            if not improved:
+                break
+        return order
+
+
+#
+# KinematicMoveModel
+#
+
+class KinematicMoveModel(object):
+    """Expected duration of printer moves. Each axis follows a trapezoidal
+  velocity profile: it starts and ends at the jerk speed (the velocity change
+  the firmware allows without acceleration), accelerates to the axis share of
+  the feed rate and decelerates again, or follows a triangular profile when the
+  move is too short to reach it. A move lasts as long as its slowest axis plus
+  a fixed command overhead (serial round trip).
+  """
+
+    def __init__(self, maxFeedRate=(50.0, 50.0), acceleration=(500.0, 500.0), jerk=(10.0, 10.0),
+                 feedRate=None, commandOverhead=0.02):
+        self.maxFeedRate = np.asarray(maxFeedRate, dtype=float)  # mm/s per axis
+        self.acceleration = np.asarray(acceleration, dtype=float)  # mm/s^2 per axis
+        self.jerk = np.asarray(jerk, dtype=float)  # mm/s per axis
+        self.feedRate = feedRate  # commanded feed rate in mm/s, None moves at the axis limits
+        self.commandOverhead = commandOverhead  # s
+
+    def commandFeedRate(self):
+        # F word (mm/min) that makes the printer move the way the model assumes
+        if self.feedRate is not None:
+            return 60.0 * self.feedRate
+        return 60.0 * math.hypot(self.maxFeedRate[0], self.maxFeedRate[1])
+
+    def moveTimes(self, waypoints):
+        # duration in seconds of each move between consecutive waypoints
+        waypoints = np.asarray(waypoints, dtype=float)[:, :2]
+        deltas = np.abs(np.diff(waypoints, axis=0))
+        lengths = np.sqrt((deltas ** 2).sum(axis=1))
+        axisSpeed = np.tile(self.maxFeedRate, (len(deltas), 1))
+        if self.feedRate is not None:
+            share = deltas / np.where(lengths > 0, lengths, 1.0)[:, np.newaxis]
+            axisSpeed = np.minimum(axisSpeed, self.feedRate * share)
+        axisTimes = self.trapezoidTimes(deltas, axisSpeed, self.acceleration, self.jerk)
+        return np.where(lengths > 0, axisTimes.max(axis=1) + self.commandOverhead, 0.0)
+
+    def trapezoidTimes(self, distances, maximumSpeed, acceleration, jerk):
+        startSpeed = np.minimum(jerk, maximumSpeed)
+        safeSpeed = np.maximum(maximumSpeed, 1e-9)
+        rampDistance = (safeSpeed ** 2 - startSpeed ** 2) / (2.0 * acceleration)
+        cruise = 2.0 * (safeSpeed - startSpeed) / acceleration + (distances - 2.0 * rampDistance) / safeSpeed
+        peakSpeed = np.sqrt(acceleration * distances + startSpeed ** 2)
+        triangle = 2.0 * (peakSpeed - startSpeed) / acceleration
+        times = np.where(2.0 * rampDistance <= distances, cruise, triangle)
+        return np.where(distances > 0, times, 0.0)
+
+    def arrivalTimes(self, waypoints, dwell=0.0):
+        # time at which each waypoint after the first is reached when every stop dwells for dwell seconds
+        moves = self.moveTimes(waypoints)
+        return np.cumsum(moves) + dwell * np.arange(len(moves))
+
+    def issueTimes(self, waypoints, dwell=0.0):
+        # time at which the move to each waypoint after the first should be sent
+        moves = self.moveTimes(waypoints)
+        return np.concatenate(([0.0], np.cumsum(moves + dwell)[:-1]))
+
+
+#
+# GcodeProgramCompiler
+#
+
+class GcodeProgramCompiler(object):
+    """Turns a list of scan stops into a G-code program: millimetres and
+  absolute positioning, one G1 X Y with an explicit feed rate per stop
+  (repeated positions are skipped), and M400 + M118 markers at every
+  acquisition point, optionally followed by a G4 dwell. Lines are sent as
+  N<line> <command>*<checksum> after M110 resets the firmware's line counter.
+  """
+
+    def compile(self, waypoints, feedRate, dwellMs=0):
+        # returns the program lines and the indices of the acquisition marker lines
+        lines = ["M110 N0", "G21", "G90"]
+        acquisitionLines = []
+        previous = None
+        for stopIndex, (xcoordinate, ycoordinate) in enumerate(np.asarray(waypoints, dtype=float)[:, :2]):
+            move = "G1 X%.2f Y%.2f F%d" % (xcoordinate, ycoordinate, feedRate)
+            if move != previous:
+                lines.append(move)
+                previous = move
+            lines.append("M400")
+            lines.append("M118 ACQ %d" % stopIndex)
+            acquisitionLines.append(len(lines) - 1)
+            if dwellMs > 0:
+                lines.append("G4 P%d" % dwellMs)
+        lines.append("M400")
+        return lines, acquisitionLines
+
+    def numberLine(self, lineNumber, command):
+        line = "N%d %s" % (lineNumber, command)
+        checksum = 0
+        for character in line:
+            checksum = checksum ^ ord(character)
+        return "%s*%d" % (line, checksum & 0xff)
+
+    def resendRequest(self, response):
+        # line number the firmware asks to be resent ("Resend: 12" / "rs N12"), None otherwise
+        for token in ("Resend:", "rs N"):
+            position = response.find(token)
+            if position >= 0:
+                digits = ""
+                for character in response[position + len(token):].strip():
+                    if not character.isdigit():
+                        break
+                    digits = digits + character
+                if digits:
+                    return int(digits)
+        return None
+
+    def saveProgram(self, path, lines):
+        with open(path, "w") as programFile:
+            programFile.write("\n".join(lines) + "\n")
 
 
 class PrinterInteractorTest(ScriptedLoadableModuleTest):
@@ -1542,6 +4976,28 @@ class PrinterInteractorTest(ScriptedLoadableModuleTest):
     """
         self.setUp()
         self.test_PrinterInteractor1()
+        self.test_SpectrumPreprocessor()
+        self.test_GridPointLocator()
+        self.test_PathOptimizer()
+        self.test_KinematicMoveModel()
+        self.test_GcodeProgramCompiler()
+        self.test_SpectralLibrary()
+        self.test_ThresholdCalibrator()
+        self.test_BatchReanalysis()
+        self.test_PrinterDeviceManager()
+        self.test_ScanPointStore()
+        self.test_ScanPointCloud()
+        self.test_AdaptiveSpectrumAverager()
+        self.test_FlyScanInterpolation()
+        self.test_PipelineWorker()
+        self.test_ScanPlanner()
+        self.test_SpectrumChartThrottling()
+        self.test_ScanProgressModel()
+        self.test_SpanTracer()
+        self.test_SignalQualityScorer()
+        self.test_SpatialHashIndex()
+        self.test_SpectrumRingBuffer()
+        self.test_PointSetRegistration()
 
     def test_PrinterInteractor1(self):
         """ Ideally you should have several levels of tests.  At the lowest level
@@ -1577,4 +5033,611 @@ class PrinterInteractorTest(ScriptedLoadableModuleTest):
         volumeNode = slicer.util.getNode(pattern="FA")
         logic = PrinterInteractorLogic()
         self.assertIsNotNone(logic.hasImageData(volumeNode))
-        self.delayDisplay('Test passed!')
\ No newline at end of file
+        self.delayDisplay('Test passed!')
+
+    def test_SpectrumPreprocessor(self):
+        """ Preprocessing a recorded cube gives the same result as preprocessing its spectra one by one.
+    """
+        self.delayDisplay("Starting the spectrum preprocessing test")
+        preprocessor = SpectrumPreprocessor()
+        # Savitzky-Golay quadratic 5 point kernel
+        self.assertTrue(np.allclose(preprocessor.smoothingKernel(5, 2) * 35, [-3, 12, 17, 12, -3]))
+
+        wavelengths = np.linspace(0, 1, 100)
+        spectrum = 10 * np.exp(-((wavelengths - 0.5) / 0.05) ** 2) + 3 * wavelengths + 1
+        cube = spectrum + np.random.RandomState(0).normal(0, 0.1, (4, 3, 100))
+        preprocessor.setDarkFrame(np.ones(100))
+        preprocessor.baselineOrder = 1
+        preprocessor.smoothingWindow = 7
+        preprocessor.normalization = "peak"
+        processedCube = preprocessor.process(cube)
+        self.assertEqual(processedCube.shape, cube.shape)
+        self.assertTrue(np.allclose(processedCube[2, 1], preprocessor.process(cube[2, 1])))
+        self.assertAlmostEqual(np.abs(processedCube).max(axis=-1).min(), 1.0)
+        self.delayDisplay('Test passed!')
+
+    def test_GridPointLocator(self):
+        """ The grid locator finds the same nearest neighbours as a brute force search, for volumes, planes and far points.
+    """
+        self.delayDisplay("Starting the grid point locator test")
+        randomState = np.random.RandomState(5)
+        planar = randomState.rand(500, 3)
+        planar[:, 2] = 1.0
+        for target in (randomState.rand(2000, 3) * [100, 50, 10], planar):
+            queries = np.vstack((target[:50] + randomState.normal(0, 0.01, (50, 3)),
+                                 randomState.rand(200, 3) * 120 - 10, [[1000.0, -500.0, 3.0]]))
+            distances, indices = GridPointLocator(target, chunkSize=64).query(queries)
+            bruteForce = np.sqrt(((queries[:, np.newaxis, :] - target[np.newaxis]) ** 2).sum(axis=2))
+            self.assertTrue(np.allclose(distances, bruteForce.min(axis=1)))
+            self.assertTrue(np.allclose(bruteForce[np.arange(len(queries)), indices], distances))
+        self.delayDisplay('Test passed!')
+
+    def test_PathOptimizer(self):
+        """ The optimized order visits every waypoint once from the start point and shortens a shuffled raster.
+    """
+        self.delayDisplay("Starting the path optimizer test")
+        x, y = np.meshgrid(np.arange(0, 30.0), np.arange(0, 20.0))
+        raster = np.column_stack((x.ravel(), y.ravel()))
+        shuffled = raster[np.random.RandomState(3).permutation(len(raster))]
+        optimizer = PathOptimizer()
+        order = optimizer.optimize(shuffled, start=5)
+        self.assertEqual(order[0], 5)
+        self.assertEqual(sorted(order), range(len(shuffled)))
+        before = optimizer.travelTime(shuffled)
+        after = optimizer.travelTime(shuffled[order])
+        self.assertTrue(after < 0.25 * before)
+        # a unit grid can not be toured in less than one move per point
+        self.assertTrue(after >= (len(raster) - 1) * (1.0 / (optimizer.feedRate / 60.0) + optimizer.moveOverhead) - 1e-6)
+        self.assertTrue(np.array_equal(optimizer.optimize(shuffled[:2]), [0, 1]))
+        self.delayDisplay('Test passed!')
+
+    def test_KinematicMoveModel(self):
+        """ Trapezoidal and triangular axis profiles, move durations at the axis limits and at a feed rate, and the F word.
+    """
+        self.delayDisplay("Starting the kinematic move model test")
+        model = KinematicMoveModel(maxFeedRate=(50.0, 50.0), acceleration=(500.0, 500.0), jerk=(10.0, 10.0))
+        # 10 to 50 mm/s takes 0.08 s and 2.4 mm each way, the remaining 5.2 mm cruise at 50 mm/s
+        times = model.trapezoidTimes(np.array([10.0, 4.8, 1.0, 0.0]), 50.0, 500.0, 10.0)
+        self.assertTrue(np.allclose(times, [0.264, 0.16, 2.0 * (math.sqrt(600.0) - 10.0) / 500.0, 0.0]))
+
+        waypoints = np.array([[0.0, 0.0], [10.0, 0.0], [10.0, 0.0], [16.0, 8.0]])
+        moves = model.moveTimes(waypoints)
+        self.assertEqual(len(moves), 3)
+        self.assertAlmostEqual(moves[0], 0.264 + model.commandOverhead)
+        self.assertEqual(moves[1], 0.0)
+        self.assertAlmostEqual(moves[2], model.trapezoidTimes(8.0, 50.0, 500.0, 10.0) + model.commandOverhead)
+        self.assertAlmostEqual(model.commandFeedRate(), 60.0 * math.hypot(50.0, 50.0))
+
+        # at 25 mm/s the diagonal move splits into 15 mm/s along x and 20 mm/s along y
+        model.feedRate = 25.0
+        axisTimes = model.trapezoidTimes(np.array([6.0, 8.0]), np.array([15.0, 20.0]), 500.0, 10.0)
+        self.assertAlmostEqual(model.moveTimes(waypoints)[2], axisTimes.max() + model.commandOverhead)
+        self.assertAlmostEqual(model.commandFeedRate(), 1500.0)
+        arrivals = model.arrivalTimes(waypoints, 0.5)
+        self.assertTrue(np.allclose(model.issueTimes(waypoints, 0.5)[1:], arrivals[:-1] + 0.5))
+        self.delayDisplay('Test passed!')
+
+    def test_GcodeProgramCompiler(self):
+        """ Program layout, line numbers with the checksums Marlin expects, and resend requests parsed from responses.
+    """
+        self.delayDisplay("Starting the G-code program compiler test")
+        compiler = GcodeProgramCompiler()
+        lines, acquisitionLines = compiler.compile([[0, 0], [0, 0], [1.5, 2]], 3000, dwellMs=100)
+        self.assertEqual(lines, ["M110 N0", "G21", "G90",
+                                 "G1 X0.00 Y0.00 F3000", "M400", "M118 ACQ 0", "G4 P100",
+                                 "M400", "M118 ACQ 1", "G4 P100",
+                                 "G1 X1.50 Y2.00 F3000", "M400", "M118 ACQ 2", "G4 P100", "M400"])
+        self.assertEqual(acquisitionLines, [5, 8, 12])
+        self.assertEqual(len(compiler.compile([[0, 0]], 3000)[0]), 7)
+
+        # the checksum example of the RepRap G-code reference, and the XOR of every character before the '*'
+        self.assertEqual(compiler.numberLine(3, "T0"), "N3 T0*57")
+        self.assertEqual(compiler.numberLine(1, "G28"), "N1 G28*18")
+        self.assertEqual(compiler.numberLine(0, "M110 N0"), "N0 M110 N0*125")
+
+        self.assertEqual(compiler.resendRequest("Error:checksum mismatch, Last Line: 11\nResend: 12\nok"), 12)
+        self.assertEqual(compiler.resendRequest("rs N7"), 7)
+        self.assertEqual(compiler.resendRequest("ok"), None)
+        self.assertEqual(compiler.resendRequest("Resend: "), None)
+        self.delayDisplay('Test passed!')
+
+    def test_SpectralLibrary(self):
+        """ Library classification and persistence, cache invalidation on a new dark frame, and outlier rejection of region references.
+    """
+        self.delayDisplay("Starting the spectral library test")
+        wavelengths = np.linspace(0, 1, 100)
+        tumor = np.exp(-((wavelengths - 0.3) / 0.05) ** 2)
+        healthy = np.exp(-((wavelengths - 0.7) / 0.05) ** 2)
+        library = SpectralLibrary()
+        for i in xrange(20):
+            library.addReference(tumor + 0.01 * i, "tumor")
+            library.addReference(healthy + 0.01 * i, "healthy")
+        self.assertTrue(library.hasClasses())
+        frames = np.vstack((tumor, healthy, 2 * tumor))
+        self.assertEqual(list(library.isTumor(frames)), [True, False, True])
+        library.metric = "cosine"
+        library.numberOfComponents = 2
+        self.assertEqual(list(library.isTumor(frames)), [True, False, True])
+        path = os.path.join(tempfile.mkdtemp(), "library.npz")
+        library.save(path)
+        loaded = SpectralLibrary()
+        loaded.load(path)
+        self.assertEqual(loaded.labels, library.labels)
+        self.assertTrue(np.allclose(loaded.references(), library.references()))
+
+        # a new dark frame invalidates the cached reference matrix, even when it reuses the old array's id
+        library.preprocessor = SpectrumPreprocessor()
+        library.preprocessor.setDarkFrame(np.zeros(100))
+        key = library._referenceMatrix()['key']
+        library.preprocessor.setDarkFrame(np.full(100, 0.5))
+        self.assertNotEqual(library._referenceMatrix()['key'], key)
+        library.preprocessor.clearDarkFrame()
+        self.assertEqual(list(library.isTumor(np.vstack((tumor, healthy)))), [True, False])
+        library.preprocessor = None
+
+        random = np.random.RandomState(0)
+        frames = tumor + 0.01 * random.randn(30, 100)
+        frames[3] = healthy
+        mean, covariance, inliers = library.estimateReference(frames)
+        self.assertFalse(inliers[3])
+        self.assertEqual(inliers.sum(), 29)
+        self.assertTrue(np.allclose(mean, tumor, atol=0.02))
+        regionLibrary = SpectralLibrary()
+        regionLibrary.metric = "mahalanobis"
+        regionLibrary.addReference(mean, "tumor", covariance)
+        regionLibrary.addReference(healthy, "healthy")
+        self.assertEqual(list(regionLibrary.isTumor(np.vstack((tumor, healthy)))), [True, False])
+        self.delayDisplay('Test passed!')
+
+    def test_ThresholdCalibrator(self):
+        """ ROC curve, AUC and operating point of the calibrator, and labels surviving a recording round trip.
+    """
+        self.delayDisplay("Starting the threshold calibration test")
+        calibrator = ThresholdCalibrator()
+        scores = np.array([1, 2, 3, 4, 5, 6, 7, 8], dtype=float)
+        labels = np.array([1, 1, 1, 0, 1, 0, 0, -1])
+        curves = calibrator.curves(scores, labels)
+        self.assertAlmostEqual(calibrator.auc(curves), 11.0 / 12.0)
+        index = calibrator.operatingPoint(curves)
+        self.assertAlmostEqual(curves['thresholds'][index], 3.5)
+        self.assertAlmostEqual(curves['tpr'][index], 0.75)
+        self.assertAlmostEqual(curves['fpr'][index], 0.0)
+        calibrator.minimumSensitivity = 1.0
+        index = calibrator.operatingPoint(curves)
+        self.assertAlmostEqual(curves['thresholds'][index], 5.5)
+        path = os.path.join(tempfile.mkdtemp(), "recording")
+        ScanRecording(np.ones((4, 3)), labels=labels[:4]).save(path)
+        recording = ScanRecording.load(ScanRecording.findRecordings(os.path.dirname(path))[0])
+        self.assertEqual(list(recording.labels), [1, 1, 1, 0])
+        self.assertEqual(recording.spectra.shape, (4, 3))
+        self.delayDisplay('Test passed!')
+
+    def test_BatchReanalysis(self):
+        """ Recordings are re-labelled with the given classifier settings, directly and through the worker's pickle files.
+    """
+        self.delayDisplay("Starting the batch re-analysis test")
+        reference = np.linspace(0, 1, 100)
+        spectra = np.vstack((np.tile(reference, (5, 1)), np.tile(reference + 1, (3, 1))))
+        directory = tempfile.mkdtemp()
+        ScanRecording(spectra, labels=np.array([1, 1, 1, 1, 1, 0, 0, 1])).save(os.path.join(directory, "specimen"))
+        settings = {'library': None, 'preprocessor': SpectrumPreprocessor(), 'reference': reference,
+                    'calibrator': ThresholdCalibrator(), 'metric': "euclidean", 'threshold': 1.0}
+        task = (os.path.join(directory, "specimen"), os.path.join(directory, "output"), settings, 3)
+        summary = reanalyzeRecording(task)
+        self.assertEqual(summary['frames'], 8)
+        self.assertAlmostEqual(summary['accuracy'], 7.0 / 8.0)
+        self.assertAlmostEqual(summary['specificity'], 1.0)
+        labels = np.load(os.path.join(directory, "output", "labels.npy"))
+        self.assertEqual(list(labels), [1, 1, 1, 1, 1, 0, 0, 0])
+
+        # the worker process reads its tasks from and writes the summaries to pickle files
+        with open(os.path.join(directory, "tasks.pkl"), 'wb') as taskFile:
+            pickle.dump([task, task], taskFile, 2)
+        SpectrumAnalysis.runBatch(os.path.join(directory, "tasks.pkl"), os.path.join(directory, "summaries.pkl"))
+        with open(os.path.join(directory, "summaries.pkl"), 'rb') as summaryFile:
+            summaries = pickle.load(summaryFile)
+        self.assertEqual([summary['frames'] for summary in summaries], [8, 8])
+
+        # without a worker interpreter the batch runs in a thread that reports like the worker process
+        thread = SpectrumAnalysis.BatchThread(os.path.join(directory, "tasks.pkl"), os.path.join(directory, "threaded.pkl"),
+                                              os.path.join(directory, "errors.txt"))
+        thread.start()
+        thread.join()
+        self.assertEqual(thread.poll(), 0)
+        self.assertTrue(os.path.exists(os.path.join(directory, "threaded.pkl")))
+        thread = SpectrumAnalysis.BatchThread(os.path.join(directory, "missing.pkl"), os.path.join(directory, "threaded.pkl"),
+                                              os.path.join(directory, "errors.txt"))
+        thread.start()
+        thread.join()
+        self.assertEqual(thread.poll(), 1)
+        with open(os.path.join(directory, "errors.txt")) as errorFile:
+            self.assertTrue("missing.pkl" in errorFile.read())
+        self.delayDisplay('Test passed!')
+
+    def test_PrinterDeviceManager(self):
+        """ A serpentine raster is split into blocks of whole rows with balanced stop counts.
+    """
+        self.delayDisplay("Starting the printer device manager test")
+        manager = PrinterDeviceManager()
+        # serpentine raster of 7 rows of 5 stops, as the multi-printer scan uses
+        waypoints = PrinterInteractorLogic().rasterWaypoints(0, 4, 0, 6, 1, 1)
+        parts = manager.partitionWaypoints(waypoints, 3)
+        self.assertEqual([len(part) for part in parts], [10, 15, 10])
+        self.assertTrue(np.allclose(np.vstack(parts), waypoints))
+        for previous, part in zip(parts[:-1], parts[1:]):
+            self.assertNotEqual(part[0, 1], previous[-1, 1])  # every block starts with a whole row
+        self.assertEqual(list(parts[2][:5, 0]), [4, 3, 2, 1, 0])  # rows keep their direction
+        self.delayDisplay('Test passed!')
+
+    def test_ScanPointStore(self):
+        """ Columns grow on append, wrap into vtkPoints, and keep their capacity across a reset.
+    """
+        self.delayDisplay("Starting the scan point store test")
+        store = ScanPointStore(capacity=2)
+        for i in xrange(5):
+            store.append(i, 2 * i, 0, i % 2, float(i))
+        self.assertEqual(len(store), 5)
+        self.assertTrue(len(store.timestamps) >= 5)
+        self.assertTrue(np.allclose(store.points()[:, 1], [0, 2, 4, 6, 8]))
+        self.assertEqual(list(store.labels()), [0, 1, 0, 1, 0])
+        points = store.vtkPoints()
+        self.assertEqual(points.GetNumberOfPoints(), 5)
+        self.assertEqual(points.GetPoint(3), (3.0, 6.0, 0.0))
+        self.assertEqual(store.vtkPoints(store.labels() == 1).GetNumberOfPoints(), 2)
+        capacity = len(store.timestamps)
+        store.reset()
+        store.appendMany(np.zeros((3, 3)), [1, 1, 0])
+        self.assertEqual(len(store), 3)
+        self.assertEqual(len(store.timestamps), capacity)
+        self.delayDisplay('Test passed!')
+
+    def test_ScanPointCloud(self):
+        """ Vertices and glyph points follow the decimation, and updates only append the vertices of new points.
+    """
+        self.delayDisplay("Starting the scan point cloud test")
+        store = ScanPointStore(capacity=4)
+        cloud = ScanPointCloud(store, decimation=2)
+        store.appendMany(np.random.rand(5, 3), [0, 1, 0, 1, 1])
+        self.assertTrue(cloud.update())
+        self.assertFalse(cloud.update())
+        self.assertEqual(cloud.polyData.GetNumberOfPoints(), 5)
+        self.assertEqual(cloud.polyData.GetNumberOfVerts(), 3)  # points 0, 2, 4
+        store.appendMany(np.random.rand(4, 3), [1, 1, 1, 1])
+        cloud.update()
+        self.assertEqual(cloud.polyData.GetNumberOfVerts(), 5)  # points 6, 8 appended
+        labels = cloud.polyData.GetPointData().GetScalars()
+        self.assertEqual(labels.GetName(), "label")
+        self.assertEqual(labels.GetValue(1), 1)
+        # glyphs are placed on the masked points, so they are decimated like the vertices
+        cloud.maskedPoints.Update()
+        self.assertEqual(cloud.maskedPoints.GetOutput().GetNumberOfPoints(), 5)
+        cloud.setDecimation(3)
+        cloud.update()
+        cloud.maskedPoints.Update()
+        self.assertEqual(cloud.polyData.GetNumberOfVerts(), 3)  # points 0, 3, 6
+        self.assertEqual(cloud.maskedPoints.GetOutput().GetNumberOfPoints(), 3)
+        store.reset()
+        store.append(0, 0, 0, 1)
+        cloud.update()
+        self.assertEqual(cloud.polyData.GetNumberOfVerts(), 1)
+        # 10^5 points arriving in 100 batches, each update only appends the vertices of its batch
+        store = ScanPointStore()
+        cloud = ScanPointCloud(store)
+        positions = np.random.rand(1000, 3)
+        labels = np.ones(1000)
+        reallocations = 0
+        for batch in xrange(100):
+            store.appendMany(positions, labels)
+            vertexIds = cloud.vertexIds
+            marker = cloud.numberOfVertices - 1
+            if marker >= 0:
+                vertexIds[marker] = -1  # an update that rewrote the published vertices would overwrite this
+            self.assertTrue(cloud.update())
+            self.assertEqual(cloud.publishedModifiedCount, store.modifiedCount)
+            self.assertEqual(cloud.numberOfVertices, 1000 * (batch + 1))
+            self.assertEqual(cloud.polyData.GetNumberOfVerts(), 1000 * (batch + 1))
+            if cloud.vertexIds is not vertexIds:
+                reallocations += 1
+            if marker >= 0:
+                self.assertEqual(cloud.vertexIds[marker], -1)
+                cloud.vertexIds[marker] = marker
+        self.assertTrue(reallocations <= 6)  # the id buffer doubles from 2048
+        self.assertTrue(np.array_equal(cloud.vertexIds[:100000], np.arange(100000)))
+        self.delayDisplay('Test passed!')
+
+    def test_AdaptiveSpectrumAverager(self):
+        """ Clear stops are labelled after minFrames, ambiguous stops collect frames until the averager is full.
+    """
+        self.delayDisplay("Starting the adaptive averaging test")
+        randomState = np.random.RandomState(2)
+        averager = AdaptiveSpectrumAverager(threshold=10.0, confidence=3.0, minFrames=3, maxFrames=20)
+        # statistic far below the threshold: confident (tumor) as soon as minFrames are in
+        for i in xrange(3):
+            self.assertFalse(averager.isConfident())
+            averager.addFrame(np.ones(5) * i, 2.0 + randomState.normal(0, 0.5))
+        self.assertTrue(averager.isConfident())
+        self.assertTrue(averager.isTumor())
+        self.assertTrue(np.allclose(averager.frameMean, np.ones(5)))
+        self.assertTrue(np.allclose(averager.frameVariance(), np.ones(5)))
+        # statistic right at the threshold: never confident, collected until the averager is full
+        averager.reset()
+        while not averager.isFull():
+            averager.addFrame(np.zeros(5), 10.0 + randomState.normal(0, 2.0))
+            self.assertFalse(averager.isConfident())
+        self.assertEqual(averager.numberOfFrames, 20)
+        self.delayDisplay('Test passed!')
+
+    def test_FlyScanInterpolation(self):
+        """ Frames of a sweep are placed along the row from their timestamps and averaged into bins.
+    """
+        self.delayDisplay("Starting the fly scan interpolation test")
+        logic = PrinterInteractorLogic()
+        # 10 mm at 600 mm/min take 1 s, the sweep took 1.4 s so 0.2 s of overhead are spent at each end
+        timestamps = np.array([0.0, 0.2, 0.7, 1.2, 1.4])
+        positions = logic.interpolateSweepPositions(timestamps, 0.0, 1.4, 20.0, 30.0, 600.0)
+        self.assertTrue(np.allclose(positions, [20.0, 20.0, 25.0, 30.0, 30.0]))
+        backwards = logic.interpolateSweepPositions(np.array([0.5]), 0.0, 1.0, 30.0, 20.0, 600.0)
+        self.assertTrue(np.allclose(backwards, [25.0]))
+        means, counts = logic.binSweepFrames(np.array([20.1, 20.4, 21.9, 25.2, 40.0]), np.array([1.0, 3.0, 5.0, 7.0, 9.0]),
+                                             20.0, 1.0, 6)
+        self.assertEqual(list(counts), [2, 0, 1, 0, 0, 2])  # bins are clipped to the row
+        self.assertTrue(np.allclose(means[[0, 2, 5]], [2.0, 5.0, 8.0]))
+        self.assertTrue(np.isnan(means[1]))
+        self.delayDisplay('Test passed!')
+
+    def test_PipelineWorker(self):
+        """ The worker returns stops in capture order with a settings snapshot, and records predictions apart from the labels.
+    """
+        self.delayDisplay("Starting the pipeline worker test")
+        logic = PrinterInteractorLogic()
+        reference = np.sin(np.linspace(0, 3, 100)) + 2
+        logic.referenceIntensities = reference
+        logic.thresholdMetric = "euclidean"
+        logic.spectrumThreshold = 1.0
+        settings = copy.deepcopy(logic.classifierSettings())
+        logic.spectrumThreshold = 100.0  # changed after the snapshot, the worker must not see it
+        tumor = [True, False, False, True, False, True]
+        tasks = Queue.Queue()
+        results = Queue.Queue()
+        for stopIndex, isTumor in enumerate(tumor):
+            tasks.put((stopIndex, stopIndex * 2.0, 5.0, 100.0 + stopIndex, reference + (0 if isTumor else 1)))
+        tasks.put(None)
+        directory = tempfile.mkdtemp()
+        worker = threading.Thread(target=logic.runPipelineWorker, args=(settings, directory, tasks, results))
+        worker.start()
+        worker.join(30)
+        messages = []
+        while not results.empty():
+            messages.append(results.get_nowait())
+        self.assertEqual([kind for kind, value in messages], ['stop'] * len(tumor) + ['done'])
+        self.assertEqual([value[0] for kind, value in messages[:-1]], range(len(tumor)))
+        self.assertEqual([value[3] for kind, value in messages[:-1]], tumor)
+        self.assertEqual(messages[-1][1], len(tumor))
+
+        recordingPath = os.path.join(directory, os.listdir(directory)[0])
+        recording = ScanRecording.load(recordingPath)
+        self.assertTrue(np.all(np.asarray(recording.labels) == -1))
+        self.assertEqual(list(np.load(os.path.join(recordingPath, "predictions.npy"))), [int(value) for value in tumor])
+        self.assertTrue(np.allclose(recording.positions[:, 0], 2.0 * np.arange(len(tumor))))
+        self.assertTrue(np.allclose(recording.timestamps, 100.0 + np.arange(len(tumor))))
+        self.delayDisplay('Test passed!')
+
+    def test_ScanPlanner(self):
+        """ Predicted durations of step and pipelined scans, and the finest 0.01 mm grid that fits a time budget.
+    """
+        self.delayDisplay("Starting the scan planner test")
+        logic = PrinterInteractorLogic()
+        waypoints = logic.rasterWaypoints(0, 10, 0, 10, 5, 5)
+        moves = logic.moveModel.moveTimes(waypoints)
+        self.assertEqual(len(waypoints), 9)
+        self.assertAlmostEqual(logic.predictScanDuration(waypoints, 200), moves.sum() + 9 * 0.2)
+        self.assertAlmostEqual(logic.predictScanDuration(waypoints, 200, pipelined=True),
+                               np.maximum(moves, 0.2).sum() + 0.2)
+
+        resolution, waypoints, seconds = logic.planScanResolution(0, 20, 0, 20, 60.0, 200)
+        self.assertTrue(seconds <= 60.0)
+        self.assertAlmostEqual(resolution * 100, round(resolution * 100))
+        self.assertTrue(np.allclose(waypoints, np.round(waypoints, 2)))
+        self.assertEqual(len(waypoints), len(logic.rasterWaypoints(0, 20, 0, 20, resolution, resolution)))
+        self.assertAlmostEqual(logic.predictScanDuration(waypoints, 200), seconds)
+        # a finer grid does not fit, a pipelined scan of the same budget does
+        finer = logic.rasterWaypoints(0, 20, 0, 20, resolution - 0.05, resolution - 0.05)
+        self.assertTrue(logic.predictScanDuration(finer, 200) > 60.0)
+        self.assertTrue(logic.planScanResolution(0, 20, 0, 20, 60.0, 200, pipelined=True)[0] <= resolution)
+        self.assertEqual(logic.planScanResolution(0, 20, 0, 20, 1e6, 200)[0], 0.1)
+        self.assertEqual(logic.planScanResolution(0, 20, 0, 20, 0.1, 200), None)
+        self.delayDisplay('Test passed!')
+
+    def test_SpectrumChartThrottling(self):
+        """ A burst of frames is drawn once, a steady stream at most chartMaximumRateHz times per second, a hidden chart never.
+    """
+        self.delayDisplay("Starting the spectrum chart throttling test")
+        logic = PrinterInteractorLogic()
+        # a simulated clock in ms, scheduled redraws run when the clock reaches them, so scheduler jitter does not matter
+        clockMs = [100000]
+        scheduledMs = []
+        chartUpdates = []
+
+        def countChartUpdate():
+            logic.chartUpdatePending = False
+            logic.lastChartUpdateTime = logic.chartClock()
+            chartUpdates.append(clockMs[0])
+
+        def advance(milliseconds):
+            for step in xrange(milliseconds):
+                clockMs[0] += 1
+                while scheduledMs and scheduledMs[0] <= clockMs[0]:
+                    scheduledMs.pop(0)
+                    countChartUpdate()
+
+        logic.chartClock = lambda: clockMs[0] / 1000.0
+        logic.scheduleChartUpdate = lambda delayMs: scheduledMs.append(clockMs[0] + delayMs)
+        logic.updateChart = countChartUpdate
+        logic.isChartVisible = lambda: True
+        logic.chartMaximumRateHz = 10.0
+        for frame in xrange(50):
+            logic.requestChartUpdate()
+        advance(300)
+        self.assertEqual(len(chartUpdates), 1)
+
+        del chartUpdates[:]
+        for frame in xrange(100):  # 100 frames per second for one second
+            logic.requestChartUpdate()
+            advance(10)
+        advance(200)
+        self.assertEqual(len(chartUpdates), 11)  # the first frame at once, then one redraw per 100 ms until the last one is drawn
+        self.assertTrue(np.diff(chartUpdates).min() >= 100)
+
+        del chartUpdates[:]
+        logic.isChartVisible = lambda: False
+        for frame in xrange(10):
+            logic.requestChartUpdate()
+        advance(200)
+        self.assertEqual(len(chartUpdates), 0)
+        self.delayDisplay('Test passed!')
+
+    def test_ScanProgressModel(self):
+        """ Only completed stops reach the stop observers, timed scans report their schedule plus the motion lag.
+    """
+        self.delayDisplay("Starting the scan progress test")
+        progress = ScanProgressModel()
+        stopCalls = []
+        changeCalls = []
+        progress.addStopObserver(lambda model: stopCalls.append(model.completedStops))
+        progress.addObserver(lambda model: changeCalls.append(model.completedStops))
+        progress.reset(10, 500)
+        progress.stopCompleted()
+        progress.recordDrift(3.0, 60.0)  # a position check answer is not a completed stop
+        self.assertEqual(stopCalls, [1])
+        self.assertEqual(changeCalls, [1, 1])
+        self.assertEqual(progress.measuredStopCostMs, 500)  # timed stops are not measured
+        self.assertAlmostEqual(progress.remainingTimeMs(), 9 * 500 + 60.0)
+        self.assertEqual(progress.scheduleLagMs(), 60.0)
+        progress.reset(4, 0)
+        progress.lastStopTime = time.time() - 0.2
+        progress.stopCompleted()
+        self.assertTrue(150 < progress.measuredStopCostMs < 400)
+        self.delayDisplay('Test passed!')
+
+    def test_SpanTracer(self):
+        """ The ring buffer drops the oldest span when full, and the Chrome trace export keeps the span order and durations.
+    """
+        self.delayDisplay("Starting the span tracer test")
+        tracer = SpanTracer(capacity=3)
+        tracer.start()
+        self.assertEqual(len(tracer), 0)
+        start = time.time()
+        tracer.record("move", "printer", start, start + 0.002)
+        tracer.record("classify", "classification", start + 0.002, start + 0.003)
+        tracer.record("move", "printer", start + 0.003, start + 0.005)
+        tracer.record("move", "printer", start + 0.005, start + 0.006)
+        self.assertEqual(len(tracer), 3)
+        self.assertEqual(tracer.droppedSpans, 1)
+        self.assertEqual(len(tracer.keys), 2)
+        path = os.path.join(tempfile.mkdtemp(), "trace.json")
+        self.assertEqual(tracer.exportChromeTrace(path), 3)
+        with open(path) as traceFile:
+            events = json.load(traceFile)["traceEvents"]
+        self.assertEqual([event["name"] for event in events], ["move", "classify", "move"])
+        self.assertEqual(events[1]["ph"], "X")
+        self.assertAlmostEqual(events[1]["dur"], 1000.0, delta=1.0)
+        self.delayDisplay('Test passed!')
+
+    def test_SignalQualityScorer(self):
+        """ Low SNR and clipped spectra are rejected, their stops are queued and never reported as healthy.
+    """
+        self.delayDisplay("Starting the signal quality test")
+        wavelengths = np.linspace(-1, 1, 200)
+        spectrum = 1000.0 * np.exp(-wavelengths ** 2 / 0.1)
+        noise = np.random.RandomState(0).normal(0, 5.0, (3, 200))
+        batch = np.vstack((spectrum + noise[0], 0.02 * spectrum + noise[1], np.minimum(spectrum + noise[2], 600.0)))
+        scorer = SignalQualityScorer()
+        snr, saturation = scorer.scores(batch)
+        self.assertTrue(snr[0] > 100)
+        self.assertTrue(snr[1] < 10)  # poor probe contact
+        self.assertTrue(saturation[2] > 0.1)  # clipped detector
+        self.assertTrue(saturation[0] < 0.01)
+        self.assertEqual(list(scorer.isAcceptable(snr, saturation)), [True, False, False])
+        scorer.saturationLevel = 600.0
+        self.assertTrue(scorer.saturation(batch[0])[0] > 0.1)
+        # rejected stops are queued, quadrant checks keep an unknown slot so findTrajectory reads the right quadrants
+        logic = PrinterInteractorLogic()
+        logic.qualityCheck = True
+        logic.createTumorArray = 1
+        logic.commandedXcoordinate, logic.commandedYcoordinate = 3.0, 4.0
+        self.assertFalse(logic.checkSignalQuality(batch[1]))
+        logic.applyPipelineResult(0, 5.0, 6.0, False, snr[2], saturation[2])
+        logic.applyPipelineResult(1, 7.0, 8.0, False, snr[0], saturation[0])
+        self.assertEqual(logic._tumorCheck, [-1, -1, 0])
+        self.assertEqual(logic.lowQualityStops, [(3.0, 4.0), (5.0, 6.0)])
+        self.assertEqual(len(logic.scanPoints), 1)
+        logic.resetScanSession()
+        self.assertEqual(logic.lowQualityStops, [])
+        self.delayDisplay('Test passed!')
+
+    def test_SpatialHashIndex(self):
+        """ One record per cell, nearest and neighbourhood lookups bounded by radius and age.
+    """
+        self.delayDisplay("Starting the spatial hash index test")
+        index = SpatialHashIndex(1.0)
+        index.insert(10.2, 20.2, True, 3.0)
+        index.insert(10.4, 20.4, False, 30.0)  # same cell, replaces the first record
+        index.insert(12.0, 20.0, True, 4.0)
+        index.insert(-0.5, -0.5, False)
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.nearest(10.0, 20.0, 1.0)[2], False)
+        self.assertEqual(index.nearest(11.6, 20.0, 1.0)[2], True)
+        self.assertEqual(index.nearest(-0.2, -0.2, 0.5)[2], False)
+        self.assertEqual(index.nearest(15.0, 20.0, 1.0), None)
+        self.assertEqual(len(index.neighbourhood(11.0, 20.0, 2.0)), 2)
+        self.assertEqual(index.nearest(10.0, 20.0, 1.0, maximumAge=-1), None)
+        self.delayDisplay('Test passed!')
+
+    def test_SpectrumRingBuffer(self):
+        """ Windows, running mean and variance stay correct after the buffer wraps around.
+    """
+        self.delayDisplay("Starting the spectrum ring buffer test")
+        buffer = SpectrumRingBuffer(4, 3)
+        frames = np.arange(21, dtype=float).reshape(7, 3)
+        for i in xrange(7):
+            buffer.append(frames[i], timestamp=i, position=(i, -i))
+        self.assertEqual(len(buffer), 4)
+        window, timestamps, positions = buffer.window()
+        self.assertTrue(np.allclose(window, frames[3:]))
+        self.assertTrue(np.allclose(timestamps, [3, 4, 5, 6]))
+        self.assertTrue(np.allclose(positions[:, 1], [-3, -4, -5, -6]))
+        self.assertTrue(np.allclose(buffer.window(2)[0], frames[5:]))
+        self.assertTrue(np.allclose(buffer.framesSince(5)[0], frames[5:]))
+        self.assertTrue(np.allclose(buffer.latest(), frames[6]))
+        self.assertTrue(np.allclose(buffer.mean(), frames[3:].mean(axis=0)))
+        self.assertTrue(np.allclose(buffer.variance(), frames[3:].var(axis=0, ddof=1)))
+        self.delayDisplay('Test passed!')
+
+    def test_PointSetRegistration(self):
+        """ Registration recovers a known similarity transform, with and without correspondences.
+    """
+        self.delayDisplay("Starting the point set registration test")
+        randomState = np.random.RandomState(0)
+        angle = 0.3
+        expected = np.eye(4)
+        expected[:3, :3] = 1.5 * np.array([[math.cos(angle), -math.sin(angle), 0],
+                                           [math.sin(angle), math.cos(angle), 0],
+                                           [0, 0, 1]])
+        expected[:3, 3] = [10, -5, 2]
+        registration = PointSetRegistration()
+
+        source = randomState.uniform(-20, 20, (6, 3))
+        target = registration.transformPoints(expected, source)
+        matrix = registration.similarityTransform(source, target)
+        self.assertTrue(np.allclose(matrix, expected))
+        self.assertLess(registration.residuals(matrix, source, target).max(), 1e-9)
+        self.assertLess(registration.leaveOneOutErrors(source, target).max(), 1e-9)
+
+        cloud = randomState.uniform(-20, 20, (2000, 3)) * [1, 0.5, 0.2]
+        target = registration.transformPoints(expected, cloud)
+        source = cloud[randomState.permutation(len(cloud))[:500]]
+        initial = expected.copy()
+        initial[:3, 3] += [1, -1, 0.5]
+        matrix, rmsDistance, iterations = registration.icp(source, target, initial)
+        self.assertLess(rmsDistance, 1e-3)
+        self.delayDisplay('Test passed!')
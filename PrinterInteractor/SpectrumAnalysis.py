@@ -0,0 +1,541 @@
+import os
+import sys
+import time
+import math
+import pickle
+import threading
+import traceback
+import multiprocessing
+import numpy as np
+
+# Spectrum analysis shared by the PrinterInteractor module and the batch re-analysis worker. Nothing here imports slicer, so the
+# worker runs in a plain Python interpreter: python SpectrumAnalysis.py <tasks> <results> <processes>. It runs on Python 2 and 3.
+
+
+#
+# SpectrumPreprocessor
+#
+
+class SpectrumPreprocessor(object):
+    """Dark-frame subtraction, polynomial baseline removal, Savitzky-Golay
+  smoothing and area or peak normalization of spectra. The last axis of the
+  input holds the intensities, so a single spectrum, a batch of frames or a
+  recorded (rows, columns, points) cube are processed the same way. Every step
+  is a NumPy operation over the whole batch, the fit matrices and filter
+  kernels are computed once per spectrum length / window and cached.
+  """
+
+    def __init__(self):
+        self.darkFrame = None
+        self.baselineOrder = -1  # -1 disables baseline removal
+        self.baselineIterations = 10  # iterative fit keeps peaks out of the baseline
+        self.smoothingWindow = 0  # 0 disables smoothing, otherwise an odd number of points
+        self.smoothingOrder = 2
+        self.normalization = "none"  # "none", "area" or "peak"
+        self.darkFrameVersion = 0  # bumped by every dark frame change, cached results compare it
+        self._baselineMatrices = {}
+        self._smoothingKernels = {}
+
+    def setDarkFrame(self, darkFrame):
+        darkFrame = np.asarray(darkFrame, dtype=float)
+        if darkFrame.ndim > 1:
+            darkFrame = darkFrame.reshape(-1, darkFrame.shape[-1]).mean(axis=0)
+        self.darkFrame = darkFrame
+        self.darkFrameVersion = self.darkFrameVersion + 1
+
+    def clearDarkFrame(self):
+        self.darkFrame = None
+        self.darkFrameVersion = self.darkFrameVersion + 1
+
+    def process(self, spectra):
+        spectra = np.asarray(spectra, dtype=float)
+        shape = spectra.shape
+        batch = spectra.reshape(-1, shape[-1])
+        if self.darkFrame is not None:
+            batch = batch - self.darkFrame
+        if self.baselineOrder >= 0:
+            batch = self.removeBaseline(batch)
+        if self.smoothingWindow > 1:
+            batch = self.smooth(batch)
+        if self.normalization == "area":
+            batch = batch / self._safeScale(np.abs(batch).sum(axis=1))
+        elif self.normalization == "peak":
+            batch = batch / self._safeScale(np.abs(batch).max(axis=1))
+        return batch.reshape(shape)
+
+    def removeBaseline(self, batch):
+        vandermonde, pseudoInverse = self.baselineMatrices(batch.shape[1])
+        fitted = batch
+        for iteration in range(max(self.baselineIterations, 1)):
+            baseline = np.dot(np.dot(fitted, pseudoInverse.T), vandermonde.T)
+            fitted = np.minimum(fitted, baseline)
+        return batch - baseline
+
+    def smooth(self, batch):
+        kernel = self.smoothingKernel(self.smoothingWindow, self.smoothingOrder)
+        halfWidth = len(kernel) // 2
+        padded = np.pad(batch, ((0, 0), (halfWidth, halfWidth)), mode="reflect")
+        numberOfPoints = batch.shape[1]
+        smoothed = np.zeros_like(batch)
+        for offset in range(len(kernel)):
+            smoothed += kernel[offset] * padded[:, offset:offset + numberOfPoints]
+        return smoothed
+
+    def baselineMatrices(self, numberOfPoints):
+        if numberOfPoints not in self._baselineMatrices:
+            x = np.linspace(-1.0, 1.0, numberOfPoints)
+            vandermonde = np.vander(x, self.baselineOrder + 1)
+            self._baselineMatrices[numberOfPoints] = (vandermonde, np.linalg.pinv(vandermonde))
+        vandermonde, pseudoInverse = self._baselineMatrices[numberOfPoints]
+        if vandermonde.shape[1] != self.baselineOrder + 1:
+            del self._baselineMatrices[numberOfPoints]
+            return self.baselineMatrices(numberOfPoints)
+        return vandermonde, pseudoInverse
+
+    def smoothingKernel(self, window, order):
+        if (window, order) not in self._smoothingKernels:
+            halfWidth = window // 2
+            offsets = np.arange(-halfWidth, halfWidth + 1, dtype=float)
+            design = np.vander(offsets, min(order, window - 1) + 1, increasing=True)
+            # the smoothed value is the constant term of the local polynomial fit
+            self._smoothingKernels[(window, order)] = np.linalg.pinv(design)[0]
+        return self._smoothingKernels[(window, order)]
+
+    def _safeScale(self, scale):
+        scale = np.where(scale == 0, 1.0, scale)
+        return scale[:, np.newaxis]
+
+
+#
+# SignalQualityScorer
+#
+
+class SignalQualityScorer(object):
+    """Signal to noise ratio and saturation of a batch of spectra (last axis holds
+  the intensities). The signal is the spread between the 5th and 95th intensity
+  percentiles, the noise a robust (median absolute deviation) estimate from the
+  second differences, which cancel the smooth spectral shape. Saturation is the
+  fraction of points clipped at saturationLevel, or repeated at the frame
+  maximum when the detector full scale is not known. Poor probe contact shows
+  up as a low SNR, glare as saturation.
+  """
+
+    def __init__(self):
+        self.minimumSnr = 10.0
+        self.saturationLevel = None  # detector full scale, None detects a flat clipped top
+        self.maximumSaturation = 0.02  # fraction of clipped points
+
+    def snr(self, spectra):
+        batch = np.asarray(spectra, dtype=float)
+        batch = batch.reshape(-1, batch.shape[-1])
+        low, high = np.percentile(batch, [5, 95], axis=1)
+        secondDifferences = np.diff(batch, n=2, axis=1)
+        deviations = np.abs(secondDifferences - np.median(secondDifferences, axis=1)[:, np.newaxis])
+        noise = 1.4826 * np.median(deviations, axis=1) / math.sqrt(6.0)  # second differences of white noise have variance 6 sigma^2
+        return (high - low) / np.maximum(noise, 1e-12)
+
+    def saturation(self, spectra):
+        batch = np.asarray(spectra, dtype=float)
+        batch = batch.reshape(-1, batch.shape[-1])
+        if self.saturationLevel is not None:
+            return (batch >= self.saturationLevel).mean(axis=1)
+        maxima = batch.max(axis=1)[:, np.newaxis]
+        return ((batch >= maxima).sum(axis=1) - 1) / float(batch.shape[1])
+
+    def scores(self, spectra):
+        return self.snr(spectra), self.saturation(spectra)
+
+    def isAcceptable(self, snr, saturation):
+        return (np.asarray(snr) >= self.minimumSnr) & (np.asarray(saturation) <= self.maximumSaturation)
+
+
+#
+# ScanRecording
+#
+
+class ScanRecording(object):
+    """A recorded scan stored as a directory of .npy files: spectra (frames,
+  points), positions (frames, 2), timestamps and labels (1 tumor, 0 healthy,
+  -1 unknown). Plain .npy files are loaded memory-mapped, so recordings larger
+  than memory can be analysed and nothing is copied until it is read.
+  """
+
+    fileNames = ("spectra", "positions", "timestamps", "labels")
+
+    def __init__(self, spectra, positions=None, timestamps=None, labels=None, path=None):
+        self.spectra = spectra
+        numberOfFrames = len(spectra)
+        self.positions = np.full((numberOfFrames, 2), np.nan) if positions is None else positions
+        self.timestamps = np.zeros(numberOfFrames) if timestamps is None else timestamps
+        self.labels = np.full(numberOfFrames, -1, dtype=np.int8) if labels is None else labels
+        self.path = path
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        arrays = {}
+        for name in cls.fileNames:
+            fileName = os.path.join(directory, name + ".npy")
+            if os.path.exists(fileName):
+                arrays[name] = np.load(fileName, mmap_mode='r' if mmap else None)
+        return cls(path=directory, **arrays)
+
+    @classmethod
+    def findRecordings(cls, directory):
+        # the directory itself when it is a recording, its recording subdirectories otherwise
+        if os.path.exists(os.path.join(directory, "spectra.npy")):
+            return [directory]
+        recordings = []
+        for name in sorted(os.listdir(directory)):
+            if os.path.exists(os.path.join(directory, name, "spectra.npy")):
+                recordings.append(os.path.join(directory, name))
+        return recordings
+
+    def save(self, directory):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        np.save(os.path.join(directory, "spectra.npy"), np.asarray(self.spectra, dtype=float))
+        np.save(os.path.join(directory, "positions.npy"), np.asarray(self.positions, dtype=float))
+        np.save(os.path.join(directory, "timestamps.npy"), np.asarray(self.timestamps, dtype=float))
+        np.save(os.path.join(directory, "labels.npy"), np.asarray(self.labels, dtype=np.int8))
+        self.path = directory
+
+
+#
+# Batch Re-analysis
+#
+
+def classifySpectra(spectra, settings):
+    """Tumor mask of a batch of spectra for the classifier described by settings
+  (see PrinterInteractorLogic.classifierSettings). Shared by the live
+  classification and the batch re-analysis workers.
+  """
+    library = settings['library']
+    if library is not None and library.hasClasses():
+        return library.isTumor(spectra)
+    processed = settings['preprocessor'].process(spectra)
+    reference = settings['preprocessor'].process(settings['reference'])
+    scores = settings['calibrator'].scores(processed, reference, settings['metric'])
+    return np.abs(scores) < settings['threshold']
+
+def reanalyzeRecording(task):
+    """Pool worker re-labelling one recording. Only the recording path and the
+  classifier settings are pickled, the spectra are memory-mapped by the worker
+  and classified in chunks. Writes labels.npy and positions.npy to the output
+  directory and returns a summary row.
+  """
+    path, outputDirectory, settings, chunkSize = task
+    startTime = time.time()
+    recording = ScanRecording.load(path)
+    labels = np.zeros(len(recording.spectra), dtype=np.int8)
+    for start in range(0, len(labels), chunkSize):
+        labels[start:start + chunkSize] = classifySpectra(np.asarray(recording.spectra[start:start + chunkSize]), settings)
+    if not os.path.exists(outputDirectory):
+        os.makedirs(outputDirectory)
+    np.save(os.path.join(outputDirectory, "labels.npy"), labels)
+    np.save(os.path.join(outputDirectory, "positions.npy"), np.asarray(recording.positions, dtype=float))
+    truth = np.asarray(recording.labels)
+    known = truth >= 0
+    summary = {'recording': os.path.basename(os.path.normpath(path)), 'frames': len(labels),
+               'tumorFraction': float(labels.mean()) if len(labels) else 0.0,
+               'labelled': int(known.sum()), 'accuracy': float('nan'), 'sensitivity': float('nan'),
+               'specificity': float('nan'), 'seconds': 0.0}
+    if known.any():
+        summary['accuracy'] = float((labels[known] == truth[known]).mean())
+    if (truth == 1).any():
+        summary['sensitivity'] = float((labels[truth == 1] == 1).mean())
+    if (truth == 0).any():
+        summary['specificity'] = float((labels[truth == 0] == 0).mean())
+    summary['seconds'] = time.time() - startTime
+    return summary
+
+
+#
+# ThresholdCalibrator
+#
+
+class ThresholdCalibrator(object):
+    """Statistics comparing spectra with the tumor reference and ROC /
+  precision-recall calibration of the threshold on them. A frame is labelled
+  tumor when the absolute statistic is below the threshold. The curves are
+  computed for every distinct threshold at once from one sort and cumulative
+  sums over all labelled frames.
+  """
+
+    metrics = ("difference", "euclidean", "cosine")
+
+    def __init__(self):
+        self.minimumSensitivity = 0.0  # 0 picks the Youden point, otherwise the lowest false positive rate reaching it
+
+    def scores(self, processed, reference, metric="difference"):
+        if metric == "difference":
+            return np.sum(reference - processed, axis=1)
+        if metric == "euclidean":
+            return np.sqrt(((processed - reference) ** 2).sum(axis=1))
+        if metric == "cosine":
+            norms = np.maximum(np.sqrt((processed * processed).sum(axis=1)) * np.sqrt(np.dot(reference, reference)), 1e-12)
+            return 1.0 - np.dot(processed, reference) / norms
+        raise ValueError("Unknown metric " + str(metric))
+
+    def curves(self, scores, labels):
+        scores = np.abs(np.asarray(scores, dtype=float))
+        labels = np.asarray(labels)
+        known = labels >= 0
+        scores = scores[known]
+        tumor = labels[known] == 1
+        order = np.argsort(scores, kind='mergesort')
+        sortedScores = scores[order]
+        truePositives = np.cumsum(tumor[order])
+        falsePositives = np.cumsum(~tumor[order])
+        # one point per distinct score, the threshold lies between it and the next larger score
+        last = np.append(np.nonzero(np.diff(sortedScores))[0], len(sortedScores) - 1)
+        thresholds = np.append((sortedScores[last[:-1]] + sortedScores[last[:-1] + 1]) / 2.0, sortedScores[-1] + 1.0)
+        truePositives = truePositives[last].astype(float)
+        falsePositives = falsePositives[last].astype(float)
+        return {
+            'thresholds': np.append(sortedScores[0], thresholds),
+            'tpr': np.append(0.0, truePositives / max(tumor.sum(), 1)),
+            'fpr': np.append(0.0, falsePositives / max((~tumor).sum(), 1)),
+            'precision': np.append(1.0, truePositives / (truePositives + falsePositives)),
+        }
+
+    def auc(self, curves):
+        return float(np.sum(np.diff(curves['fpr']) * (curves['tpr'][1:] + curves['tpr'][:-1]) / 2.0))
+
+    def operatingPoint(self, curves):
+        if self.minimumSensitivity > 0:
+            candidates = np.nonzero(curves['tpr'] >= self.minimumSensitivity)[0]
+            return candidates[np.argmin(curves['fpr'][candidates])]
+        return int(np.argmax(curves['tpr'] - curves['fpr']))
+
+    def saveCurves(self, path, curves):
+        table = np.column_stack((curves['thresholds'], curves['tpr'], curves['fpr'], curves['precision']))
+        np.savetxt(path, table, delimiter=",", header="threshold,tpr,fpr,precision", comments="")
+
+
+#
+# SpectralLibrary
+#
+
+class SpectralLibrary(object):
+    """Labelled reference spectra stored as the rows of one contiguous matrix.
+  A batch of frames is classified with one matrix product against all
+  references followed by an argmin, using euclidean or cosine distance and
+  optionally a PCA projection of the references. References learned from a
+  region carry the covariance of their frames; the Mahalanobis metric whitens
+  frames and references with the pooled (shrunk) covariance so it is still one
+  matrix product. The preprocessed (and projected) reference matrix is cached
+  until a reference or a preprocessing setting changes. Libraries are saved
+  and loaded as .npz archives.
+  """
+
+    def __init__(self):
+        self.metric = "euclidean"  # "euclidean", "cosine" or "mahalanobis"
+        self.numberOfComponents = 0  # number of principal components compared, 0 compares full spectra
+        self.shrinkage = 0.1  # weight of the scaled identity mixed into the pooled covariance, keeps it invertible
+        self.outlierCutoff = 3.5  # robust z-score above which a frame is left out of a region reference
+        self.tumorLabel = "tumor"
+        self.preprocessor = None  # SpectrumPreprocessor applied to references and frames alike
+        self.clear()
+
+    def clear(self):
+        self._spectra = np.zeros((0, 0))
+        self.numberOfReferences = 0
+        self.labels = []
+        self.covariances = []  # covariance of the preprocessed frames of each reference, None for single frames
+        self._cache = None
+
+    def references(self):
+        return self._spectra[:self.numberOfReferences]
+
+    def addReference(self, spectrum, label, covariance=None):
+        spectrum = np.asarray(spectrum, dtype=float).ravel()
+        if self.numberOfReferences == 0:
+            self._spectra = np.zeros((8, len(spectrum)))
+        if len(spectrum) != self._spectra.shape[1]:
+            raise ValueError("Reference has {0} points, the library holds spectra of {1} points".format(
+                len(spectrum), self._spectra.shape[1]))
+        if self.numberOfReferences == len(self._spectra):
+            spectra = np.zeros((2 * len(self._spectra), self._spectra.shape[1]))
+            spectra[:self.numberOfReferences] = self._spectra
+            self._spectra = spectra
+        self._spectra[self.numberOfReferences] = spectrum
+        self.labels.append(str(label))
+        self.covariances.append(None if covariance is None else np.asarray(covariance, dtype=float))
+        self.numberOfReferences = self.numberOfReferences + 1
+        self._cache = None
+
+    def estimateReference(self, frames):
+        # Mean of the frames of a region and covariance of their preprocessed values. Frames whose distance to the median
+        # spectrum has a robust (median absolute deviation) z-score above outlierCutoff are left out.
+        frames = np.atleast_2d(np.asarray(frames, dtype=float))
+        processed = self._preprocess(frames)
+        distances = np.sqrt(((processed - np.median(processed, axis=0)) ** 2).sum(axis=1))
+        deviation = distances - np.median(distances)
+        mad = np.median(np.abs(deviation))
+        inliers = np.ones(len(frames), dtype=bool)
+        if mad > 0:
+            inliers = 0.6745 * deviation / mad < self.outlierCutoff
+        covariance = None
+        if inliers.sum() > 1:
+            covariance = np.cov(processed[inliers], rowvar=False)
+        return frames[inliers].mean(axis=0), covariance, inliers
+
+    def hasClasses(self):
+        # nearest reference classification needs tumor and at least one other tissue class
+        return self.tumorLabel in self.labels and len(set(self.labels)) > 1
+
+    def save(self, path):
+        numberOfPoints = self._spectra.shape[1]
+        covariances = np.zeros((self.numberOfReferences, numberOfPoints, numberOfPoints))
+        hasCovariance = np.zeros(self.numberOfReferences, dtype=bool)
+        for index, covariance in enumerate(self.covariances):
+            if covariance is not None:
+                covariances[index] = covariance
+                hasCovariance[index] = True
+        np.savez(path, spectra=self.references(), labels=np.array(self.labels), covariances=covariances,
+                 hasCovariance=hasCovariance)
+
+    def load(self, path):
+        archive = np.load(path)
+        self.clear()
+        for index, (spectrum, label) in enumerate(zip(archive['spectra'], archive['labels'])):
+            covariance = None
+            if 'hasCovariance' in archive.files and archive['hasCovariance'][index]:
+                covariance = archive['covariances'][index]
+            self.addReference(spectrum, label, covariance)
+
+    def pooledCovariance(self):
+        covariances = [covariance for covariance in self.covariances if covariance is not None]
+        if not covariances:
+            return None
+        return np.mean(covariances, axis=0)
+
+    def _settingsKey(self):
+        preprocessor = self.preprocessor
+        if preprocessor is None:
+            return (self.metric, self.numberOfComponents)
+        return (self.metric, self.numberOfComponents, preprocessor.darkFrameVersion, preprocessor.baselineOrder,
+                preprocessor.baselineIterations, preprocessor.smoothingWindow, preprocessor.smoothingOrder,
+                preprocessor.normalization)
+
+    def _preprocess(self, spectra):
+        if self.preprocessor is None:
+            return np.asarray(spectra, dtype=float)
+        return self.preprocessor.process(spectra)
+
+    def _referenceMatrix(self):
+        key = self._settingsKey()
+        if self._cache is not None and self._cache['key'] == key:
+            return self._cache
+        cache = {'key': key, 'mean': None, 'basis': None, 'whitening': None}
+        matrix = self._preprocess(self.references())
+        if 0 < self.numberOfComponents and 1 < self.numberOfReferences:
+            cache['mean'] = matrix.mean(axis=0)
+            basis = np.linalg.svd(matrix - cache['mean'], full_matrices=False)[2]
+            cache['basis'] = basis[:self.numberOfComponents].T
+            matrix = np.dot(matrix - cache['mean'], cache['basis'])
+        covariance = self.pooledCovariance()
+        if self.metric == "mahalanobis" and covariance is not None:
+            if cache['basis'] is not None:
+                covariance = np.dot(cache['basis'].T, np.dot(covariance, cache['basis']))
+            scale = max(np.trace(covariance) / len(covariance), 1e-12)
+            covariance = (1.0 - self.shrinkage) * covariance + self.shrinkage * scale * np.eye(len(covariance))
+            # |L^-1 x| is the Mahalanobis norm of x for covariance = L L^T
+            cache['whitening'] = np.linalg.inv(np.linalg.cholesky(covariance)).T
+            matrix = np.dot(matrix, cache['whitening'])
+        if self.metric == "cosine":
+            matrix = matrix / np.maximum(np.sqrt((matrix * matrix).sum(axis=1)), 1e-12)[:, np.newaxis]
+        cache['matrix'] = matrix
+        cache['squaredNorms'] = (matrix * matrix).sum(axis=1)
+        cache['isTumor'] = np.array([label == self.tumorLabel for label in self.labels], dtype=bool)
+        self._cache = cache
+        return cache
+
+    def project(self, batch):
+        cache = self._referenceMatrix()
+        batch = self._preprocess(np.atleast_2d(batch))
+        if cache['basis'] is not None:
+            batch = np.dot(batch - cache['mean'], cache['basis'])
+        if cache['whitening'] is not None:
+            batch = np.dot(batch, cache['whitening'])
+        return batch
+
+    def distances(self, batch):
+        # (frames, references) distance matrix
+        cache = self._referenceMatrix()
+        batch = self.project(batch)
+        products = np.dot(batch, cache['matrix'].T)
+        if self.metric == "cosine":
+            norms = np.maximum(np.sqrt((batch * batch).sum(axis=1)), 1e-12)
+            return 1.0 - products / norms[:, np.newaxis]
+        squaredDistances = (batch * batch).sum(axis=1)[:, np.newaxis] - 2.0 * products + cache['squaredNorms']
+        return np.sqrt(np.maximum(squaredDistances, 0))
+
+    def classify(self, batch):
+        # index of and distance to the nearest reference of every frame
+        distances = self.distances(batch)
+        nearest = np.argmin(distances, axis=1)
+        return nearest, distances[np.arange(len(nearest)), nearest]
+
+    def isTumor(self, batch):
+        return self._referenceMatrix()['isTumor'][self.classify(batch)[0]]
+
+
+#
+# Batch Re-analysis Worker
+#
+
+def runBatch(taskPath, resultPath, processes=1):
+    """Re-analyses the pickled reanalyzeRecording tasks in taskPath with a pool
+  of processes and pickles the list of summaries to resultPath.
+  """
+    with open(taskPath, 'rb') as taskFile:
+        if sys.version_info[0] >= 3:
+            tasks = pickle.load(taskFile, encoding='latin1')  # numpy arrays pickled by Slicer's Python 2
+        else:
+            tasks = pickle.load(taskFile)
+    if processes > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(processes, len(tasks)))
+        try:
+            summaries = pool.map(reanalyzeRecording, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        summaries = [reanalyzeRecording(task) for task in tasks]
+    with open(resultPath, 'wb') as resultFile:
+        pickle.dump(summaries, resultFile, 2)
+
+
+class BatchThread(threading.Thread):
+    """Runs runBatch without a pool in a thread of the calling process, for
+  Slicer builds that have no separate interpreter for the worker. poll() and
+  returncode stand in for those of the worker process, errors are written to
+  errorPath like the worker's output.
+  """
+
+    def __init__(self, taskPath, resultPath, errorPath):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.taskPath = taskPath
+        self.resultPath = resultPath
+        self.errorPath = errorPath
+        self.returncode = None
+
+    def run(self):
+        try:
+            runBatch(self.taskPath, self.resultPath)
+            self.returncode = 0
+        except Exception:
+            with open(self.errorPath, 'w') as errorFile:
+                errorFile.write(traceback.format_exc())
+            self.returncode = 1
+
+    def poll(self):
+        return self.returncode
+
+
+if __name__ == "__main__":
+    # run through the module so pickled classes and pool tasks refer to SpectrumAnalysis, not __main__
+    import SpectrumAnalysis
+    SpectrumAnalysis.runBatch(sys.argv[1], sys.argv[2], int(sys.argv[3]))